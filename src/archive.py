@@ -2,13 +2,17 @@
 """archive.py - Archive handling (extract/create) for Comix."""
 from __future__ import absolute_import
 
+import bz2
 import os
 import re
-import sys
+import shutil
+import struct
 import tarfile
+import tempfile
 import threading
 import zipfile
-from io import StringIO
+import zlib
+from io import BytesIO
 
 from gi.repository import Gtk
 
@@ -17,14 +21,37 @@ try:
 except ImportError:
     Archive7z = None  # ignore it.
 
+from src import archivecache
 from src import mobiunpack
 from src import process
+from src import seekable
 from src.image import get_supported_format_extensions_preg
 
 ZIP, RAR, TAR, GZIP, BZIP2, SEVENZIP, MOBI = range(7)
 
 _rar_exec = None
 _7z_exec = None
+_7z_progress_switches = None
+
+# The largest number of files extracted by a single RAR or 7z process.
+_MAX_BATCH_SIZE = 64
+
+# How much of the start and the end of a file is read to find its type.
+# The end must hold a ZIP end of central directory record with the
+# longest possible comment.
+_SNIFF_HEAD_SIZE = 4096
+_SNIFF_TAIL_SIZE = 22 + 65535
+# The archive types found so far, keyed on (path, mtime, size).
+_mime_types = {}
+_MAX_MIME_TYPES = 10000
+# False in processes without a user interface, see set_interactive().
+_interactive = True
+
+
+class ArchiveError(Exception):
+    """Raised by Extractor.setup(), when not interactive, if the archive
+    can not be read.
+    """
 
 
 class Extractor(object):
@@ -38,12 +65,20 @@ class Extractor(object):
     and a signal is sent on a condition after each extraction, so that it is
     possible for other threads to wait on specific files to be ready.
 
-    Note: Support for gzip/bzip2 compressed tar archives is limited, see
-    set_files() for more info.
+    Archives that allow random access can also have files read straight
+    from them, without ever writing them to disk, see set_direct_read().
+
+    Gzip/bzip2 compressed tar archives allow random access too, through
+    an index of checkpoints in the compressed data (see the seekable
+    module) that is built while the archive is first read through.
     """
 
     def __init__(self):
         self._setupped = False
+        self._stop = True
+        self._extracted = {}
+        self._processes = []
+        self._condition = threading.Condition()
 
     def setup(self, src, dst):
         """Setup the extractor with archive <src> and destination dir <dst>.
@@ -52,39 +87,76 @@ class Extractor(object):
         """
         self._src = src
         self._dst = dst
-        self._type = archive_mime_type(src)
+        # Reopening an archive (or scanning it into the library) uses the
+        # stored table of contents instead of listing the archive again.
+        toc = archivecache.get_toc(src)
+        if toc is not None:
+            self._type, members, self._solid = toc
+        else:
+            self._type = archive_mime_type(src)
+            members = None
+            self._solid = None
+        # Only complete listings are stored, see the end of setup().
+        listed = True
         self._files = []
-        self._extracted = {}
-        self._stop = False
-        self._extract_thread = None
-        self._condition = threading.Condition()
+        self._tar_members = {}
+        self._direct = set()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._handles = []
+        # py7zlib archives can not be closed, the files they read from
+        # are closed instead, see _open_7z().
+        self._7z_files = {}
+        self._queue = []
+        self._extract_threads = []
+        self._processes = []
+        self._pool_size = 0
+        # The same Condition is used for every archive, so that threads
+        # waiting on it are still woken up by later calls to stop().
+        with self._condition:
+            self._extracted = {}
+            self._stop = False
 
         if self._type == ZIP:
             self._zfile = zipfile.ZipFile(src, 'r')
+            if members is None:
+                members = [(info.filename, info.header_offset, info.file_size)
+                           for info in self._zfile.infolist()]
             self._files = self._zfile.namelist()
         elif self._type in (TAR, GZIP, BZIP2):
-            self._tfile = tarfile.open(src, 'r')
-            self._files = self._tfile.getnames()
+            self._tfile = _open_tar(src, self._type)
+            if members is None:
+                # Offsets are only stored for plain files, anything else
+                # is looked up by name in the archive when needed.
+                members = [(info.name,
+                            info.offset_data if info.isfile() and not info.issparse() else None,
+                            info.size)
+                           for info in self._tfile.getmembers() if not info.isdir()]
+            self._tar_members = dict((name, (offset, size))
+                                     for name, offset, size in members)
+            self._files = [member[0] for member in members]
         elif self._type == RAR:
             global _rar_exec
             if _rar_exec is None:
                 _rar_exec = _get_rar_exec()
                 if _rar_exec is None:
                     print('! Could not find RAR file extractor.')
-                    dialog = Gtk.MessageDialog(None, 0, Gtk.MessageType.WARNING,
-                                               Gtk.ButtonsType.CLOSE,
-                                               _("Could not find RAR file extractor!"))
-                    dialog.format_secondary_markup(_("You need either the <i>rar</i> or the"
-                                                     " <i>unrar</i> program installed in order "
-                                                     "to read RAR (.cbr) files."))
-                    dialog.run()
-                    dialog.destroy()
+                    _report_error(_("Could not find RAR file extractor!"),
+                                  _("You need either the <i>rar</i> or the"
+                                    " <i>unrar</i> program installed in order "
+                                    "to read RAR (.cbr) files."))
                     return None
-            proc = process.Process([_rar_exec, 'vb', '-p-', '--', src])
-            fd = proc.spawn()
-            self._files = [name.rstrip(os.linesep) for name in fd.readlines()]
-            fd.close()
-            proc.wait()
+            if members is None:
+                proc = process.Process([_rar_exec, 'vb', '-p-', '--', src])
+                fd = proc.spawn()
+                if fd is not None:
+                    self._files = [_decode_output(name) for name in fd.readlines()]
+                    fd.close()
+                listed = fd is not None and proc.wait() == 0
+            else:
+                self._files = [member[0] for member in members]
+            if self._solid is None:
+                self._solid = _is_solid_rar(src)
         elif self._type == SEVENZIP:
             global _7z_exec, Archive7z
 
@@ -95,7 +167,7 @@ class Extractor(object):
                     _7z_exec = _get_7z_exec()
             else:
                 try:
-                    self._szfile = Archive7z(open(src, 'rb'), '-')
+                    self._szfile = self._open_7z()
                     self._files = self._szfile.getnames()
                 except:
                     Archive7z = None
@@ -105,28 +177,30 @@ class Extractor(object):
 
             if _7z_exec is None:
                 print('! Could not find 7Z file extractor.')
+            elif not Archive7z and members is not None and self._solid is not None:
+                self._files = [member[0] for member in members]
             elif not Archive7z:
-                proc = process.Process([_7z_exec, 'l', '-bd', '-slt', '-p-', src])
+                proc = process.Process([_7z_exec, 'l', '-bd', '-slt', '-p-', '--', src])
                 fd = proc.spawn()
-                self._files = self._process_7z_names(fd)
-                fd.close()
-                proc.wait()
+                if fd is not None:
+                    self._files = self._process_7z_names(fd)
+                    fd.close()
+                listed = fd is not None and proc.wait() == 0
 
             if not _7z_exec and not Archive7z:
-                dialog = Gtk.MessageDialog(None, 0, Gtk.MessageType.WARNING,
-                                           Gtk.ButtonsType.CLOSE,
-                                           _("Could not find 7Z file extractor!"))
-                dialog.format_secondary_markup(_("You need either the <i>pylzma</i> "
-                                                 "or the <i>p7zip</i> program installed "
-                                                 "in order to read 7Z (.cb7) files."))
-                dialog.run()
-                dialog.destroy()
+                _report_error(_("Could not find 7Z file extractor!"),
+                              _("You need either the <i>pylzma</i> "
+                                "or the <i>p7zip</i> program installed "
+                                "in order to read 7Z (.cb7) files."))
                 return None
         elif self._type == MOBI:
             self._mobifile = None
             try:
                 self._mobifile = mobiunpack.MobiFile(src)
-                self._files = self._mobifile.getnames()
+                if members is None:
+                    self._files = self._mobifile.getnames()
+                else:
+                    self._files = [member[0] for member in members]
             except mobiunpack.unpackException as e:
                 print('! Failed to unpack MobiPocket: {}'.format(e))
                 return None
@@ -135,6 +209,13 @@ class Extractor(object):
             print('! Non-supported archive format: {}'.format(src))
             return None
 
+        # A failed or empty listing (e.g. of an archive that is still being
+        # written) is not stored, so that it is tried again next time.
+        if listed and self._files and \
+                (toc is None or toc[2] is None and self._solid is not None):
+            if members is None:
+                members = [(name, None, None) for name in self._files]
+            archivecache.set_toc(src, self._type, members, self._solid)
         self._setupped = True
         return self._condition
 
@@ -152,18 +233,16 @@ class Extractor(object):
                 break
 
             if line:
-                line = line.rstrip(os.linesep)
-                try:
-                    # For non-ascii files names
-                    line = line.decode("utf-8")
-                except:
-                    pass
+                line = _decode_output(line)
 
                 if line.startswith(START):
                     started = True
                     item = {}
                     continue
 
+                if not started and line.startswith('Solid = '):
+                    self._solid = line.endswith('+')
+
                 if started:
                     if line == "":
                         if item["Attributes"].find("D") == -1:
@@ -196,21 +275,81 @@ class Extractor(object):
         managing : setting files as extracted, in order to avoid any blocking
         wait on files not present in the original archive.
 
-        Note: Random access on gzip or bzip2 compressed tar archives is
-        no good idea. These formats are supported *only* for backwards
-        compability. They are fine formats for some purposes, but should
-        not be used for scanned comic books. So, we cheat and ignore the
-        ordering applied with this method on such archives.
+        Gzip or bzip2 compressed tar archives are read through the seekable
+        module, so random access on them only costs the decompression from
+        the closest checkpoint once the archive has been read through.
         """
         if extracted:
             self._files = files
             for filename in files:
                 self._extracted[filename] = True
             return
-        if self._type in (GZIP, BZIP2):
-            self._files = [x for x in self._files if x in files]
-        else:
-            self._files = files
+        self._files = files
+
+    def can_read_directly(self):
+        """Return True if files can be read straight from the current
+        archive with read_file(), without first extracting them to disk.
+        """
+        if self._type in (ZIP, TAR, GZIP, BZIP2, MOBI):
+            return True
+        return self._type == SEVENZIP and Archive7z is not None
+
+    def set_direct_read(self, files):
+        """Mark the files in <files> as read directly from the archive.
+        They are never extracted by the extracting thread, but are
+        considered ready at once and their contents can be fetched with
+        read_file(). Only valid if can_read_directly() returns True.
+
+        If one of these files should still be needed on disk at some
+        point, extract_file() can be used to put it there.
+        """
+        self._direct = set(files)
+        self._files = [x for x in self._files if x not in self._direct]
+        for filename in self._direct:
+            self._extracted[filename] = True
+
+    def is_direct(self, name):
+        """Return True if the file <name> is read directly from the
+        archive (see set_direct_read()).
+        """
+        return name in self._direct
+
+    def read_file(self, name, size=None):
+        """Return the contents of the file <name> in the archive as a
+        bytes-like object, read straight from the archive. For MobiPocket
+        files this is a memoryview of the file itself. If <size> is given,
+        at most the first <size> bytes are returned.
+        """
+        if not self.can_read_directly():
+            raise ValueError('Can not read {} directly'.format(name))
+        return self._read_member(self._get_thread_handle(), name, size)
+
+    def extract_file(self, name):
+        """Make sure that the directly read file <name> (see
+        set_direct_read()) exists in the destination directory, extracting
+        it in the calling thread if it does not. Return the full path to
+        the extracted file.
+        """
+        dst_path = os.path.join(self._dst, name)
+        handle = self._get_thread_handle()
+        with self._lock:
+            if not os.path.exists(dst_path):
+                self._write_member(handle, name)
+        return dst_path
+
+    def prioritize(self, files):
+        """Move the files in <files> to the front of the extraction queue,
+        in the given order, so that they are extracted as soon as an
+        extracting thread is free. Files that are already extracted, or
+        currently being extracted, are ignored.
+        """
+        with self._condition:
+            queued = set(self._queue)
+            first = [name for name in files if name in queued]
+            if first:
+                first_set = set(first)
+                self._queue = first + [x for x in self._queue
+                                       if x not in first_set]
 
     def is_ready(self, name):
         """Return True if the file <name> in the extractor's file list
@@ -218,27 +357,60 @@ class Extractor(object):
         """
         return self._extracted.get(name, False)
 
+    def is_stopped(self):
+        """Return True if stop() has been called since the last setup()."""
+        return self._stop
+
     def get_mime_type(self):
         """Return the mime type name of the extractor's current archive."""
         return self._type
 
     def stop(self):
         """Signal the extractor to stop extracting and kill the extracting
-        thread. Blocks until the extracting thread has terminated.
+        threads. Blocks until the extracting threads have terminated.
         """
-        self._stop = True
+        with self._condition:
+            self._stop = True
+            for proc in self._processes:
+                proc.terminate()
+            self._condition.notify_all()
         if self._setupped:
-            self._extract_thread.join()
-            self.setupped = False
+            for thread in self._extract_threads:
+                thread.join()
+            if self._direct:
+                self.close()
+            self._setupped = False
 
     def extract(self):
-        """Start extracting the files in the file list one by one using a
-        new thread. Every time a new file is extracted a notify() will be
-        signalled on the Condition that was returned by setup().
+        """Start extracting the files in the file list using new threads.
+        Every time a new file is extracted a notify() will be signalled on
+        the Condition that was returned by setup().
+
+        Archives that allow random access are extracted by a pool of
+        threads, each with a handle of its own to the archive, that take
+        files in the current queue order (see prioritize()). RAR archives,
+        and 7z archives without pylzma, are extracted by a pool of threads
+        that take batches of files in queue order and run one external
+        process per batch. Solid RAR or 7z archives can only be decompressed
+        from the start though, so they are instead streamed in archive order
+        by a single process.
         """
-        self._extract_thread = threading.Thread(target=self._thread_extract)
-        self._extract_thread.setDaemon(False)
-        self._extract_thread.start()
+        self._queue = self._files[:]
+        self._pool_size = min(_get_worker_count(), len(self._queue))
+        if self.can_read_directly():
+            target = self._thread_extract_worker
+            if not self._queue and not self._direct:
+                self.close()
+        elif self._solid:
+            self._pool_size = min(1, len(self._queue))
+            target = self._thread_extract_solid
+        else:
+            target = self._thread_extract_batches
+        for i in range(self._pool_size):
+            thread = threading.Thread(target=target)
+            thread.setDaemon(False)
+            thread.start()
+            self._extract_threads.append(thread)
 
     def close(self):
         """Close any open file objects, need only be called manually if the
@@ -247,129 +419,320 @@ class Extractor(object):
         if self._type == ZIP:
             self._zfile.close()
         elif self._type in (TAR, GZIP, BZIP2):
-            self._tfile.close()
+            _close_tar(self._tfile)
         elif self._type == MOBI and self._mobifile is not None:
             self._mobifile.close()
+        with self._lock:
+            handles = self._handles
+            self._handles = []
+        for handle in handles:
+            self._close_handle(handle)
+        with self._lock:
+            files = list(self._7z_files.values())
+            self._7z_files = {}
+        for fd in files:
+            fd.close()
 
-    def _thread_extract(self):
-        """Extract the files in the file list one by one."""
-        # Extract 7z and rar whole archive - if it SOLID - extract one file is SLOW
-        if self._type in (SEVENZIP,) and _7z_exec is not None:
-            cmd = [_7z_exec, 'x', '-bd', '-p-',
-                   '-o' + self._dst, '-y', self._src]
-            proc = process.Process(cmd)
-            proc.spawn()
-            proc.wait()
-            self._condition.acquire()
-            for name in self._files:
-                self._extracted[name] = True
-            self._condition.notify()
-            self._condition.release()
-        if self._type in (RAR,) and _rar_exec is not None:
-            cwd = os.getcwd()
-            os.chdir(self._dst)
-            cmd = [_rar_exec, 'x', '-kb', '-p-',
-                   '-o-', '-inul', '--', self._src]
-            proc = process.Process(cmd)
-            proc.spawn()
-            proc.wait()
-            os.chdir(cwd)
-            self._condition.acquire()
-            for name in self._files:
-                self._extracted[name] = True
-            self._condition.notify()
-            self._condition.release()
+    def close_thread_handle(self):
+        """Close the object that the calling thread uses to read from the
+        archive, if it has one of its own (see _get_thread_handle()).
+        Threads that read from the archive should call this before they
+        exit, close() only closes them together with the archive.
+        """
+        handle = getattr(self._local, 'handle', None)
+        if handle is None:
+            return
+        self._local.handle = None
+        with self._lock:
+            if handle not in self._handles:
+                return
+            self._handles.remove(handle)
+        self._close_handle(handle)
+
+    def _get_handle(self):
+        """Return the object used to read from the archive set up in
+        setup().
+        """
+        if self._type == ZIP:
+            return self._zfile
+        elif self._type in (TAR, GZIP, BZIP2):
+            return self._tfile
+        elif self._type == SEVENZIP:
+            return self._szfile
+        elif self._type == MOBI:
+            return self._mobifile
+
+    def _get_thread_handle(self):
+        """Return the object used by the calling thread to read from the
+        archive. The main thread uses the one opened in setup(), any other
+        thread gets one of its own the first time it asks, so that
+        directly read files can be decoded in parallel. These are closed
+        by close().
+        """
+        handle = getattr(self._local, 'handle', None)
+        if handle is None:
+            # MobiPocket files are read through slices of a memory map,
+            # which can be shared by any number of threads.
+            if threading.current_thread() is threading.main_thread() or \
+                    self._type == MOBI:
+                handle = self._get_handle()
+            else:
+                handle = self._open_handle()
+                with self._lock:
+                    self._handles.append(handle)
+            self._local.handle = handle
+        return handle
+
+    def _open_handle(self):
+        """Return a new object for reading from the archive, independent
+        of the one opened in setup() (so that it can be used concurrently).
+        """
+        if self._type == ZIP:
+            return zipfile.ZipFile(self._src, 'r')
+        elif self._type in (TAR, GZIP, BZIP2):
+            return _open_tar(self._src, self._type)
+        elif self._type == SEVENZIP:
+            return self._open_7z()
+        elif self._type == MOBI:
+            return mobiunpack.MobiFile(self._src)
+
+    def _close_handle(self, handle):
+        """Close a <handle> returned by _open_handle()."""
+        if self._type in (TAR, GZIP, BZIP2):
+            _close_tar(handle)
+        elif self._type == SEVENZIP:
+            with self._lock:
+                fd = self._7z_files.pop(id(handle), None)
+            if fd is not None:
+                fd.close()
         else:
-            for name in self._files:
-                self._extract_file(name)
-        self.close()
-
-    def _extract_file(self, name):
-        """Extract the file named <name> to the destination directory,
-        mark the file as "ready", then signal a notify() on the Condition
-        returned by setup().
+            handle.close()
+
+    def _open_7z(self):
+        """Return a new py7zlib archive for the 7z archive. The file it
+        reads from is kept, so that it can be closed by _close_handle()
+        or close().
         """
-        if self._stop:
-            self.close()
-            sys.exit(0)
+        fd = open(self._src, 'rb')
         try:
-            if self._type in (ZIP, SEVENZIP):
-                dst_path = os.path.join(self._dst, name)
-                if not os.path.exists(os.path.dirname(dst_path)):
-                    os.makedirs(os.path.dirname(dst_path))
-                new = open(dst_path, 'wb')
-                if self._type == ZIP:
-                    new.write(self._zfile.read(name, '-'))
-                elif self._type == SEVENZIP:
-                    if Archive7z is not None:
-                        new.write(self._szfile.getmember(name).read())
-                    else:
-                        if _7z_exec is not None:
-                            proc = process.Process([_7z_exec, 'x', '-bd', '-p-',
-                                                    '-o' + self._dst, '-y', self._src, name])
-                            proc.spawn()
-                            proc.wait()
-                        else:
-                            print('! Could not find 7Z file extractor.')
-
-                new.close()
-            elif self._type in (TAR, GZIP, BZIP2):
-                if os.path.normpath(os.path.join(self._dst, name)).startswith(
-                        self._dst):
-                    self._tfile.extract(name, self._dst)
-                else:
-                    print('! Non-local tar member: {}\n'.format(name))
-            elif self._type == RAR:
-                if _rar_exec is not None:
-                    cwd = os.getcwd()
-                    os.chdir(self._dst)
-                    proc = process.Process([_rar_exec, 'x', '-kb', '-p-',
-                                            '-o-', '-inul', '--', self._src, name])
-                    proc.spawn()
-                    proc.wait()
-                    os.chdir(cwd)
-                else:
-                    print('! Could not find RAR file extractor.')
-            elif self._type == MOBI:
-                dst_path = os.path.join(self._dst, name)
-                self._mobifile.extract(name, dst_path)
-        except Exception:
-            # Better to ignore any failed extractions (e.g. from a corrupt
-            # archive) than to crash here and leave the main thread in a
-            # possible infinite block. Damaged or missing files *should* be
-            # handled gracefully by the main program anyway.
-            pass
+            handle = Archive7z(fd, '-')
+        except:
+            fd.close()
+            raise
+        with self._lock:
+            self._7z_files[id(handle)] = fd
+        return handle
+
+    def _read_member(self, handle, name, size=None):
+        """Return the contents of the file <name>, or at most the first
+        <size> bytes of it, read from the archive through <handle>.
+        """
+        if self._type == ZIP:
+            if size is None:
+                return handle.read(name)
+            member = handle.open(name)
+            try:
+                return member.read(size)
+            finally:
+                member.close()
+        elif self._type in (TAR, GZIP, BZIP2):
+            return handle.extractfile(self._get_tar_member(name)).read(size)
+        elif self._type == SEVENZIP:
+            return handle.getmember(name).read()[:size]
+        elif self._type == MOBI:
+            return handle.read(name)[:size]
+
+    def _get_tar_member(self, name):
+        """Return a TarInfo for the file <name> in a tar archive, made up
+        from its offset in the archive if that is known so that tarfile
+        does not have to walk through the archive to find it. Otherwise
+        return <name> itself.
+        """
+        offset, size = self._tar_members.get(name, (None, None))
+        if offset is None:
+            return name
+        info = tarfile.TarInfo(name)
+        info.offset_data = offset
+        info.size = size
+        return info
+
+    def _write_member(self, handle, name):
+        """Extract the file <name>, read from the archive through <handle>,
+        to the destination directory.
+        """
+        dst_path = os.path.join(self._dst, name)
+        if not os.path.normpath(dst_path).startswith(self._dst):
+            print('! Non-local archive member: {}'.format(name))
+            return
+        data = self._read_member(handle, name)
+        if not os.path.exists(os.path.dirname(dst_path)):
+            os.makedirs(os.path.dirname(dst_path))
+        new = open(dst_path, 'wb')
+        new.write(data)
+        new.close()
+
+    def _set_ready(self, name):
+        """Mark the file <name> as "ready" and signal a notify_all() on
+        the Condition returned by setup().
+        """
         self._condition.acquire()
         self._extracted[name] = True
-        self._condition.notify()
+        self._condition.notify_all()
         self._condition.release()
 
+    def _thread_extract_worker(self):
+        """Extract the files at the front of the extraction queue one by
+        one, through a handle of its own to the archive, until the queue
+        is empty or the extractor is stopped.
+        """
+        try:
+            handle = self._open_handle()
+        except Exception:
+            handle = None
+        while True:
+            with self._condition:
+                if self._stop or not self._queue:
+                    break
+                name = self._queue.pop(0)
+            try:
+                self._write_member(handle, name)
+            except Exception:
+                # Better to ignore any failed extractions (e.g. from a
+                # corrupt archive) than to crash here and leave the main
+                # thread in a possible infinite block. Damaged or missing
+                # files *should* be handled gracefully by the main program.
+                pass
+            self._set_ready(name)
+        if handle is not None:
+            self._close_handle(handle)
+        with self._condition:
+            self._pool_size -= 1
+            last = self._pool_size == 0
+        # Directly read files need the archive to stay open until stop().
+        if last and not self._direct:
+            self.close()
+
+    def _thread_extract_batches(self):
+        """Extract the files at the front of the extraction queue in
+        batches, with one RAR or 7z process per batch, until the queue is
+        empty or the extractor is stopped. The batches start small, so
+        that the first pages are ready fast, and grow as the extraction
+        goes on, so that few processes have to be started in total.
+        """
+        batch_size = 1
+        while True:
+            with self._condition:
+                if self._stop or not self._queue:
+                    break
+                batch = self._queue[:batch_size]
+                del self._queue[:batch_size]
+            self._run_extract_process(batch)
+            batch_size = min(batch_size * 2, _MAX_BATCH_SIZE)
+
+    def _thread_extract_solid(self):
+        """Extract all the files in the extraction queue with a single RAR
+        or 7z process, which goes through the archive from the start.
+        Files are ready as soon as the process gets to them, so the time
+        until the first pages are ready does not depend on the size of the
+        archive.
+        """
+        with self._condition:
+            names = self._queue
+            self._queue = []
+        # Rather than passing a huge command line, extract everything.
+        self._run_extract_process(names, everything=len(names) > _MAX_BATCH_SIZE)
+
+    def _run_extract_process(self, names, everything=False, dst=None):
+        """Extract the files <names> (or all the files in the archive, if
+        <everything> is True) with a single RAR or 7z process, that writes
+        them straight to the destination directory (or <dst>, if given).
+        Each file is marked as ready as soon as the process reports it as
+        extracted.
+        """
+        if dst is None:
+            dst = self._dst
+        wanted = [] if everything else names
+        if self._type == RAR:
+            # unrar reports each file when it is done.
+            cmd = ([_rar_exec, 'x', '-kb', '-p-', '-o-', '-idc', '-idp', '--',
+                    self._src] + wanted + [dst])
+        else:
+            # 7z reports each file when it starts on it.
+            cmd = ([_7z_exec, 'x', '-bd', '-p-', '-y', '-o' + dst] +
+                   _get_7z_progress_switches() + ['--', self._src] + wanted)
+        pending = set(names)
+        proc = process.Process(cmd)
+        with self._condition:
+            if self._stop:
+                return
+            fd = proc.spawn()
+            self._processes.append(proc)
+        if fd is not None:
+            started = None
+            for line in fd:
+                name = _get_extracted_name(_decode_output(line), dst)
+                if name is None:
+                    continue
+                if self._type == RAR:
+                    done = name
+                else:
+                    done, started = started, name
+                if done in pending:
+                    pending.discard(done)
+                    self._set_ready(done)
+            fd.close()
+            proc.wait()
+        with self._condition:
+            self._processes.remove(proc)
+        # Failed extractions are marked as ready too, see
+        # _thread_extract_worker().
+        for name in names:
+            if name in pending:
+                self._set_ready(name)
+
     def extract_file_io(self, chosen):
-        """Extract the file named <name> to the destination directory,
-        mark the file as "ready", then signal a notify() on the Condition
-        returned by setup().
+        """Return a file object with the contents of the file named
+        <chosen>. RAR archives, and 7z archives without pylzma, are
+        extracted to the destination directory (or a temporary one if
+        there is none) by the same process as extract() uses.
         """
 
-        if os.path.exists(os.path.join(self._dst, chosen)):
-            StringIO(open(os.path.join(self._dst, chosen), 'rb').read())
+        if self._dst is not None and os.path.exists(os.path.join(self._dst, chosen)):
+            with open(os.path.join(self._dst, chosen), 'rb') as fd:
+                return BytesIO(fd.read())
 
         if self._type == ZIP:
-            return StringIO(self._zfile.read(chosen))
+            return BytesIO(self._zfile.read(chosen))
         elif self._type in [TAR, GZIP, BZIP2]:
-            return StringIO(self._tfile.extractfile(chosen).read())
+            return BytesIO(self._tfile.extractfile(self._get_tar_member(chosen)).read())
         elif self._type == RAR:
-            proc = process.Process([_rar_exec, 'p', '-inul', '-p-', '--',
-                                    self._src, chosen])
-            fobj = proc.spawn()
-            return StringIO(fobj.read())
+            return self._extract_file_io_process(chosen)
         elif self._type == SEVENZIP:
             if Archive7z is not None:
-                return StringIO(self._szfile.getmember(chosen).read())
+                return BytesIO(self._szfile.getmember(chosen).read())
             elif _7z_exec is not None:
-                proc = process.Process([_7z_exec, 'e', '-bd', '-p-', '-so',
-                                        self._src, chosen])
-                fobj = proc.spawn()
-                return StringIO(fobj.read())
+                return self._extract_file_io_process(chosen)
+        elif self._type == MOBI:
+            return BytesIO(self._mobifile.read(chosen))
+
+
+    def _extract_file_io_process(self, chosen):
+        """Return a file object with the contents of the file named
+        <chosen>, extracted with _run_extract_process(). It is empty if
+        the file could not be extracted.
+        """
+        dst = self._dst
+        if dst is None:
+            dst = tempfile.mkdtemp(prefix='comix.', suffix=os.sep)
+        try:
+            self._run_extract_process([chosen], dst=dst)
+            with open(os.path.join(dst, chosen), 'rb') as fd:
+                return BytesIO(fd.read())
+        except IOError:
+            return BytesIO()
+        finally:
+            if dst is not self._dst:
+                shutil.rmtree(dst, ignore_errors=True)
 
 
 class Packer(object):
@@ -455,35 +818,110 @@ class Packer(object):
 
 
 def archive_mime_type(path):
-    """Return the archive type of <path> or None for non-archives."""
+    """Return the archive type of <path> or None for non-archives.
+
+    The type is found from a single read of the start and the end of the
+    file, and remembered for as long as the file is unchanged.
+    """
     try:
-        if os.path.isfile(path):
-            if not os.access(path, os.R_OK):
-                return None
-            if zipfile.is_zipfile(path):
-                return ZIP
-            fd = open(path, 'rb')
-            magic = fd.read(4)
-            fd.seek(60)
-            magic2 = fd.read(8)
-            fd.close()
-            if tarfile.is_tarfile(path) and os.path.getsize(path) > 0:
-                if magic.startswith('BZh'):
-                    return BZIP2
-                if magic.startswith('\037\213'):
-                    return GZIP
-                return TAR
-            if magic == 'Rar!':
-                return RAR
-            if magic == '7z\xbc\xaf':
-                return SEVENZIP
-            if magic2 == 'BOOKMOBI':
-                return MOBI
+        if not os.path.isfile(path) or not os.access(path, os.R_OK):
+            return None
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime, stat.st_size)
+        if key in _mime_types:
+            return _mime_types[key]
+        with open(path, 'rb') as fd:
+            archive_type = _sniff_archive_type(fd, stat.st_size)
     except Exception:
         print('! Error while reading {}'.format(path))
+        return None
+    if len(_mime_types) >= _MAX_MIME_TYPES:
+        _mime_types.clear()
+    _mime_types[key] = archive_type
+    return archive_type
+
+
+def _sniff_archive_type(fd, size):
+    """Return the archive type of the file <fd> of <size> bytes, or None
+    for non-archives.
+    """
+    if size == 0:
+        return None
+    head = fd.read(_SNIFF_HEAD_SIZE)
+    if size <= len(head):
+        tail = head
+    else:
+        fd.seek(max(size - _SNIFF_TAIL_SIZE, len(head)))
+        tail = fd.read()
+    if _is_zip(head, tail):
+        return ZIP
+    if head.startswith(b'BZh'):
+        if _is_tar_header(_decompress_head(fd, head, bz2.BZ2Decompressor())):
+            return BZIP2
+    elif head.startswith(b'\037\213'):
+        if _is_tar_header(_decompress_head(fd, head, zlib.decompressobj(31))):
+            return GZIP
+    elif _is_tar_header(head):
+        return TAR
+    if head.startswith(b'Rar!'):
+        return RAR
+    if head.startswith(b'7z\xbc\xaf'):
+        return SEVENZIP
+    if head[60:68] == b'BOOKMOBI':
+        return MOBI
     return None
 
 
+def _is_zip(head, tail):
+    """Return True if the start <head> and end <tail> of a file look like
+    a ZIP archive, i.e. if the end contains a valid end of central
+    directory record.
+    """
+    if head.startswith(b'PK\005\006'):  # Empty archive.
+        return len(head) >= 22
+    pos = tail.rfind(b'PK\005\006')
+    while pos >= 0:
+        # The record ends with a comment whose length it gives.
+        if len(tail) >= pos + 22:
+            comment_size, = struct.unpack_from('<H', tail, pos + 20)
+            if pos + 22 + comment_size <= len(tail):
+                return True
+        pos = tail.rfind(b'PK\005\006', 0, pos)
+    return False
+
+
+def _decompress_head(fd, head, decompressor):
+    """Return at least the first tar block of the file <fd> decompressed
+    with <decompressor>, or less if the file is shorter or not valid.
+    <head> is the data already read from the start of the file. More of
+    the file is read only if needed (bzip2 only outputs whole blocks).
+    """
+    data = head
+    fd.seek(len(head))
+    output = b''
+    try:
+        while data and len(output) < tarfile.BLOCKSIZE:
+            output += decompressor.decompress(data)
+            if getattr(decompressor, 'eof', False):
+                break
+            data = fd.read(_SNIFF_HEAD_SIZE)
+    except (zlib.error, IOError, EOFError):
+        pass
+    return output
+
+
+def _is_tar_header(block):
+    """Return True if <block> starts with a valid tar header."""
+    if len(block) < tarfile.BLOCKSIZE:
+        return False
+    try:
+        tarfile.TarInfo.frombuf(block[:tarfile.BLOCKSIZE], tarfile.ENCODING,
+                                'surrogateescape')
+    except tarfile.HeaderError:
+        return False
+    return True
+
+
 def get_name(archive_type):
     """Return a text representation of an archive type."""
     return {ZIP: _('ZIP archive'),
@@ -501,18 +939,167 @@ def get_archive_info(path):
     at <path>, or None if <path> doesn't point to a supported archive.
     """
     image_re = re.compile('\.(' + '|'.join(get_supported_format_extensions_preg()) + ')\s*$', re.I)
-    extractor = Extractor()
-    extractor.setup(path, None)
-    mime = extractor.get_mime_type()
-    if mime is None:
-        return None
-    files = extractor.get_files()
-    extractor.close()
+    toc = archivecache.get_toc(path)
+    if toc is not None:
+        mime = toc[0]
+        files = [member[0] for member in toc[1]]
+    else:
+        extractor = Extractor()
+        if extractor.setup(path, None) is None:
+            return None
+        mime = extractor.get_mime_type()
+        if mime is None:
+            return None
+        files = extractor.get_files()
+        extractor.close()
     num_pages = len([f for f in files if image_re.search(f)])
     size = os.stat(path).st_size
     return mime, num_pages, size
 
 
+def set_interactive(interactive):
+    """Set whether Extractor.setup() may show dialogs, which it does
+    about missing extractor programs. Processes without a user interface
+    should set this to False, setup() then raises an ArchiveError instead.
+    """
+    global _interactive
+    _interactive = interactive
+
+
+def _report_error(message, details):
+    """Tell the user about an archive that can not be read, with
+    <message> and the Pango markup <details>. When not interactive, raise
+    an ArchiveError with <message> instead.
+    """
+    if not _interactive:
+        raise ArchiveError(message)
+    dialog = Gtk.MessageDialog(None, 0, Gtk.MessageType.WARNING,
+                               Gtk.ButtonsType.CLOSE, message)
+    dialog.format_secondary_markup(details)
+    dialog.run()
+    dialog.destroy()
+
+
+def _open_tar(src, archive_type):
+    """Return a TarFile for the tar archive <src> of type <archive_type>.
+    Compressed archives are read through a seekable.SeekableFile, so that
+    their members can be read in any order.
+    """
+    if archive_type == GZIP:
+        return tarfile.open(fileobj=seekable.SeekableFile(src, seekable.GZIP), mode='r:')
+    elif archive_type == BZIP2:
+        return tarfile.open(fileobj=seekable.SeekableFile(src, seekable.BZIP2), mode='r:')
+    return tarfile.open(src, 'r')
+
+
+def _close_tar(tfile):
+    """Close the TarFile <tfile> returned by _open_tar()."""
+    fileobj = tfile.fileobj
+    tfile.close()
+    if isinstance(fileobj, seekable.SeekableFile):
+        fileobj.close()
+
+
+def _get_worker_count():
+    """Return the number of threads to use when extracting archives that
+    allow random access.
+    """
+    return max(1, min(8, os.cpu_count() or 1))
+
+
+def _decode_output(line):
+    """Return the <line> of output from an external program as text,
+    without the line ending.
+    """
+    if isinstance(line, bytes):
+        line = line.decode('utf-8', 'replace')
+    return line.rstrip('\r\n')
+
+
+def _get_extracted_name(line, dst=None):
+    """Return the name of the file in a <line> of progress output from
+    unrar ("Extracting  <name>  OK") or 7z ("- <name>" from 7z 15 and
+    later with -bb1, "Extracting  <name>" before that), or None if the
+    line is not about an extracted file. unrar reports the path of the
+    extracted file, which starts with the destination dir <dst>, rather
+    than the name in the archive, so <dst> is stripped.
+    """
+    if line.startswith('Extracting  '):
+        name = line[len('Extracting  '):].rstrip()
+        if name.endswith(' OK'):
+            name = name[:-len(' OK')].rstrip()
+    elif line.startswith('- '):
+        name = line[len('- '):]
+    else:
+        return None
+    if dst:
+        dst = os.path.join(dst, '')
+        if name.startswith(dst):
+            name = name[len(dst):]
+    return name or None
+
+
+def _get_7z_progress_switches():
+    """Return the switches that make 7z print the name of each file it
+    extracts, which it does by default before version 15 but only with
+    -bb1 (which older versions do not know) since.
+    """
+    global _7z_progress_switches
+    if _7z_progress_switches is None:
+        _7z_progress_switches = []
+        proc = process.Process([_7z_exec])
+        fd = proc.spawn()
+        if fd is not None:
+            match = re.search(r'7-Zip.*?(\d+)\.\d+', _decode_output(fd.read()))
+            fd.close()
+            proc.wait()
+            if match is not None and int(match.group(1)) >= 15:
+                _7z_progress_switches = ['-bb1']
+    return _7z_progress_switches
+
+
+def _is_solid_rar(path):
+    """Return True if the RAR archive at <path> is solid, as told by the
+    flags of its main archive header.
+    """
+    try:
+        with open(path, 'rb') as fd:
+            data = fd.read(64)
+    except IOError:
+        return False
+    if data.startswith(b'Rar!\x1a\x07\x00'):
+        # RAR 1.5 to 4: HEAD_CRC, HEAD_TYPE (0x73) and HEAD_FLAGS.
+        header = data[7:]
+        if len(header) >= 5 and header[2:3] == b'\x73':
+            return bool(struct.unpack('<H', header[3:5])[0] & 0x0008)
+    elif data.startswith(b'Rar!\x1a\x07\x01\x00'):
+        # RAR 5: CRC32, then variable length integers for the header size,
+        # type (1), flags, the optional extra area and data sizes, and
+        # finally the archive flags.
+        def read_vint(pos):
+            value = shift = 0
+            while pos < len(data):
+                byte = ord(data[pos:pos + 1])
+                value |= (byte & 0x7f) << shift
+                shift += 7
+                pos += 1
+                if not byte & 0x80:
+                    break
+            return value, pos
+
+        pos = read_vint(12)[1]
+        header_type, pos = read_vint(pos)
+        if header_type != 1:
+            return False
+        flags, pos = read_vint(pos)
+        if flags & 0x0001:
+            pos = read_vint(pos)[1]
+        if flags & 0x0002:
+            pos = read_vint(pos)[1]
+        return bool(read_vint(pos)[0] & 0x0004)
+    return False
+
+
 def _get_rar_exec():
     """Return the name of the RAR file extractor executable, or None if
     no such executable is found.
@@ -0,0 +1,286 @@
+# coding=utf-8
+"""archivecache.py - On-disk cache of information about archives (their
+tables of contents, the geometry of their pages and page thumbnails),
+stored next to the library database using sqlite.
+"""
+from __future__ import absolute_import
+
+import os
+import threading
+import time
+from sqlite3 import dbapi2
+
+from src import constants
+
+_db_path = os.path.join(constants.DATA_DIR, 'archive_cache.db')
+_con = None
+_lock = threading.Lock()
+# Page thumbnails are only kept for this many of the most recently used
+# archives, everything else for this many.
+_MAX_THUMBNAIL_ARCHIVES = 200
+_MAX_ARCHIVES = 5000
+# Seconds to wait for other processes writing to the cache, such as the
+# worker processes that add books to the library.
+_TIMEOUT = 30
+
+
+def get_page_info(path):
+    """Return a dictionary with the stored (width, height, orientation,
+    mime) tuples for the images in the archive at <path>, keyed on their
+    names in the archive. The dictionary is empty if nothing is stored or
+    the archive has changed since.
+    """
+    with _lock:
+        con = _get_connection()
+        if con is None:
+            return {}
+        try:
+            with con:
+                archive = _get_archive_id(con, path)
+            if archive is None:
+                return {}
+            cur = con.execute('''SELECT name, width, height, orientation, mime
+                FROM page WHERE archive = ?''', (archive,))
+            return dict((row[0], tuple(row[1:])) for row in cur)
+        except dbapi2.Error:
+            return {}
+
+
+def set_page_info(path, info):
+    """Store the dictionary <info> of (width, height, orientation, mime)
+    tuples for the images in the archive at <path>, as returned by
+    get_page_info().
+    """
+    with _lock:
+        con = _get_connection()
+        if con is None:
+            return
+        try:
+            with con:
+                archive = _get_archive_id(con, path, create=True)
+                if archive is None:
+                    return
+                con.executemany('''INSERT OR REPLACE INTO page
+                    (archive, name, width, height, orientation, mime)
+                    VALUES (?, ?, ?, ?, ?, ?)''',
+                                [(archive, name) + tuple(page_info)
+                                 for name, page_info in info.items()])
+        except dbapi2.Error:
+            print('! Could not store page info for {}'.format(path))
+
+
+def get_toc(path):
+    """Return the stored table of contents of the archive at <path>, as a
+    tuple (type, members, solid) where <type> is the archive type (as
+    defined in the archive module), <members> is a list of (name, offset,
+    size) tuples, in archive order, and <solid> tells if the archive is
+    solid (None if that is not known). Return None if nothing is stored
+    or the archive has changed since.
+    """
+    with _lock:
+        con = _get_connection()
+        if con is None:
+            return None
+        try:
+            with con:
+                archive = _get_archive_id(con, path)
+                if archive is None:
+                    return None
+                con.execute('UPDATE archive SET used = ? WHERE id = ?',
+                            (time.time(), archive))
+            row = con.execute('''SELECT type, solid FROM toc
+                WHERE archive = ?''', (archive,)).fetchone()
+            if row is None:
+                return None
+            archive_type, solid = row
+            if solid is not None:
+                solid = bool(solid)
+            cur = con.execute('''SELECT name, offset, size FROM member
+                WHERE archive = ? ORDER BY position''', (archive,))
+            return archive_type, [tuple(row) for row in cur], solid
+        except dbapi2.Error:
+            return None
+
+
+def set_toc(path, archive_type, members, solid=None):
+    """Store the table of contents of the archive at <path>, as returned
+    by get_toc(). Everything stored about the archives that were used
+    longest ago is removed.
+    """
+    with _lock:
+        con = _get_connection()
+        if con is None:
+            return
+        try:
+            with con:
+                archive = _get_archive_id(con, path, create=True)
+                if archive is None:
+                    return
+                con.execute('DELETE FROM member WHERE archive = ?', (archive,))
+                con.execute('''INSERT OR REPLACE INTO toc (archive, type, solid)
+                    VALUES (?, ?, ?)''', (archive, archive_type, solid))
+                con.executemany('''INSERT INTO member
+                    (archive, position, name, offset, size)
+                    VALUES (?, ?, ?, ?, ?)''',
+                                [(archive, position) + tuple(member)
+                                 for position, member in enumerate(members)])
+                old = [row[0] for row in con.execute('''SELECT id
+                    FROM archive ORDER BY used DESC LIMIT -1 OFFSET ?''',
+                                                     (_MAX_ARCHIVES,))]
+                for old_archive in old:
+                    _delete_archive(con, old_archive)
+        except dbapi2.Error:
+            print('! Could not store table of contents for {}'.format(path))
+
+
+def get_thumbnails(path, width, height):
+    """Return a dictionary with the stored page thumbnails, as PNG data,
+    for the images in the archive at <path>, keyed on their names in the
+    archive. Only thumbnails made to fit in <width>x<height> are included.
+    The dictionary is empty if nothing is stored or the archive has
+    changed since.
+    """
+    with _lock:
+        con = _get_connection()
+        if con is None:
+            return {}
+        try:
+            with con:
+                archive = _get_archive_id(con, path)
+                if archive is None:
+                    return {}
+                con.execute('''UPDATE thumb_use SET used = ?
+                    WHERE archive = ?''', (time.time(), archive))
+            cur = con.execute('''SELECT name, data FROM thumb
+                WHERE archive = ? AND width = ? AND height = ?''',
+                              (archive, width, height))
+            return dict((name, bytes(data)) for name, data in cur)
+        except dbapi2.Error:
+            return {}
+
+
+def set_thumbnails(path, width, height, thumbnails):
+    """Add the dictionary <thumbnails> of page thumbnails that fit in
+    <width>x<height>, for the archive at <path>, to the stored ones (see
+    get_thumbnails()). The thumbnails of the archives that were used
+    longest ago are removed.
+    """
+    with _lock:
+        con = _get_connection()
+        if con is None:
+            return
+        try:
+            with con:
+                archive = _get_archive_id(con, path, create=True)
+                if archive is None:
+                    return
+                con.executemany('''INSERT OR REPLACE INTO thumb
+                    (archive, name, width, height, data)
+                    VALUES (?, ?, ?, ?, ?)''',
+                                [(archive, name, width, height, dbapi2.Binary(data))
+                                 for name, data in thumbnails.items()])
+                con.execute('''INSERT OR REPLACE INTO thumb_use (archive, used)
+                    VALUES (?, ?)''', (archive, time.time()))
+                old = [row[0] for row in con.execute('''SELECT archive
+                    FROM thumb_use ORDER BY used DESC LIMIT -1 OFFSET ?''',
+                                                     (_MAX_THUMBNAIL_ARCHIVES,))]
+                for table in ('thumb', 'thumb_use'):
+                    con.executemany('DELETE FROM {} WHERE archive = ?'.format(table),
+                                    [(archive,) for archive in old])
+        except dbapi2.Error:
+            print('! Could not store page thumbnails for {}'.format(path))
+
+
+def _get_archive_id(con, path, create=False):
+    """Return the id of the archive at <path> in the database <con>, or
+    None if it is not there or has changed since it was stored. Changed
+    archives are removed. If <create> is True a missing archive is added
+    instead.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = (stat.st_size, stat.st_mtime, stat.st_ino)
+    path = os.path.abspath(path)
+    row = con.execute('''SELECT id, size, mtime, inode FROM archive
+        WHERE path = ?''', (path,)).fetchone()
+    if row is not None:
+        if tuple(row[1:]) == key:
+            return row[0]
+        _delete_archive(con, row[0])
+    if not create:
+        return None
+    return con.execute('''INSERT INTO archive (path, size, mtime, inode, used)
+        VALUES (?, ?, ?, ?, ?)''', (path,) + key + (time.time(),)).lastrowid
+
+
+def _delete_archive(con, archive):
+    """Remove everything stored about the archive with id <archive> from
+    the database <con>.
+    """
+    for table in ('page', 'toc', 'member', 'thumb', 'thumb_use'):
+        con.execute('DELETE FROM {} WHERE archive = ?'.format(table),
+                    (archive,))
+    con.execute('DELETE FROM archive WHERE id = ?', (archive,))
+
+
+def _get_connection():
+    """Return the connection to the cache database, opening (and
+    creating) it first if needed. Return None if it can not be opened.
+    """
+    global _con
+    if _con is None:
+        try:
+            con = dbapi2.connect(_db_path, timeout=_TIMEOUT,
+                                 check_same_thread=False)
+            con.text_factory = str
+            con.execute('PRAGMA journal_mode = WAL')
+            with con:
+                con.execute('''CREATE TABLE IF NOT EXISTS archive (
+                    id INTEGER PRIMARY KEY,
+                    path string UNIQUE,
+                    size INTEGER,
+                    mtime REAL,
+                    inode INTEGER,
+                    used REAL)''')
+                if 'used' not in [row[1] for row in
+                                  con.execute('PRAGMA table_info(archive)')]:
+                    con.execute('ALTER TABLE archive ADD COLUMN used REAL')
+                con.execute('''CREATE TABLE IF NOT EXISTS page (
+                    archive INTEGER NOT NULL,
+                    name string NOT NULL,
+                    width INTEGER,
+                    height INTEGER,
+                    orientation INTEGER,
+                    mime string,
+                    PRIMARY KEY (archive, name))''')
+                con.execute('''CREATE TABLE IF NOT EXISTS toc (
+                    archive INTEGER PRIMARY KEY,
+                    type INTEGER,
+                    solid INTEGER)''')
+                if 'solid' not in [row[1] for row in
+                                   con.execute('PRAGMA table_info(toc)')]:
+                    con.execute('ALTER TABLE toc ADD COLUMN solid INTEGER')
+                con.execute('''CREATE TABLE IF NOT EXISTS member (
+                    archive INTEGER NOT NULL,
+                    position INTEGER NOT NULL,
+                    name string,
+                    offset INTEGER,
+                    size INTEGER,
+                    PRIMARY KEY (archive, position))''')
+                con.execute('''CREATE TABLE IF NOT EXISTS thumb (
+                    archive INTEGER NOT NULL,
+                    name string NOT NULL,
+                    width INTEGER NOT NULL,
+                    height INTEGER NOT NULL,
+                    data BLOB,
+                    PRIMARY KEY (archive, name, width, height))''')
+                con.execute('''CREATE TABLE IF NOT EXISTS thumb_use (
+                    archive INTEGER PRIMARY KEY,
+                    used REAL)''')
+        except dbapi2.Error:
+            print('! Could not open {}'.format(_db_path))
+            return None
+        _con = con
+    return _con
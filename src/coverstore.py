@@ -0,0 +1,127 @@
+# coding=utf-8
+"""coverstore.py - On-disk store of the library covers as they are
+displayed (scaled to the cover size and framed), kept in a single sqlite
+database so that showing the library does not have to read, scale and
+frame a thumbnail file for every book.
+"""
+from __future__ import absolute_import
+
+import os
+import threading
+import time
+from sqlite3 import dbapi2
+
+from src import constants
+from src import image
+
+_db_path = os.path.join(constants.DATA_DIR, 'library_covers.db')
+_con = None
+_lock = threading.Lock()
+_MMAP_SIZE = 256 * 1024 * 1024
+# Covers are kept for this many of the most recently stored sizes of each
+# book, so that switching between cover sizes does not render them again.
+_MAX_SIZES = 3
+# Version of the database layout, as kept in PRAGMA user_version.
+_VERSION = 1
+
+
+def get_cover(book, path, size):
+    """Return a pixbuf with the stored cover of <book>, whose archive is
+    at <path>, rendered at <size>. Return None if no such cover is stored
+    or the archive has changed since.
+    """
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    with _lock:
+        con = _get_connection()
+        if con is None:
+            return None
+        try:
+            row = con.execute('''SELECT data FROM cover
+                WHERE book = ? AND path = ? AND size = ? AND mtime = ?''',
+                              (book, path, size, mtime)).fetchone()
+        except dbapi2.Error:
+            return None
+    if row is None:
+        return None
+    try:
+        return image.load_pixbuf_from_data(bytes(row[0]))
+    except Exception:
+        return None
+
+
+def set_cover(book, path, size, pixbuf):
+    """Store the cover <pixbuf> of <book>, whose archive is at <path>,
+    rendered at <size>. Only the covers of the _MAX_SIZES sizes stored
+    last are kept for each book.
+    """
+    try:
+        mtime = os.stat(path).st_mtime
+        success, data = pixbuf.save_to_bufferv('png', [], [])
+    except Exception:
+        return
+    if not success:
+        return
+    with _lock:
+        con = _get_connection()
+        if con is None:
+            return
+        try:
+            with con:
+                con.execute('''INSERT OR REPLACE INTO cover
+                    (book, size, path, mtime, stored, data)
+                    VALUES (?, ?, ?, ?, ?, ?)''', (book, size, path, mtime,
+                                                   time.time(), dbapi2.Binary(data)))
+                con.execute('''DELETE FROM cover WHERE book = ? AND size NOT IN
+                    (SELECT size FROM cover WHERE book = ?
+                     ORDER BY stored DESC LIMIT ?)''', (book, book, _MAX_SIZES))
+        except dbapi2.Error:
+            print('! Could not store the cover for {}'.format(path))
+
+
+def delete_covers(books):
+    """Remove the stored covers of all of <books>."""
+    with _lock:
+        con = _get_connection()
+        if con is None:
+            return
+        try:
+            with con:
+                con.executemany('DELETE FROM cover WHERE book = ?',
+                                [(book,) for book in books])
+        except dbapi2.Error:
+            print('! Could not remove covers from {}'.format(_db_path))
+
+
+def _get_connection():
+    """Return the connection to the cover database, opening (and
+    creating) it first if needed. Return None if it can not be opened.
+    """
+    global _con
+    if _con is None:
+        try:
+            con = dbapi2.connect(_db_path, check_same_thread=False)
+            con.execute('PRAGMA journal_mode = WAL')
+            # Read the covers straight from a memory map of the file.
+            con.execute('PRAGMA mmap_size = {:d}'.format(_MMAP_SIZE))
+            with con:
+                version = con.execute('PRAGMA user_version').fetchone()[0]
+                if version < _VERSION:
+                    # Only a cache, older layouts are simply dropped.
+                    con.execute('DROP TABLE IF EXISTS cover')
+                    con.execute('PRAGMA user_version = {:d}'.format(_VERSION))
+                con.execute('''CREATE TABLE IF NOT EXISTS cover (
+                    book INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    path string,
+                    mtime REAL,
+                    stored REAL,
+                    data BLOB,
+                    PRIMARY KEY (book, size))''')
+        except dbapi2.Error:
+            print('! Could not open {}'.format(_db_path))
+            return None
+        _con = con
+    return _con
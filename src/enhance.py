@@ -26,14 +26,24 @@ class ImageEnhancer(object):
         self.sharpness = 1.0
         self.autocontrast = False
 
-    def enhance(self, pixbuf):
-        """Return an "enhanced" version of <pixbuf>."""
-        if any([self.brightness != 1.0, self.contrast != 1.0, self.saturation != 1.0, self.sharpness != 1.0,
-                self.autocontrast]):
-            return image.enhance(pixbuf, self.brightness, self.contrast,
-                                 self.saturation, self.sharpness, self.autocontrast)
+    def enhance(self, pixbuf, values=None):
+        """Return an "enhanced" version of <pixbuf>. If <values> is given,
+        it is used instead of the current values, as returned by
+        get_values(), which makes this safe to use from other threads.
+        """
+        if values is None:
+            values = self.get_values()
+        if values != (1.0, 1.0, 1.0, 1.0, False):
+            return image.enhance(pixbuf, *values)
         return pixbuf
 
+    def get_values(self):
+        """Return the current enhancement values as a tuple, (brightness,
+        contrast, saturation, sharpness, autocontrast).
+        """
+        return (self.brightness, self.contrast, self.saturation,
+                self.sharpness, self.autocontrast)
+
     def signal_update(self):
         """Signal to the main window that a change in the enhancement
         values has been made.
@@ -158,6 +158,8 @@ class _ComicFileChooserDialog(Gtk.Dialog):
                 self._namelabel.set_text('')
                 self._sizelabel.set_text('')
             else:
+                # A stored thumbnail of a larger size may be returned.
+                pixbuf = image.fit_in_rectangle(pixbuf, 128, 128)
                 pixbuf = image.add_border(pixbuf, 1)
                 self._preview_image.set_from_pixbuf(pixbuf)
                 self._namelabel.set_text(encoding.to_unicode(os.path.basename(path)))
@@ -2,20 +2,21 @@
 """filehandler.py - File handler."""
 from __future__ import absolute_import, division
 
-import gc
 import os
 import re
 import shutil
-import sys
 import tempfile
 import threading
+from io import BytesIO
 
-from gi.repository import Gtk, GdkPixbuf
+from gi.repository import GObject, Gtk, GdkPixbuf
 
 from src import archive
+from src import archivecache
 from src import cursor
 from src import encoding
 from src import image
+from src import pixbufcache
 from src import thumbnail
 from src.image import get_supported_format_extensions_preg
 from src.preferences import prefs
@@ -27,6 +28,9 @@ try:
 except NameError:
     pass
 
+# The number of bytes read from archived images to find their size etc.
+_HEADER_SIZE = 65536
+
 
 class FileHandler(object):
     """The FileHandler keeps track of images, pages, caches and reads files.
@@ -37,7 +41,9 @@ class FileHandler(object):
     Other modules should *never* read directly from the files pointed to by
     paths given by the FileHandler's methods. The files are not even
     guaranteed to exist at all times since the extraction of archives is
-    threaded.
+    threaded, and images in most archives are decoded straight from the
+    archive without being extracted at all. Use extract_page() when a page
+    really has to be available on disk.
     """
 
     def __init__(self, window):
@@ -50,8 +56,23 @@ class FileHandler(object):
         self._image_files = []
         self._current_image_index = 0
         self._comment_files = []
-        self._raw_pixbufs = {}
+        self._raw_pixbufs = pixbufcache.PixbufCache()
+        self._wanted_pixbufs = set()
+        self._file_generation = 0
+        self._preload_wanted = []
+        self._preload_settings = None
+        self._preload_generation = 0
+        self._preload_stop = False
+        self._preload_thread = None
+        self._preload_condition = threading.Condition()
         self._name_table = {}
+        self._page_info = {}
+        self._page_info_changed = False
+        # Page thumbnails of the current archive as PNG data, per archive
+        # and size (see decode_thumbnail()), and those not stored yet.
+        self._thumbnails = {}
+        self._new_thumbnails = {}
+        self._thumbnail_lock = threading.Lock()
         self._extractor = archive.Extractor()
         self._condition = None
 
@@ -63,31 +84,65 @@ class FileHandler(object):
         """Return the pixbuf indexed by <index> from cache.
         Pixbufs not found in cache are fetched from disk first.
         """
-        if index not in self._raw_pixbufs:
-            self._wait_on_page(index + 1)
-            pxb_err = False
-            try:
-                """ Check for gif in the name of the file.  If it is a gif,
-                and the user wishes GIFs to be animated, load it as a
-                PixbufAnimation and make sure that it actually is animated. 
-                If it isn't animated, load a pixbuf instead.  """
-                if not (prefs['animate gifs'] or prefs['animate']) \
-                        or "gif" not in self._image_files[index][-3:].lower():
-                    self._raw_pixbufs[index] = GdkPixbuf.Pixbuf.new_from_file(self._image_files[index])
-                else:
-                    self._raw_pixbufs[index] = GdkPixbuf.PixbufAnimation(self._image_files[index])
-                    if self._raw_pixbufs[index].is_static_image():
-                        self._raw_pixbufs[index] = self._raw_pixbufs[index].get_static_image()
-            except Exception:
-                pxb_err = True
+        if index in self._raw_pixbufs:
+            return self._raw_pixbufs[index]
+        self._wait_on_page(index + 1)
+        pixbuf = self._decode_pixbuf(index)
+        if pixbuf is None:
+            pixbuf = self._get_missing_image()
+        self._raw_pixbufs[index] = pixbuf
+        return pixbuf
+
+    def _decode_pixbuf(self, index):
+        """Return a new pixbuf decoded from the (extracted) image file
+        indexed by <index>, or None if it could not be decoded. This does
+        not touch the cache and is safe to call from any thread.
+        """
+        try:
+            path = self._image_files[index]
+        except IndexError:
+            return None
+        data = self._read_direct(path)
+        try:
+            """ Check for gif in the name of the file.  If it is a gif,
+            and the user wishes GIFs to be animated, load it as a
+            PixbufAnimation and make sure that it actually is animated. 
+            If it isn't animated, load a pixbuf instead.  """
+            animate = (prefs['animate gifs'] or prefs['animate']) and \
+                "gif" in path[-3:].lower()
+            if data is not None:
+                return image.load_pixbuf_from_data(data, animated=animate)
+            elif not animate:
+                return GdkPixbuf.Pixbuf.new_from_file(path)
+            pixbuf = GdkPixbuf.PixbufAnimation(path)
+            if pixbuf.is_static_image():
+                pixbuf = pixbuf.get_static_image()
+            return pixbuf
+        except Exception:
+            pass
+        try:
+            if data is not None:
+                im = image.Image.open(BytesIO(data))
+            else:
+                im = image.Image.open(path)
+            return image.pil_to_pixbuf(im)
+        except Exception:
+            return None
 
-            if pxb_err:
-                try:
-                    im = image.Image.open(self._image_files[index])
-                    self._raw_pixbufs[index] = image.pil_to_pixbuf(im)
-                except Exception:
-                    self._raw_pixbufs[index] = self._get_missing_image()
-        return self._raw_pixbufs[index]
+    def _read_direct(self, path, size=None):
+        """Return the contents of the archived file <path>, or at most the
+        first <size> bytes of it, if it is read directly from the archive
+        rather than extracted, otherwise None.
+        """
+        if self.archive_type is None:
+            return None
+        name = self._name_table.get(path)
+        if name is None or not self._extractor.is_direct(name):
+            return None
+        try:
+            return self._extractor.read_file(name, size)
+        except Exception:
+            return b''
 
     def get_pixbufs(self, single=False):
         """Return the pixbuf(s) for the image(s) that should be currently
@@ -104,8 +159,14 @@ class FileHandler(object):
         """Make sure that the correct pixbufs are stored in cache. These
         are (in the current implementation) the current image(s), and
         if cacheing is enabled, also the one or two pixbufs before and
-        after them. All other pixbufs are deleted and garbage collected
-        directly in order to save memory.
+        after them. Other pixbufs are kept as long as the cache is within
+        the 'cache size' limit, the least recently used ones are dropped
+        first. Without cacheing only the wanted pixbufs are kept.
+
+        Pixbufs not yet in cache are decoded in a background thread and
+        put there once they are ready, so that the GUI is not blocked
+        meanwhile. In single page mode they are also scaled for display
+        there, so that flipping to them only takes a cache lookup.
         """
         # Get list of wanted pixbufs.
         first_wanted = self._current_image_index
@@ -118,18 +179,140 @@ class FileHandler(object):
         first_wanted = max(0, first_wanted)
         last_wanted = min(self.get_number_of_pages(), last_wanted)
         wanted_pixbufs = range(first_wanted, last_wanted)
+        self._wanted_pixbufs = set(wanted_pixbufs)
 
         # Remove old pixbufs.
-        for page in set(self._raw_pixbufs) - set(wanted_pixbufs):
-            del self._raw_pixbufs[page]
-        if sys.version_info[:3] >= (2, 5, 0):
-            gc.collect(0)
+        self._raw_pixbufs.pin(wanted_pixbufs)
+        if prefs['cache']:
+            self._raw_pixbufs.set_limit(
+                pixbufcache.get_limits(prefs['cache size'])[0])
         else:
-            gc.collect()
+            self._raw_pixbufs.set_limit(0)
+
+        # Decode (and scale) the pixbufs not already cached in the
+        # background, the ones closest to the current page(s) first,
+        # forwards before backwards.
+        settings = None
+        if prefs['cache'] and not self._window.is_double_page:
+            settings = self._window.get_scale_settings()
+        current = self._current_image_index
+        jobs = []
+        for wanted in sorted(wanted_pixbufs,
+                             key=lambda i: (i < current, abs(i - current))):
+            if wanted not in self._raw_pixbufs:
+                jobs.append((wanted, None))
+            elif settings is not None:
+                pixbuf = self._raw_pixbufs[wanted]
+                if not isinstance(pixbuf, GdkPixbuf.PixbufAnimation) and \
+                        not self._window.has_scaled_pixbuf(self._window.get_scaled_key(
+                            self._image_files[wanted], pixbuf, settings)):
+                    jobs.append((wanted, pixbuf))
+        self._preload(jobs, settings)
+
+    def _preload(self, jobs, settings=None):
+        """Replace the list of pixbufs to be handled in the background with
+        <jobs>, in that order. A job is an (index, pixbuf) tuple where the
+        pixbuf is None if it should be decoded first. If <settings> (the
+        _ScaleSettings of the main window) is given, the pixbufs are also
+        scaled for display.
+        """
+        with self._preload_condition:
+            self._preload_wanted = list(jobs)
+            self._preload_settings = settings
+            self._preload_generation += 1
+            self._preload_condition.notify()
+        self.notify_page_waiters()
+        if self._preload_thread is None and jobs:
+            self._preload_thread = threading.Thread(target=self._thread_preload)
+            self._preload_thread.setDaemon(True)
+            self._preload_thread.start()
+
+    def _stop_preload(self):
+        """Empty the preload list and block until the preloading thread,
+        if any, has terminated.
+        """
+        with self._preload_condition:
+            self._preload_wanted = []
+            self._preload_generation += 1
+            self._preload_stop = True
+            self._preload_condition.notify()
+        self.notify_page_waiters()
+        if self._preload_thread is not None:
+            self._preload_thread.join()
+            self._preload_thread = None
+        self._preload_stop = False
+
+    def notify_page_waiters(self):
+        """Wake up the threads blocked in wait_on_pages(), so that they
+        can check if what they are waiting for has changed.
+        """
+        if self._condition is not None:
+            with self._condition:
+                self._condition.notify_all()
+
+    def close_thread_handle(self):
+        """Close what the calling thread has opened to read pages from the
+        archive. Background threads should call this before they exit.
+        """
+        self._extractor.close_thread_handle()
 
-        # Cache new pixbufs if they are not already cached.
-        for wanted in wanted_pixbufs:
-            self._get_pixbuf(wanted)
+    def _thread_preload(self):
+        """Decode (and scale) the pixbufs in the preload list and pass them
+        on to the main thread, until _stop_preload() is called. Pixbufs for
+        files that are already extracted are handled first, if there are
+        none the thread waits on the extractor.
+        """
+        while True:
+            with self._preload_condition:
+                while not self._preload_wanted and not self._preload_stop:
+                    self._preload_condition.wait()
+                if self._preload_stop:
+                    return
+                settings = self._preload_settings
+                generation = self._preload_generation
+                file_generation = self._file_generation
+                pages = [index + 1 for index, pixbuf in self._preload_wanted
+                         if pixbuf is None]
+                for i, job in enumerate(self._preload_wanted):
+                    if job[1] is not None or self.is_page_ready(job[0] + 1):
+                        del self._preload_wanted[i]
+                        break
+                else:
+                    job = None
+            if job is None:
+                self.wait_on_pages(pages, lambda: not self._preload_stop and
+                                   generation == self._preload_generation)
+                continue
+            index, pixbuf = job
+            if pixbuf is None:
+                pixbuf = self._decode_pixbuf(index)
+            key = scaled = None
+            if settings is not None and pixbuf is not None and \
+                    not isinstance(pixbuf, GdkPixbuf.PixbufAnimation):
+                try:
+                    key = self._window.get_scaled_key(self._image_files[index],
+                                                      pixbuf, settings)
+                    scaled = self._window.scale_pixbuf(pixbuf, key)
+                except Exception:
+                    key = scaled = None
+            GObject.idle_add(self._add_preloaded_pixbuf, index, pixbuf,
+                             file_generation, key, scaled)
+
+    def _add_preloaded_pixbuf(self, index, pixbuf, file_generation,
+                              key=None, scaled=None):
+        """Put the <pixbuf> indexed by <index>, decoded in the background,
+        in the cache if it is still wanted there, and <scaled> in the main
+        window's cache of scaled pixbufs under <key>.
+        """
+        if file_generation == self._file_generation and \
+                index in self._wanted_pixbufs:
+            if index not in self._raw_pixbufs:
+                if pixbuf is None:
+                    pixbuf = self._get_missing_image()
+                self._raw_pixbufs[index] = pixbuf
+            if scaled is not None:
+                self._window.add_scaled_pixbuf(key, scaled)
+        return False
 
     def next_page(self):
         """Set up filehandler to the next page. Return True if this results
@@ -172,6 +355,7 @@ class FileHandler(object):
             return False
         old_page = self.get_current_page()
         self._current_image_index = 0
+        self._prioritize_current_pages()
         return old_page != self.get_current_page()
 
     def last_page(self):
@@ -186,6 +370,7 @@ class FileHandler(object):
         self._current_image_index = self.get_number_of_pages() - offset
         if offset == 2 and self.get_virtual_double_page():
             self._current_image_index += 1
+        self._prioritize_current_pages()
         return old_page != self.get_current_page()
 
     def set_page(self, page_num):
@@ -196,6 +381,7 @@ class FileHandler(object):
             return False
         old_page = self.get_current_page()
         self._current_image_index = page_num - 1
+        self._prioritize_current_pages()
         return old_page != self.get_current_page()
 
     def get_virtual_double_page(self):
@@ -208,12 +394,10 @@ class FileHandler(object):
             'no double page for wide images'] or self.get_current_page() == self.get_number_of_pages():
             return False
 
-        page1 = self._get_pixbuf(self._current_image_index)
-        if page1.get_width() > page1.get_height():
-            return True
-        page2 = self._get_pixbuf(self._current_image_index + 1)
-        if page2.get_width() > page2.get_height():
-            return True
+        for page in (self.get_current_page(), self.get_current_page() + 1):
+            width, height = self.get_size(page)
+            if width > height:
+                return True
         return False
 
     def open_file(self, path, start_page=1):
@@ -260,6 +444,7 @@ class FileHandler(object):
         if self.archive_type is not None:
             self._base_path = path
             self._condition = self._extractor.setup(path, self._tmp_dir)
+            self._page_info = archivecache.get_page_info(path)
             files = self._extractor.get_files()
             image_files = [f for f in files if self._image_re.search(f)]
             alphanumeric_sort(image_files)
@@ -279,10 +464,19 @@ class FileHandler(object):
 
             self._redo_priority_ordering(start_page, image_files)
 
+            # Images are decoded straight from the archive when possible,
+            # so only comments and possible subarchives hit the disk.
+            if self._extractor.can_read_directly():
+                self._extractor.set_files(comment_files + unknown_files)
+                self._extractor.set_direct_read(image_files)
+            else:
+                self._extractor.set_files(image_files + comment_files +
+                                          unknown_files)
             self._extractor.extract()
         else:
             # If <path> is an image we scan its directory for more (or for
             # any at all if <path> is directory).
+            self._page_info = {}
             self._base_path = dir_path if dir_path else os.path.dirname(path)
             # Not necessary to sort *all* of it, but whatever.
             for f in list_dir_sorted(self._base_path):
@@ -306,6 +500,9 @@ class FileHandler(object):
                     has_subarchive = True
             # Allows to avoid any behaviour changes if there was no subarchive..
             if has_subarchive:
+                # Directly read images must be put on disk before moving.
+                for page in range(1, self.get_number_of_pages() + 1):
+                    self.extract_page(page)
                 # Now, get all files, and move them into the temp directory
                 # while renaming them to avoid any sorting error.
                 self._image_files = []
@@ -340,6 +537,35 @@ class FileHandler(object):
         self._window.new_page()
         self._window.ui_manager.recent.add(path)
 
+    def _get_priority_indices(self):
+        """Return the indices of the images that are most likely to be
+        needed soon, i.e. the current image(s) and their closest
+        neighbours, with the most urgent first.
+        """
+        depth = self._window.is_double_page and 2 or 1
+        priority_ordering = (
+            list(range(self._current_image_index,
+                  self._current_image_index + depth * 2)) +
+            list(range(self._current_image_index - depth,
+                  self._current_image_index))[::-1])
+        return [p for p in priority_ordering
+                if 0 <= p <= self.get_number_of_pages() - 1]
+
+    def _prioritize_current_pages(self):
+        """Make the extractor extract the current image(s) and their
+        closest neighbours before anything else, e.g. after a jump to some
+        page far away in the archive.
+        """
+        if self.archive_type is None or not self.file_loaded:
+            return
+        # Directly read pages are decoded by the preloading and thumbnail
+        # threads, each reading the archive through a handle of its own.
+        names = [self._name_table[self._image_files[p]]
+                 for p in self._get_priority_indices()]
+        names = [name for name in names if not self._extractor.is_direct(name)]
+        if names:
+            self._extractor.prioritize(names)
+
     def _redo_priority_ordering(self, start_page, lst):
         if start_page <= 0:
             if self._window.is_double_page:
@@ -350,14 +576,7 @@ class FileHandler(object):
             self._current_image_index = start_page - 1
         self._current_image_index = max(0, self._current_image_index)
 
-        depth = self._window.is_double_page and 2 or 1
-        priority_ordering = (
-            list(range(self._current_image_index,
-                  self._current_image_index + depth * 2)) +
-            list(range(self._current_image_index - depth,
-                  self._current_image_index))[::-1])
-        priority_ordering = [lst[p] for p in priority_ordering
-                             if 0 <= p <= self.get_number_of_pages() - 1]
+        priority_ordering = [lst[p] for p in self._get_priority_indices()]
         for i, name in enumerate(priority_ordering):
             lst.remove(name)
             lst.insert(i, name)
@@ -382,22 +601,33 @@ class FileHandler(object):
 
     def close_file(self, *args):
         """Run tasks for "closing" the currently opened file(s)."""
+        # Bumped first, so that background threads can tell when the
+        # state they have read is about to go away, see _get_file_state().
+        self._file_generation += 1
         self.file_loaded = False
+        base_path = self._base_path
         self._base_path = None
+        self._store_page_info(base_path)
+        self._page_info = {}
+        self._store_thumbnails()
         self._image_files = []
         self._current_image_index = 0
         self._comment_files = []
-        self._name_table.clear()
+        self._name_table = {}
         self._raw_pixbufs.clear()
+        self._wanted_pixbufs = set()
+        self._stop_preload()
         self._window.clear()
         self._window.ui_manager.set_sensitivities()
         self._extractor.stop()
         thread_delete(self._tmp_dir)
         self._tmp_dir = tempfile.mkdtemp(prefix='comix.', suffix=os.sep)
-        gc.collect()
 
     def cleanup(self):
         """Run clean-up tasks. Should be called prior to exit."""
+        self._store_page_info(self._base_path)
+        self._store_thumbnails()
+        self._stop_preload()
         self._extractor.stop()
         thread_delete(self._tmp_dir)
 
@@ -452,6 +682,22 @@ class FileHandler(object):
             return self._image_files[self._current_image_index]
         return self._image_files[page - 1]
 
+    def extract_page(self, page=None):
+        """Make sure that the image file for <page>, or the current page if
+        <page> is None, exists on disk and return the full path to it.
+
+        Images in archives are normally decoded without ever being written
+        to disk, so this should be used by anything that actually needs to
+        access the file through its path (e.g. for copying it).
+        """
+        self._wait_on_page(page)
+        path = self.get_path_to_page(page)
+        if self.archive_type is not None:
+            name = self._name_table[path]
+            if self._extractor.is_direct(name):
+                self._extractor.extract_file(name)
+        return path
+
     def get_path_to_base(self):
         """Return the full path to the current base (path to archive or
         image directory.)
@@ -499,66 +745,207 @@ class FileHandler(object):
         return encoding.to_unicode(name)
 
     def get_size(self, page=None):
-        """Return a tuple (width, height) with the size of <page>. If <page>
-        is None, return the size of the current page.
+        """Return a tuple (width, height) with the size of <page>, as it is
+        displayed when its EXIF orientation is followed (if the preference
+        for that is set). If <page> is None, return the size of the current
+        page.
         """
-        self._wait_on_page(page)
-        info = GdkPixbuf.Pixbuf.get_file_info(self.get_path_to_page(page))
-        if info is not None:
-            return info[1], info[2]
-        return 0, 0
+        info = self._get_page_info(page)
+        if info is None:
+            return 0, 0
+        width, height, orientation = info[:3]
+        if prefs['auto rotate from exif'] and \
+                image.get_orientation_rotation(orientation) in (90, 270):
+            return height, width
+        return width, height
 
     def get_mime_name(self, page=None):
         """Return a string with the name of the mime type of <page>. If
         <page> is None, return the mime type name of the current page.
         """
-        self._wait_on_page(page)
-        info = GdkPixbuf.Pixbuf.get_file_info(self.get_path_to_page(page))
+        info = self._get_page_info(page)
         if info is not None:
-            return info[0]['name'].upper()
+            return info[3].upper()
         return _('Unknown filetype')
 
+    def _get_page_info(self, page=None):
+        """Return a tuple (width, height, orientation, mime) for the image
+        file of <page>, or the current page if <page> is None, or None if
+        the file is not a recognized image. Only the image header is read,
+        and the result is kept in the page index, which is stored in the
+        archive cache for archives.
+        """
+        path = self.get_path_to_page(page)
+        name = self._name_table.get(path, path)
+        if name not in self._page_info:
+            self._wait_on_page(page)
+            data = self._read_direct(path, _HEADER_SIZE)
+            if data is None:
+                info = image.get_header_info(path)
+            else:
+                info = image.get_header_info(BytesIO(data))
+                if info is None and len(data) == _HEADER_SIZE:
+                    # Huge metadata before the actual image header.
+                    info = image.get_header_info(BytesIO(self._read_direct(path)))
+            self._page_info[name] = info
+            if info is not None:
+                self._page_info_changed = True
+        return self._page_info[name]
+
+    def _store_page_info(self, base_path):
+        """Store the page index of the archive at <base_path> in the
+        archive cache, if anything was added to it.
+        """
+        if self.archive_type is not None and base_path is not None and \
+                self._page_info_changed:
+            archivecache.set_page_info(base_path, dict(
+                (name, info) for name, info in self._page_info.items()
+                if info is not None))
+        self._page_info_changed = False
+
+    def _get_stored_thumbnail(self, base_path, name, width, height):
+        """Return the PNG data of the stored thumbnail of the file <name>
+        in the archive at <base_path> that fits in <width>x<height>, or
+        None if there is none. The stored thumbnails of the archive are
+        read on first use.
+        """
+        key = (base_path, width, height)
+        with self._thumbnail_lock:
+            if key not in self._thumbnails:
+                self._thumbnails[key] = archivecache.get_thumbnails(
+                        base_path, width, height)
+            return self._thumbnails[key].get(name)
+
+    def _add_stored_thumbnail(self, generation, base_path, name, width,
+                              height, thumb):
+        """Keep the <thumb> pixbuf of the file <name> in the archive at
+        <base_path> to be stored when the archive is closed, unless it has
+        been closed since the file generation <generation>.
+        """
+        try:
+            success, data = thumb.save_to_bufferv('png', [], [])
+        except Exception:
+            return
+        if not success:
+            return
+        key = (base_path, width, height)
+        with self._thumbnail_lock:
+            if generation != self._file_generation:
+                return
+            self._thumbnails.setdefault(key, {})[name] = data
+            self._new_thumbnails.setdefault(key, {})[name] = data
+
+    def _store_thumbnails(self):
+        """Store the page thumbnails that have been made since the last
+        call in the archive cache.
+        """
+        with self._thumbnail_lock:
+            new_thumbnails = self._new_thumbnails
+            self._thumbnails = {}
+            self._new_thumbnails = {}
+        for (base_path, width, height), thumbnails in new_thumbnails.items():
+            archivecache.set_thumbnails(base_path, width, height, thumbnails)
+
     def get_thumbnail(self, page=None, width=128, height=128, create=False):
         """Return a thumbnail pixbuf of <page> that fit in a box with
         dimensions <width>x<height>. Return a thumbnail for the current
         page if <page> is None.
 
-        If <create> is True, and <width>x<height> <= 128x128, the
+        If <create> is True, and <width>x<height> <= 256x256, the
         thumbnail is also stored on disk.
         """
         self._wait_on_page(page)
-        path = self.get_path_to_page(page)
-        if width <= 128 and height <= 128:
-            thumb = thumbnail.get_thumbnail(path, create)
-        else:
+        thumb = self.decode_thumbnail(page, width, height, create)
+        if thumb is None:
+            thumb = image.fit_in_rectangle(self._get_missing_image(), width, height)
+        return thumb
+
+    def decode_thumbnail(self, page=None, width=128, height=128, create=False):
+        """Return a thumbnail pixbuf of <page> like get_thumbnail(), or
+        None if the page can not be decoded. This does not wait for the
+        page to be extracted (see is_page_ready()) and is safe to call from
+        any thread.
+        """
+        state = self._get_file_state()
+        if state is None:
+            return None
+        generation, base_path, image_files, name_table, index = state
+        try:
+            path = image_files[index if page is None else page - 1]
+        except IndexError:
+            return None
+        name = name_table.get(path)
+        if name is not None:
+            data = self._get_stored_thumbnail(base_path, name, width, height)
+            if data is not None:
+                try:
+                    return image.load_pixbuf_from_data(data)
+                except Exception:
+                    pass
+        data = self._read_direct(path)
+        if data is not None:
             try:
-                if "gif" not in path[-3:].lower():
-                    thumb = GdkPixbuf.Pixbuf.new_from_file_at_size(path, width, height)
-                else:
-                    thumb = GdkPixbuf.PixbufAnimation(path).get_static_image()
-                    src_width = thumb.get_width()
-                    src_height = thumb.get_height()
-                    if float(src_width) / width > float(src_height) / height:
-                        thumb = thumb.scale_simple(width,
-                                                   int(max(src_height * width / src_width, 1)), GdkPixbuf.InterpType.TILES)
-                    else:
-                        thumb = thumb.scale_simple(int(max(src_width * height / src_height, 1)),
-                                                   height, GdkPixbuf.InterpType.TILES)
+                thumb = image.load_thumbnail(BytesIO(data), width, height)
+            except Exception:
+                try:
+                    thumb = image.load_pixbuf_from_data(data, width, height)
+                except Exception:
+                    thumb = None
+        elif width <= 256 and height <= 256:
+            try:
+                thumb = thumbnail.get_thumbnail(path, create, size=max(width, height))
             except Exception:
                 thumb = None
+        else:
+            try:
+                thumb = image.load_thumbnail(path, width, height)
+            except Exception:
+                # Formats that only GdkPixbuf can read.
+                try:
+                    if "gif" not in path[-3:].lower():
+                        thumb = GdkPixbuf.Pixbuf.new_from_file_at_size(path, width, height)
+                    else:
+                        thumb = GdkPixbuf.PixbufAnimation(path).get_static_image()
+                        src_width = thumb.get_width()
+                        src_height = thumb.get_height()
+                        if float(src_width) / width > float(src_height) / height:
+                            thumb = thumb.scale_simple(width,
+                                                       int(max(src_height * width / src_width, 1)), GdkPixbuf.InterpType.TILES)
+                        else:
+                            thumb = thumb.scale_simple(int(max(src_width * height / src_height, 1)),
+                                                       height, GdkPixbuf.InterpType.TILES)
+                except Exception:
+                    thumb = None
         if thumb is None:
-            thumb = self._get_missing_image()
+            return None
         thumb = image.fit_in_rectangle(thumb, width, height)
+        if name is not None:
+            self._add_stored_thumbnail(generation, base_path, name, width,
+                                       height, thumb)
         return thumb
 
+    def _get_file_state(self):
+        """Return a tuple (generation, base_path, image_files, name_table,
+        current_index) for the opened file, all read from the same opening
+        of it, or None if no file is opened. Safe to call from any thread.
+        """
+        generation = self._file_generation
+        base_path = self._base_path
+        if not self.file_loaded or base_path is None:
+            return None
+        state = (generation, base_path, self._image_files,
+                 self._name_table, self._current_image_index)
+        if generation != self._file_generation:
+            return None
+        return state
+
     def get_stats(self, page=None):
         """Return a stat object, as used by the stat module, for <page>.
         If <page> is None, return a stat object for the current page.
         Return None if the stat object can not be produced (e.g. broken file).
         """
-        self._wait_on_page(page)
         try:
-            stats = os.stat(self.get_path_to_page(page))
+            stats = os.stat(self.extract_page(page))
         except Exception:
             stats = None
         return stats
@@ -614,6 +1001,36 @@ class FileHandler(object):
         return self._window.render_icon(Gtk.STOCK_MISSING_IMAGE,
                                         Gtk.IconSize.DIALOG)
 
+    def is_page_ready(self, page):
+        """Return True if the file corresponding to image <page> can be
+        read without waiting for the extractor.
+        """
+        if self.archive_type is None:
+            return True
+        try:
+            name = self._name_table[self.get_path_to_page(page)]
+        except (IndexError, KeyError):
+            return False
+        return self._extractor.is_ready(name)
+
+    def wait_on_pages(self, pages, waiting=None):
+        """Block the calling thread until the file corresponding to one of
+        the image <pages> has been extracted, the extractor is stopped, or
+        the callable <waiting> returns False. Return True if one of the
+        pages is ready. Unlike _wait_on_page() this is meant for the
+        background threads, see notify_page_waiters().
+        """
+        if self._condition is None:
+            return any(self.is_page_ready(page) for page in pages)
+        with self._condition:
+            while True:
+                if any(self.is_page_ready(page) for page in pages):
+                    return True
+                if self._extractor.is_stopped() or \
+                        (waiting is not None and not waiting()):
+                    return False
+                self._condition.wait()
+
     def _wait_on_page(self, page):
         """Block the running (main) thread until the file corresponding to
         image <page> has been fully extracted.
@@ -636,6 +1053,8 @@ class FileHandler(object):
         if self.archive_type is None:
             return
         name = self._name_table[path]
+        if not self._extractor.is_ready(name):
+            self._extractor.prioritize([name])
         self._condition.acquire()
         while not self._extractor.is_ready(name):
             self._condition.wait()
@@ -40,6 +40,133 @@ def get_supported_format_extensions_preg():
     return formats
 
 
+def load_pixbuf_from_data(data, width=-1, height=-1, animated=False):
+    """Return a pixbuf decoded from <data>, the contents of an image file.
+
+    If <width> and <height> are given the image is scaled while decoding,
+    preserving the aspect ratio, so that it fits in a rectangle of that
+    size. If <animated> is True and <data> holds a real animation, a
+    PixbufAnimation is returned instead.
+    """
+
+    def _size_prepared(loader, src_width, src_height):
+        if width > 0 and height > 0 and \
+                (src_width > width or src_height > height):
+            if float(src_width) / width > float(src_height) / height:
+                loader.set_size(width, int(max(src_height * width / src_width, 1)))
+            else:
+                loader.set_size(int(max(src_width * height / src_height, 1)), height)
+
+    if isinstance(data, memoryview):
+        # PyGObject only takes bytes for the loader's buffer.
+        data = data.tobytes()
+    loader = GdkPixbuf.PixbufLoader()
+    loader.connect('size-prepared', _size_prepared)
+    try:
+        loader.write(data)
+    finally:
+        loader.close()
+    if animated:
+        animation = loader.get_animation()
+        if animation is not None and not animation.is_static_image():
+            return animation
+    pixbuf = loader.get_pixbuf()
+    if pixbuf is None:
+        raise ValueError('Could not decode image data')
+    return pixbuf
+
+
+def load_thumbnail(source, width, height):
+    """Return a pixbuf of the image in <source>, a path or a file object,
+    scaled down (never up) to fit in a rectangle of <width>x<height>.
+
+    Large images are never decoded at their full size: JPEG images are
+    decoded at 1/2, 1/4 or 1/8 of their size by the DCT scaling of libjpeg,
+    and other formats are reduced while loading where PIL supports it
+    before the final resampling. Raise an exception if PIL can not read
+    the image.
+    """
+    im = Image.open(source)
+    # Only a hint, the decoded size stays at least <width>x<height>.
+    im.draft('RGB', (width, height))
+    im.thumbnail((width, height))
+    if im.mode in ('LA', 'PA') or \
+            (im.mode in ('L', 'P', 'RGB') and 'transparency' in im.info):
+        im = im.convert('RGBA')
+    return pil_to_pixbuf(im)
+
+
+def get_header_info(source):
+    """Return a tuple (width, height, orientation, mime) for the image in
+    <source>, a path or a file object, where <orientation> is the EXIF
+    orientation (1 if there is none) and <mime> is the format name. Only
+    the image header is read, the image data is never decoded. Return
+    None if the format is not recognized.
+    """
+    try:
+        im = Image.open(source)
+        width, height = im.size
+        mime = im.format
+    except Exception:
+        return _get_pixbuf_header_info(source)
+    return width, height, _get_header_orientation(im), mime
+
+
+def _get_header_orientation(im):
+    """Return the EXIF orientation of the PIL image <im>, or 1 if there is
+    none. Only EXIF data that is part of the header is used (as in JPEG,
+    WebP and TIFF images), Image.getexif() would decode the whole image
+    for some formats, such as PNG.
+    """
+    try:
+        exif = im.info.get('exif')
+        if exif:
+            tags = Image.Exif()
+            tags.load(exif)
+            return int(tags.get(0x0112, 1))
+        tags = getattr(im, 'tag_v2', None)
+        if tags is not None:
+            return int(tags.get(0x0112, 1))
+    except Exception:
+        pass
+    return 1
+
+
+def _get_pixbuf_header_info(source):
+    """Return the header info, as get_header_info() does, of images that
+    only GdkPixbuf can read. The orientation is always 1.
+    """
+    if not hasattr(source, 'read'):
+        info = GdkPixbuf.Pixbuf.get_file_info(source)
+        if info is None or info[0] is None:
+            return None
+        return info[1], info[2], 1, info[0].get_name()
+    size = []
+
+    def _size_prepared(loader, width, height):
+        size.extend((width, height))
+
+    loader = GdkPixbuf.PixbufLoader()
+    loader.connect('size-prepared', _size_prepared)
+    try:
+        source.seek(0)
+        while not size:
+            data = source.read(4096)
+            if not data:
+                break
+            loader.write(data)
+    except Exception:
+        pass
+    image_format = loader.get_format()
+    try:
+        loader.close()
+    except Exception:
+        pass  # Only a partial image was written.
+    if image_format is None or not size:
+        return None
+    return size[0], size[1], 1, image_format.get_name()
+
+
 def fit_in_rectangle(src, width, height, scale_up=False, rotation=0,
                      animated=False):
     """Scale (and return) a pixbuf so that it fits in a rectangle with
@@ -223,6 +350,11 @@ def get_most_common_edge_colour(pixbuf):
 def pil_to_pixbuf(image):
     """Return a pixbuf created from the PIL <image>."""
     IS_RGBA = image.mode == 'RGBA'
+    if image.mode.startswith('I;16'):
+        image = image.convert('I')
+    if image.mode == 'I':
+        # 16 bit greyscale, which convert() would clip to white.
+        image = image.point(lambda v: v / 256).convert('L')
     if image.mode not in ('RGB', 'RGBA'):
         image = image.convert('RGB')
     try:
@@ -278,7 +410,14 @@ def get_implied_rotation(pixbuf):
     """
     if isinstance(pixbuf, GdkPixbuf.PixbufAnimation):
         pixbuf = pixbuf.get_static_image()
-    orientation = pixbuf.get_option('orientation')
+    return get_orientation_rotation(pixbuf.get_option('orientation'))
+
+
+def get_orientation_rotation(orientation):
+    """Return the rotation (in degrees) implied by the EXIF <orientation>,
+    given as a number or a string, see get_implied_rotation().
+    """
+    orientation = str(orientation)
     if orientation == '3':
         return 180
     elif orientation == '6':
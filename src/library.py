@@ -4,6 +4,7 @@ from __future__ import absolute_import, division
 
 import gc
 import os
+import threading
 
 try:
     from urllib import url2pathname  # Py2
@@ -21,6 +22,7 @@ from gi.repository import Gtk
 from gi.repository import Pango
 
 from src import archive
+from src import coverstore
 from src import encoding
 from src import filechooser
 from src import image
@@ -33,6 +35,8 @@ _dialog = None
 # but is represented by this ID in the library's TreeModels.
 _COLLECTION_ALL = -1
 _DRAG_EXTERNAL_ID, _DRAG_BOOK_ID, _DRAG_COLLECTION_ID = range(3)
+# The number of threads that load covers for the _BookArea.
+_COVER_THREADS = 2
 
 
 class _LibraryDialog(Gtk.Window):
@@ -82,6 +86,7 @@ class _LibraryDialog(Gtk.Window):
         """Close the library and do required cleanup tasks."""
         prefs['lib window width'], prefs['lib window height'] = self.get_size()
         self.book_area.stop_update()
+        self.control_area.stop_refresh()
         self.backend.close()
         self.book_area.close()
         filechooser.close_library_filechooser_dialog()
@@ -339,12 +344,15 @@ class _CollectionArea(Gtk.ScrolledWindow):
                     src_collection, dest_collection)
             self.display_collections()
         elif drag_id == _DRAG_BOOK_ID:
-            for path_str in selection.get_text().split(','):  # IconView path
-                book = self._library.book_area.get_book_at_path(int(path_str))
-                self._library.backend.add_book_to_collection(book, dest_collection)
-                if src_collection != _COLLECTION_ALL:
-                    self._library.backend.remove_book_from_collection(book, src_collection)
-                    self._library.book_area.remove_book_at_path(int(path_str))
+            # IconView paths, removed from the end so that the rest stay valid.
+            paths = sorted((int(path_str) for path_str in selection.get_text().split(',')),
+                           reverse=True)
+            books = [self._library.book_area.get_book_at_path(path) for path in paths]
+            self._library.backend.add_books_to_collection(books, dest_collection)
+            if src_collection != _COLLECTION_ALL:
+                self._library.backend.remove_books_from_collection(books, src_collection)
+                for path in paths:
+                    self._library.book_area.remove_book_at_path(path)
 
     # noinspection PyUnusedLocal
     def _drag_motion(self, treeview, context, x, y, *args):
@@ -449,7 +457,20 @@ class _BookArea(Gtk.ScrolledWindow):
     def __init__(self, library):
         super(_BookArea, self).__init__()
         self._library = library
-        self._stop_update = False
+        self._book_paths = {}
+        self._placeholder = None
+        self._missing_cover = None
+        # Covers are loaded in threads, but only for the books that are
+        # visible (or nearly so), see _update_covers().
+        self._cover_condition = threading.Condition()
+        self._cover_generation = 0
+        self._cover_size = prefs['library cover size']
+        self._covers_requested = set()
+        self._covers_wanted = []
+        self._covers_loaded = []
+        self._cover_threads = 0
+        self._flush_pending = False
+        self._update_pending = False
         self.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
 
         self._liststore = Gtk.ListStore(GdkPixbuf.Pixbuf, int)  # (Cover, ID).
@@ -470,6 +491,8 @@ class _BookArea(Gtk.ScrolledWindow):
                                      [Gtk.TargetEntry.new('text/uri-list', 0, _DRAG_EXTERNAL_ID)],
                                      Gdk.DragAction.COPY | Gdk.DragAction.MOVE)
         self._iconview.set_selection_mode(Gtk.SelectionMode.MULTIPLE)
+        self._iconview.connect('size_allocate', self._schedule_update_covers)
+        self.get_vadjustment().connect('value_changed', self._schedule_update_covers)
         self.add(self._iconview)
 
         self._ui_manager = Gtk.UIManager()
@@ -502,24 +525,36 @@ class _BookArea(Gtk.ScrolledWindow):
         self._liststore.clear()
 
     def display_covers(self, collection):
-        """Display the books in <collection> in the IconView."""
-        self._stop_update = False  # To handle new re-entry during update.
-        self._liststore.clear()
+        """Display the books in <collection> in the IconView. All books
+        are added at once with a placeholder image, their covers are
+        loaded in the background as they are scrolled into view.
+        """
+        self.stop_update()
         if collection == _COLLECTION_ALL:  # The "All" collection is virtual.
             collection = None
-        for i, book in enumerate(self._library.backend.get_books_in_collection(
-                collection, self._library.filter_string)):
-            self._add_book(book)
-            if i % 15 == 0:  # Don't update GUI for every cover for efficiency.
-                while Gtk.events_pending():
-                    Gtk.main_iteration()
-                if self._stop_update:
-                    return
-        self._stop_update = True
+        records = self._library.backend.get_book_records(
+                collection, self._library.filter_string)
+        # Books whose archives are missing get the missing cover at once.
+        self._book_paths = dict((record.id, None if record.missing else record.path)
+                                for record in records)
+        self._cover_size = prefs['library cover size']
+        self._prepare_placeholders()
+        # Filling a detached model saves the IconView from updating itself
+        # for every row.
+        self._iconview.set_model(None)
+        self._liststore.clear()
+        for record in records:
+            self._liststore.append([self._placeholder, record.id])
+        self._iconview.set_model(self._liststore)
+        self._schedule_update_covers()
 
     def stop_update(self):
         """Signal that the updating of book covers should stop."""
-        self._stop_update = True
+        with self._cover_condition:
+            self._cover_generation += 1
+            self._covers_requested = set()
+            self._covers_wanted = []
+            self._covers_loaded = []
 
     def remove_book_at_path(self, path):
         """Remove the book at <path> from the ListStore (and thus from
@@ -542,18 +577,111 @@ class _BookArea(Gtk.ScrolledWindow):
         path = selected[0]
         self._book_activated(self._iconview, path)
 
-    def _add_book(self, book):
-        """Add the <book> to the ListStore (and thus to the _BookArea)."""
-        pixbuf = self._library.backend.get_book_cover(book)
-        if pixbuf is None:
-            pixbuf = self._library.render_icon(Gtk.STOCK_MISSING_IMAGE,
-                                               Gtk.IconSize.DIALOG)
-        # The ratio (0.67) is just above the normal aspect ratio for books.
-        pixbuf = image.fit_in_rectangle(pixbuf,
-                                        int(0.67 * prefs['library cover size']),
-                                        prefs['library cover size'])
-        pixbuf = image.add_border(pixbuf, 1, 0xFFFFFFFF)
-        self._liststore.append([pixbuf, book])
+    def _prepare_placeholders(self):
+        """Create the images shown for books whose covers are not loaded
+        yet, and for books whose covers can not be loaded, at the current
+        cover size.
+        """
+        size = self._cover_size
+        placeholder = GdkPixbuf.Pixbuf.new(colorspace=GdkPixbuf.Colorspace.RGB,
+                                           has_alpha=True, bits_per_sample=8,
+                                           width=int(0.67 * size), height=size)
+        placeholder.fill(0x00000000)
+        self._placeholder = image.add_border(placeholder, 1, 0xFFFFFFFF)
+        missing = self._library.render_icon(Gtk.STOCK_MISSING_IMAGE,
+                                            Gtk.IconSize.DIALOG)
+        self._missing_cover = _render_cover(missing, size)
+
+    # noinspection PyUnusedLocal
+    def _schedule_update_covers(self, *args):
+        """Update the covers from the GTK main loop, once for any number
+        of calls before that happens.
+        """
+        if not self._update_pending:
+            self._update_pending = True
+            GObject.idle_add(self._update_covers)
+
+    def _update_covers(self):
+        """Start loading the covers of the visible books, and those of the
+        books a screenful before and after them, that are not loaded (or
+        being loaded) yet. The visible ones are loaded first.
+        """
+        self._update_pending = False
+        visible = self._iconview.get_visible_range()
+        if visible is None:
+            return False
+        first = visible[0].get_indices()[0]
+        last = visible[1].get_indices()[0]
+        margin = last - first + 1
+        order = list(range(first, last + 1))
+        for distance in range(1, margin + 1):
+            order.extend((last + distance, first - distance))
+        wanted = []
+        for index in order:
+            if not 0 <= index < len(self._liststore):
+                continue
+            book = self._liststore[index][1]
+            if book not in self._covers_requested:
+                self._covers_requested.add(book)
+                wanted.append((index, book, self._book_paths.get(book)))
+        if not wanted:
+            return False
+        with self._cover_condition:
+            self._covers_wanted = wanted + self._covers_wanted
+            for i in range(self._cover_threads, _COVER_THREADS):
+                self._cover_threads += 1
+                thread = threading.Thread(target=self._thread_load_covers)
+                thread.setDaemon(False)
+                thread.start()
+        return False
+
+    def _thread_load_covers(self):
+        """Load the wanted covers until there are no more, and hand them
+        over to _flush_covers() in batches.
+        """
+        while True:
+            with self._cover_condition:
+                if not self._covers_wanted:
+                    self._cover_threads -= 1
+                    return
+                index, book, path = self._covers_wanted.pop(0)
+                generation = self._cover_generation
+                size = self._cover_size
+            pixbuf = None
+            if path is not None:
+                pixbuf = coverstore.get_cover(book, path, size)
+                if pixbuf is None:
+                    pixbuf = self._library.backend.get_book_cover(book, path, size)
+                    if pixbuf is not None:
+                        pixbuf = _render_cover(pixbuf, size)
+                        coverstore.set_cover(book, path, size, pixbuf)
+            with self._cover_condition:
+                if generation != self._cover_generation:
+                    continue
+                self._covers_loaded.append((index, book, pixbuf))
+                if not self._flush_pending:
+                    self._flush_pending = True
+                    GObject.idle_add(self._flush_covers)
+
+    def _flush_covers(self):
+        """Put the covers loaded since the last call into the ListStore."""
+        with self._cover_condition:
+            loaded = self._covers_loaded
+            self._covers_loaded = []
+            self._flush_pending = False
+        moved = False
+        for index, book, pixbuf in loaded:
+            if index >= len(self._liststore) or self._liststore[index][1] != book:
+                # Books were removed in the meantime, try again later.
+                self._covers_requested.discard(book)
+                moved = True
+                continue
+            if pixbuf is None:
+                pixbuf = self._missing_cover
+            self._liststore[index][0] = pixbuf
+        if moved:
+            self._schedule_update_covers()
+        return False
 
     # noinspection PyUnusedLocal
     def _book_activated(self, iconview, path):
@@ -578,10 +706,10 @@ class _BookArea(Gtk.ScrolledWindow):
         collection = self._library.collection_area.get_current_collection()
         if collection == _COLLECTION_ALL:
             return
-        selected = self._iconview.get_selected_items()
+        selected = sorted(self._iconview.get_selected_items(), reverse=True)
+        books = [self.get_book_at_path(path) for path in selected]
+        self._library.backend.remove_books_from_collection(books, collection)
         for path in selected:
-            book = self.get_book_at_path(path)
-            self._library.backend.remove_book_from_collection(book, collection)
             self.remove_book_at_path(path)
         coll_name = self._library.backend.get_collection_name(collection)
         self._library.set_status_message(_("Removed {num} book(s) from '{collection}'.").format(num=len(selected), collection=coll_name))
@@ -600,10 +728,10 @@ class _BookArea(Gtk.ScrolledWindow):
         response = choice_dialog.run()
         choice_dialog.destroy()
         if response == Gtk.ResponseType.YES:
-            selected = self._iconview.get_selected_items()
+            selected = sorted(self._iconview.get_selected_items(), reverse=True)
+            books = [self.get_book_at_path(path) for path in selected]
+            self._library.backend.remove_books(books)
             for path in selected:
-                book = self.get_book_at_path(path)
-                self._library.backend.remove_book(book)
                 self.remove_book_at_path(path)
             self._library.set_status_message(_('Removed {} book(s) from the library.').format(len(selected)))
 
@@ -728,6 +856,7 @@ class _ControlArea(Gtk.HBox):
 
     def __init__(self, library):
         self._library = library
+        self._filter_timer_id = None
         super(_ControlArea, self).__init__(homogeneous=False, spacing=12)
         self.set_border_width(10)
         borderbox = Gtk.EventBox()
@@ -766,14 +895,15 @@ class _ControlArea(Gtk.HBox):
         hbox.pack_start(label, False, False, 0)
         search_entry = Gtk.Entry()
         search_entry.connect('activate', self._filter_books)
+        search_entry.connect('changed', self._filter_books_delayed)
         search_entry.set_tooltip_text(_('Display only those books that have '
-                                        'the specified text string in their '
-                                        'full path. The search is not case '
-                                        'sensitive.'))
+                                        'words starting with each of the '
+                                        'specified words in their full path. '
+                                        'The search is not case sensitive.'))
         hbox.pack_start(search_entry, True, True, 6)
         label = Gtk.Label(label='{}:'.format(_('Cover size')))
         hbox.pack_start(label, False, False, 6)
-        adjustment = Gtk.Adjustment(prefs['library cover size'], 50, 128, 1, 10, 0)
+        adjustment = Gtk.Adjustment(prefs['library cover size'], 50, 256, 1, 10, 0)
 
         cover_size_scale = Gtk.HScale.new(adjustment=adjustment)
         cover_size_scale.set_size_request(150, -1)
@@ -796,6 +926,15 @@ class _ControlArea(Gtk.HBox):
         add_collection_button.set_image(Gtk.Image.new_from_stock(Gtk.STOCK_ADD, Gtk.IconSize.BUTTON))
         add_collection_button.set_tooltip_text(_('Add a new empty collection.'))
         hbox.pack_start(add_collection_button, False, False, 0)
+
+        refresh_button = Gtk.Button(_('Refresh'))
+        self._refresh_button = refresh_button
+        self._refresh_generation = 0
+        refresh_button.connect('clicked', self._refresh_library)
+        refresh_button.set_image(Gtk.Image.new_from_stock(Gtk.STOCK_REFRESH, Gtk.IconSize.BUTTON))
+        refresh_button.set_tooltip_text(_('Update the books whose files have '
+                                          'changed, and find those that are gone.'))
+        hbox.pack_start(refresh_button, False, False, 0)
         hbox.pack_start(Gtk.HBox(True, True, 0), True, True, 0)
 
         self._open_button = Gtk.Button(None, Gtk.STOCK_OPEN)
@@ -811,14 +950,20 @@ class _ControlArea(Gtk.HBox):
         self._open_button.set_sensitive(False)
         if selected:
             book = self._library.book_area.get_book_at_path(selected[0])
-            name = self._library.backend.get_book_name(book)
-            dir_path = os.path.dirname(self._library.backend.get_book_path(book))
-            format_ = self._library.backend.get_book_format(book)
-            pages = self._library.backend.get_book_pages(book)
-            size = self._library.backend.get_book_size(book)
+            record = self._library.backend.get_book_record(book)
+        else:
+            record = None
+        if record is not None:
+            name = record.name
+            dir_path = os.path.dirname(record.path)
+            format_ = record.format
+            pages = record.pages
+            size = record.size
+            missing = record.missing
         else:
             name = dir_path = format_ = pages = size = None
-        if len(selected) == 1:
+            missing = False
+        if len(selected) == 1 and not missing:
             self._open_button.set_sensitive(True)
         if name is not None:
             self._namelabel.set_text(encoding.to_unicode(name))
@@ -828,7 +973,9 @@ class _ControlArea(Gtk.HBox):
             self._pageslabel.set_text(_('{} pages').format(pages))
         else:
             self._pageslabel.set_text('')
-        if format_ is not None and size is not None:
+        if missing:
+            self._filelabel.set_text(_('The file of this book is missing.'))
+        elif format_ is not None and size is not None:
             self._filelabel.set_text('{}, {}'.format(archive.get_name(format_),
                                                      '{:.1f} MiB'.format(size / 1048576.0)))
         else:
@@ -876,11 +1023,77 @@ class _ControlArea(Gtk.HBox):
                     message = '{} {}'.format(message, _('A collection by that name already exists.'))
                 self._library.set_status_message(message)
 
+    # noinspection PyUnusedLocal
+    def _refresh_library(self, *args):
+        """Add the books whose archives have changed since they were
+        added to the library again, and mark those whose archives are
+        gone as missing.
+        """
+        # Checking the files can take a while (e.g. on network drives),
+        # so it is done in a thread and the result applied by
+        # _finish_refresh().
+        states = self._library.backend.get_book_file_states()
+        self._refresh_button.set_sensitive(False)
+        self._library.set_status_message(_('Checking the books...'))
+        generation = self._refresh_generation
+
+        def check():
+            result = librarybackend.check_book_files(states)
+            GObject.idle_add(self._finish_refresh, generation, result)
+
+        thread = threading.Thread(target=check)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _finish_refresh(self, generation, result):
+        """Apply the <result> of librarybackend.check_book_files() started
+        by _refresh_library(), unless the library was closed since
+        <generation>.
+        """
+        if generation != self._refresh_generation:
+            return False
+        changed, missing, found, adopted = result
+        self._refresh_button.set_sensitive(True)
+        self._library.backend.set_book_mtimes(adopted)
+        self._library.backend.set_books_missing(missing, True)
+        self._library.backend.set_books_missing(found, False)
+        num_missing = len(self._library.backend.get_missing_books())
+        if missing or found:
+            collection = self._library.collection_area.get_current_collection()
+            self._library.book_area.display_covers(collection)
+        if changed:
+            _AddBooksProgressDialog(self._library, changed, None)
+        self._library.set_status_message(
+                _('{changed} book(s) changed, {missing} book(s) missing.').format(
+                        changed=len(changed), missing=num_missing))
+        return False
+
+    def stop_refresh(self):
+        """Drop the result of a running refresh, see _refresh_library()."""
+        self._refresh_generation += 1
+
+    def _filter_books_delayed(self, entry):
+        """Filter the books once the text in the Gtk.Entry has not changed
+        for a moment, so that they are not displayed again for every
+        keystroke while typing.
+        """
+        if self._filter_timer_id is not None:
+            GObject.source_remove(self._filter_timer_id)
+        self._filter_timer_id = GObject.timeout_add(250, self._filter_books_timeout, entry)
+
+    def _filter_books_timeout(self, entry):
+        self._filter_timer_id = None
+        self._filter_books(entry)
+        return False
+
     def _filter_books(self, entry, *args):
         """Display only the books in the current collection whose paths
-        contain the string in the Gtk.Entry. The string is not
+        match the words in the Gtk.Entry. The match is not
         case-sensitive.
         """
+        if self._filter_timer_id is not None:
+            GObject.source_remove(self._filter_timer_id)
+            self._filter_timer_id = None
         self._library.filter_string = entry.get_text()
         if not self._library.filter_string:
             self._library.filter_string = None
@@ -937,23 +1150,62 @@ class _AddBooksProgressDialog(Gtk.Dialog):
         main_box.pack_start(child=added_label, expand=False, fill=False, padding=0)
         self.show_all()
 
-        total_paths = float(len(paths))
-        total_added = 0
-        for i, path in enumerate(paths):
-            if library.backend.add_book(path, collection):
-                total_added += 1
-                number_label.set_text('{:d}'.format(total_added))
-            added_label.set_text(_("Adding '{}'...").format(encoding.to_unicode(path)))
-            bar.set_fraction((i + 1) / total_paths)
-            while Gtk.events_pending():
-                Gtk.main_iteration()
-            if self._destroy:
-                return
-        self._response()
+        self._library = library
+        self._number_label = number_label
+        self._bar = bar
+        self._added_label = added_label
+        self._total_added = 0
+        self._importer = librarybackend.BookImporter(library.backend, paths,
+                                                     collection,
+                                                     prefs['library cover size'])
+        GObject.timeout_add(100, self._poll)
+
+    def _poll(self):
+        """Write the books that have been read since the last call to
+        the library and update the progress. Return False when done.
+        """
+        if self._destroy:
+            return False
+        added = self._importer.poll()
+        for path, success in added:
+            if success:
+                self._total_added += 1
+        if added:
+            self._number_label.set_text('{:d}'.format(self._total_added))
+            self._added_label.set_text(_("Adding '{}'...").format(
+                    encoding.to_unicode(added[-1][0])))
+            self._bar.set_fraction(self._importer.get_done() /
+                                   max(self._importer.get_total(), 1))
+        if self._importer.is_finished():
+            self._response()
+            return False
+        return True
 
     def _response(self, *args):
+        if self._destroy:
+            return
         self._destroy = True
+        self._importer.stop()
         self.destroy()
+        if self._total_added:
+            self._library.collection_area.display_collections()
+        errors = self._importer.get_errors()
+        if errors:
+            dialog = Gtk.MessageDialog(self._library, 0, Gtk.MessageType.WARNING,
+                                       Gtk.ButtonsType.CLOSE,
+                                       _('Some books could not be added.'))
+            dialog.format_secondary_text('\n'.join(errors))
+            dialog.run()
+            dialog.destroy()
+
+
+def _render_cover(pixbuf, size):
+    """Return the cover <pixbuf> scaled and framed for display in the
+    _BookArea with covers of <size>.
+    """
+    # The ratio (0.67) is just above the normal aspect ratio for books.
+    pixbuf = image.fit_in_rectangle(pixbuf, int(0.67 * size), size)
+    return image.add_border(pixbuf, 1, 0xFFFFFFFF)
 
 
 # noinspection PyUnusedLocal
@@ -2,16 +2,25 @@
 """librarybackend.py - Comic book library backend using sqlite."""
 from __future__ import absolute_import
 
+import multiprocessing
 import os
+from collections import namedtuple
+from functools import partial
 from sqlite3 import dbapi2
 
 from src import archive
 from src import constants
+from src import coverstore
 from src import encoding
 from src import thumbnail
 
 _db_path = os.path.join(constants.DATA_DIR, 'library.db')
 _cover_dir = os.path.join(constants.DATA_DIR, 'library_covers')
+_SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+# Everything stored about a book, as returned by get_book_records().
+BookRecord = namedtuple('BookRecord', 'id name path pages format size missing')
+_BOOK_RECORD_COLUMNS = 'id, name, path, pages, format, size, missing'
 
 
 class LibraryBackend(object):
@@ -19,7 +28,12 @@ class LibraryBackend(object):
     data to and from disk.
     """
 
-    def __init__(self):
+    def __init__(self, synchronous='NORMAL'):
+        """Open the library database. <synchronous> is the sqlite
+        synchronous level used for writes, one of 'OFF', 'NORMAL', 'FULL'
+        and 'EXTRA'. With the write-ahead log 'NORMAL' never corrupts the
+        database, but may lose the last transactions on a power failure.
+        """
 
         def row_factory(cursor, row):
             """Return rows as sequences only when they have more than
@@ -32,49 +46,106 @@ class LibraryBackend(object):
         self._con = dbapi2.connect(_db_path)
         self._con.row_factory = row_factory
         self._con.text_factory = str
-        if not self._con.execute('PRAGMA table_info(Book)').fetchall():
-            self._create_table_book()
-        if not self._con.execute('PRAGMA table_info(Collection)').fetchall():
-            self._create_table_collection()
-        if not self._con.execute('PRAGMA table_info(Contain)').fetchall():
-            self._create_table_contain()
+        # With the write-ahead log readers never wait for the writer. Not
+        # all file systems support it, sqlite then keeps the old journal.
+        try:
+            self._con.execute('PRAGMA journal_mode = WAL')
+        except dbapi2.Error:
+            print('! Could not use write-ahead logging for {}'.format(_db_path))
+        if synchronous.upper() not in _SYNCHRONOUS_LEVELS:
+            raise ValueError('Invalid synchronous level {}'.format(synchronous))
+        self._con.execute('PRAGMA synchronous = {}'.format(synchronous.upper()))
+        self._upgrade_schema()
+        self._has_search_index = self._con.execute('''SELECT name
+            FROM sqlite_master WHERE name = ?''', ('book_search',)).fetchone() is not None
+        _move_old_covers()
 
     def get_books_in_collection(self, collection=None, filter_string=None):
         """Return a sequence with all the books in <collection>, or *ALL*
         books if <collection> is None. If <filter_string> is not None, we
-        only return books where the <filter_string> occurs in the path.
+        only return books whose name or path contain words starting with
+        each of the words in <filter_string>.
         """
-        if collection is None:
-            if filter_string is None:
-                cur = self._con.execute('''SELECT id FROM Book
-                    ORDER BY path''')
-            else:
-                cur = self._con.execute('''SELECT id FROM Book
-                    WHERE path LIKE ?
-                    ORDER BY path''', ("%%%s%%" % filter_string,))
-        else:
-            if filter_string is None:
-                cur = self._con.execute('''SELECT id FROM Book
-                    WHERE id IN (SELECT book FROM Contain WHERE collection = ?)
-                    ORDER BY path''', (collection,))
-            else:
-                cur = self._con.execute('''SELECT id FROM Book
-                    WHERE id IN (SELECT book FROM Contain WHERE collection = ?)
-                    AND path LIKE ?
-                    ORDER BY path''', (collection, "%%%s%%" % filter_string))
-        return cur.fetchall()
+        return self._query_books('id', collection, filter_string).fetchall()
 
-    def get_book_cover(self, book):
-        """Return a pixbuf with a thumbnail of the cover of <book>, or
-        None if the cover can not be fetched.
+    def get_book_records(self, collection=None, filter_string=None):
+        """Return a list of BookRecords for the books that
+        get_books_in_collection() returns for <collection> and
+        <filter_string>, fetched with a single query.
         """
-        try:
-            path = self._con.execute('''SELECT path FROM Book
-                WHERE id = ?''', (book,)).fetchone()
-        except Exception:
+        return [BookRecord._make(row) for row in
+                self._query_books(_BOOK_RECORD_COLUMNS, collection, filter_string)]
+
+    def get_book_records_by_id(self, books):
+        """Return a list of BookRecords for the <books> that are in the
+        library, in the same order, fetched with a single query.
+        """
+        books = list(books)
+        records = {}
+        # sqlite limits the number of parameters in a query.
+        for start in range(0, len(books), 500):
+            chunk = books[start:start + 500]
+            cur = self._con.execute('''SELECT {} FROM Book
+                WHERE id IN ({})'''.format(_BOOK_RECORD_COLUMNS,
+                                         ', '.join('?' * len(chunk))), chunk)
+            for row in cur:
+                records[row[0]] = BookRecord._make(row)
+        return [records[book] for book in books if book in records]
+
+    def get_book_record(self, book):
+        """Return the BookRecord for <book>, or None if <book> isn't in
+        the library.
+        """
+        row = self._con.execute('''SELECT {} FROM Book
+            WHERE id = ?'''.format(_BOOK_RECORD_COLUMNS), (book,)).fetchone()
+        if row is None:
+            return None
+        return BookRecord._make(row)
+
+    def _query_books(self, columns, collection=None, filter_string=None):
+        """Return a cursor over the <columns> of the books in <collection>
+        (all books if it is None) that match <filter_string> (unless it is
+        None), ordered by path.
+        """
+        conditions = []
+        parameters = []
+        if collection is not None:
+            conditions.append('id IN (SELECT book FROM Contain WHERE collection = ?)')
+            parameters.append(collection)
+        words = filter_string.split() if filter_string is not None else []
+        if self._has_search_index:
+            # The index only holds words of letters and digits, words
+            # without any (such as "-") would match no books at all.
+            words = [word for word in words if any(c.isalnum() for c in word)]
+        if words and self._has_search_index:
+            # Every word is matched as a quoted prefix, so that characters
+            # with a meaning in the query syntax are taken literally.
+            conditions.append('''id IN (SELECT rowid FROM book_search
+                WHERE book_search MATCH ?)''')
+            parameters.append(' '.join('"{}"*'.format(word.replace('"', '""'))
+                                       for word in words))
+        else:
+            for word in words:
+                conditions.append('path LIKE ?')
+                parameters.append('%{}%'.format(word))
+        query = 'SELECT {} FROM Book'.format(columns)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        return self._con.execute(query + ' ORDER BY path', parameters)
+
+    def get_book_cover(self, book, path=None, size=128):
+        """Return a pixbuf with a thumbnail of the cover of <book>, that is
+        at least <size> px high where possible, or None if the cover can
+        not be fetched. The <path> of the book may be given if it is
+        already known.
+        """
+        if path is None:
+            path = self.get_book_path(book)
+        if path is None:
             print('! Non-existant book #{:d}'.format(book))
             return None
-        thumb = thumbnail.get_thumbnail(path, create=True, dst_dir=_cover_dir)
+        thumb = thumbnail.get_thumbnail(path, create=True, dst_dir=_cover_dir,
+                                        size=size)
         if thumb is None:
             print('! Could not get cover for {}'.format(path))
         return thumb
@@ -176,41 +247,53 @@ class LibraryBackend(object):
         Return True if the book was successfully added (or was already
         added).
         """
-        path = os.path.abspath(path)
-        name = os.path.basename(path)
-        info = archive.get_archive_info(path)
-        if info is None:
+        record = _read_book(path)[1]
+        if record is None:
             return False
-        format_, pages, size = info
-        thumbnail.get_thumbnail(path, create=True, dst_dir=_cover_dir)
-        old = self._con.execute('''SELECT id FROM Book
-            WHERE path = ?''', (path,)).fetchone()
+        return bool(self.add_book_records([record], collection))
+
+    def add_book_records(self, records, collection=None):
+        """Add the books described by <records>, tuples (path, name,
+        pages, format, size, mtime) as made by the worker processes of a
+        BookImporter, to the library in a single transaction. Books that
+        are already in the library are updated. If <collection> is not
+        None, it is the collection that the books should be put in.
+        Return a list with the paths of the books that were added (or
+        were already added).
+        """
+        records = list(records)
         try:
-            if old is not None:
-                self._con.execute('''UPDATE Book SET
-                    name = ?, pages = ?, format = ?, size = ?
-                    WHERE path = ?''', (name, pages, format_, size, path))
-            else:
-                self._con.execute('''INSERT INTO Book
-                    (name, path, pages, format, size)
-                    VALUES (?, ?, ?, ?, ?)''',
-                                  (name, path, pages, format_, size))
+            with self._con:
+                # Update first and then insert what is new, rather than
+                # replacing rows, so that the ids of old books are kept.
+                self._con.executemany('''UPDATE Book SET
+                    name = ?, pages = ?, format = ?, size = ?, mtime = ?,
+                    missing = 0
+                    WHERE path = ?''', [(name, pages, format_, size, mtime, path)
+                                          for path, name, pages, format_, size, mtime
+                                          in records])
+                self._con.executemany('''INSERT OR IGNORE INTO Book
+                    (path, name, pages, format, size, mtime)
+                    VALUES (?, ?, ?, ?, ?, ?)''', records)
+                if collection is not None:
+                    self._con.executemany('''INSERT OR IGNORE INTO Contain
+                        (collection, book)
+                        SELECT ?, id FROM Book WHERE path = ?''',
+                                          [(collection, record[0])
+                                           for record in records])
         except dbapi2.Error:
-            print('! Could not add book {} to the library'.format(path))
-            return False
-        if collection is not None:
-            book = self._con.execute('''SELECT id FROM Book
-                WHERE path = ?''', (path,)).fetchone()
-            self.add_book_to_collection(book, collection)
-        return True
+            print('! Could not add {:d} book(s) to the library'.format(len(records)))
+            return []
+        return [record[0] for record in records]
 
     def add_collection(self, name):
         """Add a new collection with <name> to the library. Return True
         if the collection was successfully added.
         """
         try:
-            self._con.execute('''INSERT INTO Collection
-                (name) VALUES (?)''', (name,))
+            with self._con:
+                self._con.execute('''INSERT INTO Collection
+                    (name) VALUES (?)''', (name,))
             return True
         except dbapi2.Error:
             print('! Could not add collection {}'.format(name))
@@ -218,35 +301,40 @@ class LibraryBackend(object):
 
     def add_book_to_collection(self, book, collection):
         """Put <book> into <collection>."""
+        self.add_books_to_collection([book], collection)
+
+    def add_books_to_collection(self, books, collection):
+        """Put all of <books> into <collection>."""
         try:
-            self._con.execute('''INSERT INTO Contain
-                (collection, book) VALUES (?, ?)''', (collection, book))
-        except dbapi2.DatabaseError:  # E.g. book already in collection.
-            pass
+            with self._con:
+                self._con.executemany('''INSERT OR IGNORE INTO Contain
+                    (collection, book) VALUES (?, ?)''',
+                                      [(collection, book) for book in books])
         except dbapi2.Error:
-            print('! Could not add book {} to collection {}'.format(book,
-                                                                    collection))
+            print('! Could not add books to collection {}'.format(collection))
 
     def add_collection_to_collection(self, subcollection, supercollection):
         """Put <subcollection> into <supercollection>, or put
         <subcollection> in the root if <supercollection> is None.
         """
-        if supercollection is None:
-            self._con.execute('''UPDATE Collection
-                SET supercollection = NULL
-                WHERE id = ?''', (subcollection,))
-        else:
-            self._con.execute('''UPDATE Collection
-                SET supercollection = ?
-                WHERE id = ?''', (supercollection, subcollection))
+        with self._con:
+            if supercollection is None:
+                self._con.execute('''UPDATE Collection
+                    SET supercollection = NULL
+                    WHERE id = ?''', (subcollection,))
+            else:
+                self._con.execute('''UPDATE Collection
+                    SET supercollection = ?
+                    WHERE id = ?''', (supercollection, subcollection))
 
     def rename_collection(self, collection, name):
         """Rename the <collection> to <name>. Return True if the renaming
         was successful.
         """
         try:
-            self._con.execute('''UPDATE Collection SET name = ?
-                WHERE id = ?''', (name, collection))
+            with self._con:
+                self._con.execute('''UPDATE Collection SET name = ?
+                    WHERE id = ?''', (name, collection))
             return True
         except dbapi2.DatabaseError:  # E.g. name taken.
             pass
@@ -265,41 +353,186 @@ class LibraryBackend(object):
         copy_name = name + ' ' + _('(Copy)')
         while self.get_collection_by_name(copy_name):
             copy_name = copy_name + ' ' + _('(Copy)')
-        if self.add_collection(copy_name) is None:  # Could not create the new.
+        try:
+            with self._con:
+                copy_collection = self._con.execute('''INSERT INTO Collection
+                    (name) VALUES (?)''', (copy_name,)).lastrowid
+                self._con.execute('''INSERT OR IGNORE INTO Contain (collection, book)
+                    SELECT ?, book FROM Contain
+                    WHERE collection = ?''', (copy_collection, collection))
+        except dbapi2.Error:
+            print('! Could not add collection {}'.format(copy_name))
             return False
-        copy_collection = self._con.execute('''SELECT id FROM Collection
-            WHERE name = ?''', (copy_name,)).fetchone()
-        self._con.execute('''INSERT OR IGNORE INTO Contain (collection, book)
-            SELECT ?, book FROM Contain
-            WHERE collection = ?''', (copy_collection, collection))
         return True
 
+    def get_changed_books(self):
+        """Check the archives of all books in the library against what is
+        stored about them. Return a tuple (changed, missing, found) as
+        check_book_files() does.
+        """
+        changed, missing, found, adopted = check_book_files(
+                self.get_book_file_states())
+        self.set_book_mtimes(adopted)
+        return changed, missing, found
+
+    def get_book_file_states(self):
+        """Return a list of tuples (book, path, size, mtime, missing) with
+        what is stored about the archives of all books in the library, for
+        check_book_files().
+        """
+        return [tuple(row) for row in self._con.execute(
+                '''SELECT id, path, size, mtime, missing FROM Book''')]
+
+    def set_book_mtimes(self, mtimes):
+        """Store the modification times of archives, given by <mtimes> as
+        (mtime, book) tuples.
+        """
+        if mtimes:
+            with self._con:
+                self._con.executemany('''UPDATE Book SET mtime = ?
+                    WHERE id = ?''', mtimes)
+
+    def set_books_missing(self, books, missing=True):
+        """Mark all of <books> as <missing> (i.e. that their archives can
+        not be found) or not.
+        """
+        with self._con:
+            self._con.executemany('''UPDATE Book SET missing = ?
+                WHERE id = ?''', [(int(missing), book) for book in books])
+
+    def get_missing_books(self):
+        """Return a sequence with the books whose archives could not be
+        found when the library was last refreshed.
+        """
+        return self._con.execute('''SELECT id FROM Book
+            WHERE missing ORDER BY path''').fetchall()
+
     def remove_book(self, book):
         """Remove the <book> from the library."""
-        path = self.get_book_path(book)
-        if path is not None:
-            thumbnail.delete_thumbnail(path, dst_dir=_cover_dir)
-        self._con.execute('DELETE FROM Book WHERE id = ?', (book,))
-        self._con.execute('DELETE FROM Contain WHERE book = ?', (book,))
+        self.remove_books([book])
+
+    def remove_books(self, books):
+        """Remove all of <books> from the library."""
+        books = list(books)
+        for record in self.get_book_records_by_id(books):
+            thumbnail.delete_thumbnail(record.path, dst_dir=_cover_dir)
+        coverstore.delete_covers(books)
+        with self._con:
+            self._con.executemany('DELETE FROM Book WHERE id = ?',
+                                  [(book,) for book in books])
+            self._con.executemany('DELETE FROM Contain WHERE book = ?',
+                                  [(book,) for book in books])
 
     def remove_collection(self, collection):
         """Remove the <collection> (sans books) from the library."""
-        self._con.execute('DELETE FROM Collection WHERE id = ?', (collection,))
-        self._con.execute('DELETE FROM Contain WHERE collection = ?',
-                          (collection,))
-        self._con.execute('''UPDATE Collection SET supercollection = NULL
-            WHERE supercollection = ?''', (collection,))
+        with self._con:
+            self._con.execute('DELETE FROM Collection WHERE id = ?', (collection,))
+            self._con.execute('DELETE FROM Contain WHERE collection = ?',
+                              (collection,))
+            self._con.execute('''UPDATE Collection SET supercollection = NULL
+                WHERE supercollection = ?''', (collection,))
 
     def remove_book_from_collection(self, book, collection):
         """Remove <book> from <collection>."""
-        self._con.execute('''DELETE FROM Contain
-            WHERE book = ? AND collection = ?''', (book, collection))
+        self.remove_books_from_collection([book], collection)
+
+    def remove_books_from_collection(self, books, collection):
+        """Remove all of <books> from <collection>."""
+        with self._con:
+            self._con.executemany('''DELETE FROM Contain
+                WHERE book = ? AND collection = ?''',
+                                  [(book, collection) for book in books])
 
     def close(self):
         """Commit changes and close cleanly."""
         self._con.commit()
         self._con.close()
 
+    def _upgrade_schema(self):
+        """Bring the database schema up to the current version, stored in
+        the user_version of the database, by running the missing steps of
+        _get_migrations() in order, each in its own transaction.
+        """
+        migrations = self._get_migrations()
+        version = self._con.execute('PRAGMA user_version').fetchone()
+        while version < len(migrations):
+            try:
+                self._con.execute('BEGIN')
+                migrations[version]()
+                self._con.execute('PRAGMA user_version = {:d}'.format(version + 1))
+                self._con.commit()
+            except dbapi2.Error:
+                self._con.rollback()
+                print('! Could not upgrade the library to version {:d}'.format(
+                        version + 1))
+                return
+            version += 1
+
+    def _get_migrations(self):
+        """Return the list of functions that upgrade the database schema,
+        where the function at index i upgrades from version i to i + 1.
+        Version 0 is a database from before schema versions, which may or
+        may not have the tables already.
+        """
+        return [self._create_tables, self._create_indexes,
+                self._add_book_file_state, self._create_search_index]
+
+    def _create_tables(self):
+        if not self._con.execute('PRAGMA table_info(Book)').fetchall():
+            self._create_table_book()
+        if not self._con.execute('PRAGMA table_info(Collection)').fetchall():
+            self._create_table_collection()
+        if not self._con.execute('PRAGMA table_info(Contain)').fetchall():
+            self._create_table_contain()
+
+    def _create_indexes(self):
+        # Books are already indexed on path, and Contain on (collection,
+        # book), but not the other way around.
+        self._con.execute('''CREATE INDEX IF NOT EXISTS contain_book
+            ON contain (book)''')
+        self._con.execute('''CREATE INDEX IF NOT EXISTS collection_supercollection
+            ON collection (supercollection)''')
+        self._con.execute('''CREATE INDEX IF NOT EXISTS book_added
+            ON book (added)''')
+
+    def _add_book_file_state(self):
+        # The modification time of the archive when the book was added, and
+        # whether the archive was gone when the library was last refreshed.
+        self._con.execute('ALTER TABLE book ADD COLUMN mtime REAL')
+        self._con.execute('''ALTER TABLE book ADD COLUMN missing
+            INTEGER NOT NULL DEFAULT 0''')
+
+    def _create_search_index(self):
+        # The full text index of book names and paths, and the triggers that
+        # keep it up to date. sqlite may be built without FTS5, searching
+        # then falls back to LIKE (see _query_books()).
+        try:
+            self._con.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS book_search
+                USING fts5(name, path, content='book', content_rowid='id')''')
+        except dbapi2.OperationalError:
+            print('! Could not create the library search index, '
+                  'searching will be slow.')
+            return
+        self._con.execute('''CREATE TRIGGER IF NOT EXISTS book_search_insert
+            AFTER INSERT ON book BEGIN
+                INSERT INTO book_search (rowid, name, path)
+                VALUES (new.id, new.name, new.path);
+            END''')
+        self._con.execute('''CREATE TRIGGER IF NOT EXISTS book_search_delete
+            AFTER DELETE ON book BEGIN
+                INSERT INTO book_search (book_search, rowid, name, path)
+                VALUES ('delete', old.id, old.name, old.path);
+            END''')
+        self._con.execute('''CREATE TRIGGER IF NOT EXISTS book_search_update
+            AFTER UPDATE OF name, path ON book BEGIN
+                INSERT INTO book_search (book_search, rowid, name, path)
+                VALUES ('delete', old.id, old.name, old.path);
+                INSERT INTO book_search (rowid, name, path)
+                VALUES (new.id, new.name, new.path);
+            END''')
+        self._con.execute('''INSERT INTO book_search (book_search)
+            VALUES ('rebuild')''')
+
     def _create_table_book(self):
         self._con.execute('''CREATE TABLE book (
             id INTEGER PRIMARY KEY,
@@ -321,3 +554,201 @@ class LibraryBackend(object):
             collection INTEGER NOT NULL,
             book INTEGER NOT NULL,
             PRIMARY KEY (collection, book))''')
+
+
+class BookImporter(object):
+    """The BookImporter adds books to the library in the background.
+
+    The archives are listed and their covers thumbnailed in a pool of
+    worker processes, the results are written to the library by poll(),
+    which is meant to be called periodically from the GTK thread so that
+    all writes go through the single connection of the LibraryBackend,
+    one transaction for each batch.
+    """
+
+    def __init__(self, backend, paths, collection=None, cover_size=128):
+        """Start adding the books at <paths> to the library of <backend>,
+        and also to <collection> unless it is None. Their covers are
+        thumbnailed for display at <cover_size> px.
+        """
+        self._backend = backend
+        self._collection = collection
+        self._total = len(paths)
+        self._done = 0
+        self._finished = False
+        self._errors = []
+        # Fresh interpreters rather than forks of this one, which has GTK
+        # and sqlite state that is not safe to share with a child.
+        context = multiprocessing.get_context('spawn')
+        self._pool = context.Pool(max(1, min(os.cpu_count() or 1, self._total)),
+                                  initializer=_init_import_worker)
+        self._results = self._pool.imap_unordered(
+                partial(_read_book, cover_size=cover_size), paths)
+
+    def get_total(self):
+        """Return the number of books that are to be added."""
+        return self._total
+
+    def get_done(self):
+        """Return the number of books that have been handled so far."""
+        return self._done
+
+    def is_finished(self):
+        """Return True if all books have been handled, or if the import
+        was stopped.
+        """
+        return self._finished
+
+    def get_errors(self):
+        """Return a list of the distinct reasons, as messages for the
+        user, why books could not be added so far.
+        """
+        return self._errors[:]
+
+    def poll(self):
+        """Write the books that the workers have finished since the last
+        call to the library, and return them as a list of tuples (path,
+        added) where <added> tells if the book was added successfully.
+        """
+        if self._finished:
+            return []
+        finished = []
+        try:
+            while True:
+                finished.append(self._results.next(timeout=0))
+        except multiprocessing.TimeoutError:
+            pass
+        except StopIteration:
+            self._finished = True
+            self._pool.close()
+            self._pool.join()
+        records = [record for path, record, error, updates in finished
+                   if record is not None]
+        added = set()
+        if records:
+            added.update(self._backend.add_book_records(records, self._collection))
+        for path, record, error, updates in finished:
+            if error is not None and error not in self._errors:
+                self._errors.append(error)
+            thumbnail.update_index(updates)
+        self._done += len(finished)
+        return [(path, record is not None and record[0] in added)
+                for path, record, error, updates in finished]
+
+    def stop(self):
+        """Stop adding books. Books that are already done are written to
+        the library, pending ones are dropped.
+        """
+        if self._finished:
+            return
+        self.poll()
+        self._finished = True
+        self._pool.terminate()
+        self._pool.join()
+
+
+def check_book_files(states):
+    """Check the archives of the books described by <states>, as returned
+    by LibraryBackend.get_book_file_states(). Return a tuple (changed,
+    missing, found, adopted) where <changed> is a list with the paths of
+    the archives that have been modified (and should be added again),
+    <missing> is a list of the books whose archives are gone, <found> a
+    list of the books that were missing but whose archives are back (and
+    unchanged), and <adopted> a list of (mtime, book) tuples for
+    LibraryBackend.set_book_mtimes(). This does not use the database, so
+    it can run in any thread.
+    """
+    changed = []
+    missing = []
+    found = []
+    adopted = []
+    for book, path, size, mtime, was_missing in states:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            if not was_missing:
+                missing.append(book)
+            continue
+        if stat.st_size != size:
+            changed.append(path)
+        elif mtime is None:
+            # Added before modification times were stored, assume that
+            # the archive is unchanged if its size is.
+            adopted.append((stat.st_mtime, book))
+        elif stat.st_mtime != mtime:
+            changed.append(path)
+        elif was_missing:
+            found.append(book)
+    return changed, missing, found, adopted
+
+
+def _init_import_worker():
+    """Prepare a BookImporter worker process."""
+    try:
+        _
+    except NameError:
+        import gettext
+        gettext.install('comix')
+    # Errors are passed on to the parent, which has the user interface,
+    # and so are changes to the thumbnail index, which it writes.
+    archive.set_interactive(False)
+    thumbnail.track_index_updates()
+
+
+def _move_old_covers():
+    """Move the covers that older versions stored directly in the cover
+    directory to its subdirectory for normal size thumbnails.
+    """
+    try:
+        names = [name for name in os.listdir(_cover_dir) if name.endswith('.png')]
+    except OSError:
+        return
+    if not names:
+        return
+    normal_dir = os.path.join(_cover_dir, 'normal')
+    try:
+        if not os.path.isdir(normal_dir):
+            os.makedirs(normal_dir, 0o700)
+        for name in names:
+            os.rename(os.path.join(_cover_dir, name), os.path.join(normal_dir, name))
+    except OSError:
+        print('! Could not move the covers in {}'.format(_cover_dir))
+
+
+def _read_book(path, cover_size=128):
+    """Return a tuple (path, record, error, index_updates) for the
+    archive at <path>, where <record> is a tuple (path, name, pages,
+    format, size, mtime) for LibraryBackend.add_book_records(), or None if
+    the archive can not be read. <error> is then a message for the user
+    about why, if there is more to say than that. The cover thumbnail for
+    display at <cover_size> px is created on the way, <index_updates> are
+    the resulting changes to the thumbnail index (see
+    thumbnail.take_index_updates()).
+    """
+    record, error = _read_book_record(path, cover_size)
+    return path, record, error, thumbnail.take_index_updates()
+
+
+def _read_book_record(path, cover_size):
+    """Return a tuple (record, error) for the archive at <path>, see
+    _read_book().
+    """
+    abspath = os.path.abspath(path)
+    try:
+        mtime = os.stat(abspath).st_mtime
+        info = archive.get_archive_info(abspath)
+        if info is None:
+            return None, None
+    except archive.ArchiveError as e:
+        print('! Could not read {}: {}'.format(path, e))
+        return None, str(e)
+    except Exception:
+        print('! Could not read {}'.format(path))
+        return None, None
+    format_, pages, size = info
+    try:
+        thumbnail.get_thumbnail(abspath, create=True, dst_dir=_cover_dir,
+                                size=cover_size)
+    except Exception:
+        print('! Could not create cover for {}'.format(path))
+    return (abspath, os.path.basename(abspath), pages, format_, size, mtime), None
@@ -6,6 +6,7 @@ import os
 import shutil
 import sys
 import threading
+from collections import namedtuple
 
 from gi.repository import GObject
 from gi.repository import Gdk
@@ -19,13 +20,22 @@ from src import event
 from src import filehandler
 from src import image
 from src import lens
+from src import pixbufcache
 from src import preferences
 from src import slideshow
 from src import status
 from src import thumbbar
+from src import thumbnail
 from src import ui
 from src.preferences import prefs
 
+# The settings that decide how pages are scaled for display.
+_ScaleSettings = namedtuple('_ScaleSettings', 'width height scale_up zoom_mode manual_zoom rotation auto_rotate '
+                            'horizontal_flip vertical_flip enhancement checkered')
+# The key of a scaled pixbuf in the cache, one path and rotation per page.
+_ScaledKey = namedtuple('_ScaledKey', 'paths width height scale_up rotations horizontal_flip vertical_flip '
+                        'enhancement checkered')
+
 
 class MainWindow(Gtk.Window):
     """
@@ -48,6 +58,7 @@ class MainWindow(Gtk.Window):
 
         self._manual_zoom = 100  # In percent of original image size
         self._waiting_for_redraw = False
+        self._scaled_pixbufs = pixbufcache.PixbufCache()
 
         self.file_handler = filehandler.FileHandler(self)
         self.thumbnailsidebar = thumbbar.ThumbnailSidebar(self)
@@ -215,29 +226,20 @@ class MainWindow(Gtk.Window):
                              priority=GObject.PRIORITY_HIGH_IDLE)
 
     def _draw_image(self, at_bottom, scroll):
-        def pixb_process(pixbuf):
-            """ Small helper for common stuff to few pixbufs. """
-            if prefs['horizontal flip']:
-                pixbuf = pixbuf.flip(horizontal=True)
-            if prefs['vertical flip']:
-                pixbuf = pixbuf.flip(horizontal=False)
-            pixbuf = self.enhancer.enhance(pixbuf)
-            return pixbuf
-
         self._waiting_for_redraw = False
         self._display_active_widgets()
         if not self.file_handler.file_loaded:
             return False
         area_width, area_height = self.get_visible_area_size()
-        if self.zoom_mode == preferences.ZOOM_MODE_HEIGHT:
-            scaled_width = -1
+        settings = self.get_scale_settings()
+        if prefs['cache']:
+            self._scaled_pixbufs.set_limit(
+                pixbufcache.get_limits(prefs['cache size'])[1])
         else:
-            scaled_width = area_width
-        if self.zoom_mode == preferences.ZOOM_MODE_WIDTH:
-            scaled_height = -1
-        else:
-            scaled_height = area_height
-        scale_up = prefs['stretch']
+            self._scaled_pixbufs.set_limit(0)
+        scaled_width = settings.width
+        scaled_height = settings.height
+        scale_up = settings.scale_up
         self.is_virtual_double_page = \
             self.file_handler.get_virtual_double_page()
         # TODO: If and when it becomes possible to resize (and do other things)
@@ -245,8 +247,12 @@ class MainWindow(Gtk.Window):
         #       correctly. All the conditionals about animated are part of this
         if self.displayed_double():
             left_pixbuf, right_pixbuf = self.file_handler.get_pixbufs()
+            left_path = self.file_handler.get_path_to_page()
+            right_path = self.file_handler.get_path_to_page(
+                self.file_handler.get_current_page() + 1)
             if self.is_manga_mode:
                 right_pixbuf, left_pixbuf = left_pixbuf, right_pixbuf
+                right_path, left_path = left_path, right_path
             # instead of modifying returns, just do two extra calls here
             left_animated = isinstance(left_pixbuf, GdkPixbuf.PixbufAnimation)
             right_animated = isinstance(right_pixbuf, GdkPixbuf.PixbufAnimation)
@@ -283,18 +289,36 @@ class MainWindow(Gtk.Window):
                 scaled_height = int(self._manual_zoom * total_height / 100)
                 scale_up = True
 
-            left_pixbuf, right_pixbuf = image.fit_2_in_rectangle(
-                    left_pixbuf, right_pixbuf, scaled_width, scaled_height,
-                    scale_up=scale_up, rotation1=left_rotation,
-                    rotation2=right_rotation, animated1=left_animated,
-                    animated2=right_animated)
+            key = _ScaledKey((left_path, right_path), scaled_width,
+                             scaled_height, scale_up,
+                             (left_rotation, right_rotation),
+                             settings.horizontal_flip, settings.vertical_flip,
+                             settings.enhancement, settings.checkered)
+            if (key, 0) in self._scaled_pixbufs and \
+                    (key, 1) in self._scaled_pixbufs:
+                left_pixbuf = self._scaled_pixbufs[(key, 0)]
+                right_pixbuf = self._scaled_pixbufs[(key, 1)]
+            else:
+                left_pixbuf, right_pixbuf = image.fit_2_in_rectangle(
+                        left_pixbuf, right_pixbuf, scaled_width, scaled_height,
+                        scale_up=scale_up, rotation1=left_rotation,
+                        rotation2=right_rotation, animated1=left_animated,
+                        animated2=right_animated)
+                if not left_animated and not right_animated:
+                    left_pixbuf = self.process_pixbuf(left_pixbuf, key)
+                    right_pixbuf = self.process_pixbuf(right_pixbuf, key)
+                    self._scaled_pixbufs[(key, 0)] = left_pixbuf
+                    self._scaled_pixbufs[(key, 1)] = right_pixbuf
+                elif not left_animated:
+                    left_pixbuf = self.process_pixbuf(left_pixbuf, key)
+                elif not right_animated:
+                    right_pixbuf = self.process_pixbuf(right_pixbuf, key)
+            self._scaled_pixbufs.pin([(key, 0), (key, 1)])
             if not left_animated:
-                pixb_process(left_pixbuf)
                 self.left_image.set_from_pixbuf(left_pixbuf)
             else:
                 self.left_image.set_from_animation(left_pixbuf)
             if not right_animated:
-                pixb_process(right_pixbuf)
                 self.right_image.set_from_pixbuf(right_pixbuf)
             else:
                 self.right_image.set_from_animation(right_pixbuf)
@@ -339,26 +363,19 @@ class MainWindow(Gtk.Window):
             unscaled_x = pixbuf.get_width()
             unscaled_y = pixbuf.get_height()
 
-            rotation = prefs['rotation']
-            if not animated and prefs['auto rotate from exif']:
-                rotation += image.get_implied_rotation(pixbuf)
-                rotation = rotation % 360
-
-            if self.zoom_mode == preferences.ZOOM_MODE_MANUAL:
-                if not animated:
-                    scaled_width = int(self._manual_zoom * unscaled_x / 100)
-                    scaled_height = int(self._manual_zoom * unscaled_y / 100)
-                    if rotation in (90, 270):
-                        scaled_width, scaled_height = scaled_height, scaled_width
-                scale_up = True
-
-            pixbuf = image.fit_in_rectangle(pixbuf, scaled_width,
-                                            scaled_height, scale_up=scale_up, rotation=rotation,
-                                            animated=animated)
             if not animated:
-                pixbuf = pixb_process(pixbuf)
+                key = self.get_scaled_key(self.file_handler.get_path_to_page(),
+                                          pixbuf, settings)
+                rotation = key.rotations[0]
+                if key in self._scaled_pixbufs:
+                    pixbuf = self._scaled_pixbufs[key]
+                else:
+                    pixbuf = self.scale_pixbuf(pixbuf, key)
+                    self._scaled_pixbufs[key] = pixbuf
+                self._scaled_pixbufs.pin([key])
                 self.left_image.set_from_pixbuf(pixbuf)
             else:
+                rotation = prefs['rotation']
                 self.left_image.set_from_animation(pixbuf)
 
             self.right_image.clear()
@@ -677,6 +694,7 @@ class MainWindow(Gtk.Window):
         """Clear the currently displayed data (i.e. "close" the file)."""
         self.left_image.clear()
         self.right_image.clear()
+        self._scaled_pixbufs.clear()
         self.thumbnailsidebar.clear()
         self.set_title('Comix')
         self.statusbar.set_message('')
@@ -689,6 +707,81 @@ class MainWindow(Gtk.Window):
                 self.file_handler.get_current_page() !=
                 self.file_handler.get_number_of_pages())
 
+    def get_scale_settings(self):
+        """Return a _ScaleSettings tuple with the current settings that
+        decide how a page is scaled and transformed for display.
+        """
+        area_width, area_height = self.get_visible_area_size()
+        if self.zoom_mode == preferences.ZOOM_MODE_HEIGHT:
+            width = -1
+        else:
+            width = area_width
+        if self.zoom_mode == preferences.ZOOM_MODE_WIDTH:
+            height = -1
+        else:
+            height = area_height
+        return _ScaleSettings(width, height, prefs['stretch'], self.zoom_mode,
+                              self._manual_zoom, prefs['rotation'],
+                              prefs['auto rotate from exif'],
+                              prefs['horizontal flip'], prefs['vertical flip'],
+                              self.enhancer.get_values(),
+                              prefs['checkered bg for transparent images'])
+
+    @staticmethod
+    def get_scaled_key(path, pixbuf, settings):
+        """Return the _ScaledKey for displaying the (non-animated) <pixbuf>
+        of the page at <path> alone, with the _ScaleSettings <settings>.
+        """
+        width = settings.width
+        height = settings.height
+        scale_up = settings.scale_up
+        rotation = settings.rotation
+        if settings.auto_rotate:
+            rotation += image.get_implied_rotation(pixbuf)
+            rotation = rotation % 360
+        if settings.zoom_mode == preferences.ZOOM_MODE_MANUAL:
+            width = int(settings.manual_zoom * pixbuf.get_width() / 100)
+            height = int(settings.manual_zoom * pixbuf.get_height() / 100)
+            if rotation in (90, 270):
+                width, height = height, width
+            scale_up = True
+        return _ScaledKey((path,), width, height, scale_up, (rotation,),
+                          settings.horizontal_flip, settings.vertical_flip,
+                          settings.enhancement, settings.checkered)
+
+    def scale_pixbuf(self, pixbuf, key):
+        """Return <pixbuf> scaled and transformed for display as a single
+        page, as described by the _ScaledKey <key>. This does not depend on
+        the state of the window and may be called from other threads.
+        """
+        pixbuf = image.fit_in_rectangle(pixbuf, key.width, key.height,
+                                        scale_up=key.scale_up,
+                                        rotation=key.rotations[0])
+        return self.process_pixbuf(pixbuf, key)
+
+    def process_pixbuf(self, pixbuf, key):
+        """Return the already scaled <pixbuf> flipped and enhanced as
+        described by the _ScaledKey <key>.
+        """
+        if key.horizontal_flip:
+            pixbuf = pixbuf.flip(horizontal=True)
+        if key.vertical_flip:
+            pixbuf = pixbuf.flip(horizontal=False)
+        return self.enhancer.enhance(pixbuf, key.enhancement)
+
+    def has_scaled_pixbuf(self, key):
+        """Return True if there is a pixbuf for <key> in the cache of
+        scaled pixbufs.
+        """
+        return key in self._scaled_pixbufs
+
+    def add_scaled_pixbuf(self, key, pixbuf):
+        """Put <pixbuf>, scaled as described by <key>, in the cache of
+        scaled pixbufs.
+        """
+        if key not in self._scaled_pixbufs:
+            self._scaled_pixbufs[key] = pixbuf
+
     def get_visible_area_size(self):
         """Return a 2-tuple with the width and height of the visible part
         of the main layout area.
@@ -805,12 +898,14 @@ class MainWindow(Gtk.Window):
             prefs['path to last file'] = ''
             prefs['page of last file'] = 1
         self.file_handler.cleanup()
+        self.thumbnailsidebar.clear()
         preferences.write_preferences_file()
         self.ui_manager.bookmarks.write_bookmarks_file()
         # This hack is to avoid Python issue #1856. # Fixed in 3.2+
         for thread in threading.enumerate():
             if thread is not threading.currentThread():
                 thread.join()
+        thumbnail.write_index()
         print('Bye!')
         sys.exit(0)
 
@@ -835,7 +930,7 @@ class MainWindow(Gtk.Window):
                     prefs['last path in save filechooser'])
 
         if save_dialog.run() == Gtk.ResponseType.ACCEPT and save_dialog.get_filename():
-            shutil.copy(self.file_handler.get_path_to_page(),
+            shutil.copy(self.file_handler.extract_page(),
                         save_dialog.get_filename().decode('utf-8'))
             prefs['last path in save filechooser'] = \
                 save_dialog.get_current_folder()
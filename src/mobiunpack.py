@@ -2,10 +2,14 @@
 """mobiunpack.py - MobiPocket handling (extract pictures) for Comix.
 
 Based on code from mobiunpack by Charles M. Hannum et al.
+
+The file is memory mapped, sections are returned as memoryview slices of
+the mapping so that reading an image does not copy it.
 """
 from __future__ import absolute_import
 
 import imghdr
+import mmap
 import re
 import struct
 
@@ -16,35 +20,45 @@ try:
 except NameError:
     pass
 
+# Only the start of a section is needed to tell the image type.
+_HEADER_SIZE = 32
+
 
 class unpackException(Exception):
     pass
 
 
 class Sectionizer(object):
-    def __init__(self, f):
-        self.f = f
-        header = self.f.read(78)
-        self.ident = header[0x3C:0x3C + 8]
-        self.num_sections, = struct.unpack_from('>H', header, 76)
-        sections = self.f.read(self.num_sections * 8)
-        self.sections = struct.unpack_from('>{}L'.format(self.num_sections * 2), sections, 0)[::2] + (0x7fffffff,)
+    def __init__(self, data):
+        self.data = data
+        if len(data) < 78:
+            raise unpackException('invalid file format')
+        self.ident = bytes(data[0x3C:0x3C + 8])
+        self.num_sections, = struct.unpack_from('>H', data, 76)
+        if len(data) < 78 + self.num_sections * 8:
+            raise unpackException('invalid file format')
+        self.sections = struct.unpack_from('>{}L'.format(self.num_sections * 2), data, 78)[::2] + (len(data),)
 
     def loadSection(self, section, limit=0x7fffffff):
         before, after = self.sections[section:section + 2]
-        self.f.seek(before)
-        if limit > after - before:
-            limit = after - before
-        return self.f.read(limit)
+        after = min(after, before + limit, len(self.data))
+        return self.data[before:max(before, after)]
 
 
 class MobiFile(object):
     def __init__(self, filename):
-        f = open(filename, 'rb')
+        self._mmap = None
+        self._data = None
+        self._names = None
+        with open(filename, 'rb') as f:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError) as e:
+                raise unpackException('could not map file: {}'.format(e))
         try:
-            self.file = f
-            self.sect = Sectionizer(self.file)
-            if self.sect.ident != 'BOOKMOBI':
+            self._data = memoryview(self._mmap)
+            self.sect = Sectionizer(self._data)
+            if self.sect.ident != b'BOOKMOBI':
                 raise unpackException('invalid file format')
 
             self.header = self.sect.loadSection(0)
@@ -53,28 +67,50 @@ class MobiFile(object):
                 raise unpackException('file is encrypted')
             self.firstimg, = struct.unpack_from('>L', self.header, 0x6C)
         except:
-            self.file = None
-            f.close()
+            self.close()
             raise
 
     def getnames(self):
-        names = []
-        for i in range(self.firstimg, self.sect.num_sections):
-            header = self.sect.loadSection(i, 32)
-            imgtype = imghdr.what(None, header)
-            if imgtype is not None:
-                names.append("image{:05d}.{}".format(1 + i - self.firstimg, imgtype))
-        return names
+        if self._names is None:
+            names = []
+            for i in range(self.firstimg, self.sect.num_sections):
+                header = bytes(self.sect.loadSection(i, _HEADER_SIZE))
+                imgtype = imghdr.what(None, header)
+                if imgtype is not None:
+                    names.append("image{:05d}.{}".format(1 + i - self.firstimg, imgtype))
+            self._names = names
+        return list(self._names)
 
-    def extract(self, name, dst):
+    def read(self, name):
+        """Return the contents of the image <name> as a memoryview, valid
+        until close() is called.
+        """
         fnparts = re.split('^image([0-9]*)\.', name)
         if len(fnparts) != 3:
-            return
+            raise unpackException('invalid image name {}'.format(name))
         i = int(fnparts[1]) - 1 + self.firstimg
-        data = self.sect.loadSection(i)
-        f = open(dst, 'wb')
-        f.write(data)
-        f.close()
+        if not self.firstimg <= i < self.sect.num_sections:
+            raise unpackException('invalid image name {}'.format(name))
+        return self.sect.loadSection(i)
+
+    def extract(self, name, dst):
+        try:
+            data = self.read(name)
+        except unpackException:
+            return
+        with open(dst, 'wb') as f:
+            f.write(data)
 
     def close(self):
-        self.file.close()
+        self.header = None
+        if self._data is not None:
+            self._data.release()
+            self._data = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Slices returned by read() are still in use, the mapping
+                # goes away together with the last of them.
+                pass
+            self._mmap = None
@@ -0,0 +1,98 @@
+# coding=utf-8
+"""pixbufcache.py - Memory bounded cache for decoded pixbufs."""
+from __future__ import absolute_import
+
+from collections import OrderedDict
+
+
+def get_pixbuf_size(pixbuf):
+    """Return the number of bytes used by the pixel data of <pixbuf>."""
+    try:
+        return pixbuf.get_rowstride() * pixbuf.get_height()
+    except AttributeError:  # PixbufAnimation, count a single frame.
+        return pixbuf.get_width() * pixbuf.get_height() * 4
+
+
+def get_limits(cache_size):
+    """Return a tuple (decoded, scaled) with the limits in bytes of the
+    caches of decoded pages and of pages scaled for display, which share
+    the <cache_size> MiB of the 'cache size' preference.
+    """
+    total = cache_size * 1024 * 1024
+    scaled = total // 4
+    return total - scaled, scaled
+
+
+class PixbufCache(object):
+    """Least recently used cache of pixbufs, bounded by the total size of
+    their pixel data. Keys that are pinned with pin() are never evicted,
+    so the pages that are currently needed stay in memory even if they
+    alone exceed the limit.
+    """
+
+    def __init__(self, limit=0):
+        self._pixbufs = OrderedDict()
+        self._sizes = {}
+        self._pinned = set()
+        self._size = 0
+        self._limit = limit
+
+    def __contains__(self, key):
+        return key in self._pixbufs
+
+    def __len__(self):
+        return len(self._pixbufs)
+
+    def __iter__(self):
+        return iter(list(self._pixbufs))
+
+    def __getitem__(self, key):
+        pixbuf = self._pixbufs.pop(key)
+        self._pixbufs[key] = pixbuf
+        return pixbuf
+
+    def __setitem__(self, key, pixbuf):
+        if key in self._pixbufs:
+            del self[key]
+        size = get_pixbuf_size(pixbuf)
+        self._pixbufs[key] = pixbuf
+        self._sizes[key] = size
+        self._size += size
+        self._evict()
+
+    def __delitem__(self, key):
+        del self._pixbufs[key]
+        self._size -= self._sizes.pop(key)
+
+    def get_size(self):
+        """Return the number of bytes currently used by the cache."""
+        return self._size
+
+    def set_limit(self, limit):
+        """Set the maximum number of bytes used by the cache to <limit>."""
+        self._limit = limit
+        self._evict()
+
+    def pin(self, keys):
+        """Protect the pixbufs for <keys> (and only those) from eviction."""
+        self._pinned = set(keys)
+        self._evict()
+
+    def clear(self):
+        """Remove all pixbufs from the cache."""
+        self._pixbufs.clear()
+        self._sizes.clear()
+        self._pinned = set()
+        self._size = 0
+
+    def _evict(self):
+        """Remove the least recently used pixbufs that are not pinned
+        until the cache is within its limit.
+        """
+        if self._size <= self._limit:
+            return
+        for key in list(self._pixbufs):
+            if key not in self._pinned:
+                del self[key]
+                if self._size <= self._limit:
+                    break
@@ -26,6 +26,7 @@ prefs = {
     'bg colour': (5000, 5000, 5000),
     'checkered bg for transparent images': True,
     'cache': True,
+    'cache size': 256,
     'animate gifs': False,
     'animate': False,
     'stretch': False,
@@ -233,6 +234,14 @@ class _PreferencesDialog(Gtk.Dialog):
                                         'that you have this preference set, unless you are '
                                         'running short on free RAM.'))
         page.add_row(cache_button)
+        label = Gtk.Label(label='{}:'.format(_('Cache size (in MiB)')))
+        adjustment = Gtk.Adjustment(prefs['cache size'], 16, 16384, 16, 128)
+        cache_size_spinner = Gtk.SpinButton.new(adjustment, climb_rate=1, digits=0)
+        cache_size_spinner.connect('value_changed', self._spinner_cb, 'cache size')
+        cache_size_spinner.set_tooltip_text(_('The maximum amount of memory used for '
+                                              'cached images. Recently viewed pages are '
+                                              'kept in memory until this limit is reached.'))
+        page.add_row(label, cache_size_spinner)
 
         page.new_section(_('Image Animation'))
         gif_button = Gtk.CheckButton(_('Play GIF image animations.'))
@@ -343,6 +352,8 @@ class _PreferencesDialog(Gtk.Dialog):
         elif preference == 'slideshow delay':
             prefs[preference] = int(value * 1000)
             self._window.slideshow.update_delay()
+        elif preference == 'cache size':
+            prefs[preference] = int(value)
         elif preference == 'thumbnail size':
             prefs[preference] = int(value)
             self._window.thumbnailsidebar.resize()
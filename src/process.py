@@ -52,3 +52,11 @@ class Process(object):
         if self._proc is None:
             raise Exception('Process not spawned.')
         return self._proc.wait()
+
+    def terminate(self):
+        """Ask the process to terminate, if it is running."""
+        if self._proc is not None and self._proc.poll() is None:
+            try:
+                self._proc.terminate()
+            except OSError:
+                pass
@@ -13,6 +13,7 @@ from src import archive
 from src import encoding
 from src import image
 from src import labels
+from src.preferences import prefs
 
 try:
     # noinspection PyUnresolvedReferences
@@ -144,7 +145,11 @@ class _PropertiesDialog(Gtk.Dialog):
         # ----------------------------------------------------------------
         path = window.file_handler.get_path_to_page()
         page = _Page()
-        thumb = window.file_handler.get_thumbnail(width=200, height=128)
+        # Pages of archives are extracted to a temporary directory, only
+        # store thumbnails for real files.
+        create = window.file_handler.archive_type is None and prefs['create thumbnails']
+        thumb = window.file_handler.get_thumbnail(width=200, height=128,
+                                                  create=create)
         page.set_thumbnail(thumb)
         filename = os.path.basename(path)
         page.set_filename(filename)
@@ -0,0 +1,265 @@
+# coding=utf-8
+"""seekable.py - Random access to gzip and bzip2 compressed files.
+
+Compressed streams can normally only be read from the start. To seek in
+them we keep an index of checkpoints, positions in the compressed file
+from where decompression can be resumed, recorded the first time the
+file is read through. Seeking then only needs to decompress the data
+between the closest checkpoint and the wanted position.
+
+For gzip files a checkpoint is a copy of the decompressor state, taken
+every _CHECKPOINT_SPACING bytes of output. The blocks of bzip2 streams
+are not byte aligned, so for bzip2 files checkpoints are only possible
+at the start of each stream. Files from parallel compressors such as
+pbzip2 have many small streams, files from bzip2 itself have only one.
+
+The indexes are kept in memory, shared between all open files for the
+same path, for as long as the file is unchanged. Only one file at a time
+decodes the part beyond the last checkpoint, the others wait for it and
+then continue from the checkpoints it has added.
+"""
+from __future__ import absolute_import
+
+import bisect
+import bz2
+import os
+import sys
+import threading
+import zlib
+
+GZIP, BZIP2 = range(2)
+
+_CHECKPOINT_SPACING = 4 * 1024 * 1024
+_READ_SIZE = 64 * 1024
+_MAX_INDEXES = 4
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+class SeekableFile(object):
+    """A read-only file object for the decompressed contents of the gzip
+    or bzip2 (as given by <kind>) compressed file at <path>, that supports
+    seeking.
+    """
+
+    def __init__(self, path, kind):
+        self._file = open(path, 'rb')
+        self._kind = kind
+        self._index = _get_index(path)
+        self._pos = 0
+        self._buffer = bytearray()
+        self._buffer_pos = 0
+        self._in_pos = 0
+        self._eof = False
+        self._decompressor = None
+        self.closed = False
+
+    def read(self, size=-1):
+        """Return at most <size> bytes from the current position, or
+        everything up to the end if <size> is negative or None.
+        """
+        if size is None:
+            size = -1
+        end = sys.maxsize if size < 0 else self._pos + size
+        if self._index.covers(end):
+            return self._read(size)
+        with self._index.extending:
+            return self._read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Move the current position to <offset>, relative to <whence>,
+        and return the new position.
+        """
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._get_size()
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def tell(self):
+        """Return the current position in the decompressed data."""
+        return self._pos
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def close(self):
+        """Close the underlying compressed file."""
+        self._file.close()
+        self._buffer = bytearray()
+        self._decompressor = None
+        self.closed = True
+
+    def _read(self, size):
+        """Return at most <size> bytes from the current position, see
+        read().
+        """
+        self._prepare_decoding()
+        while not self._eof and \
+                (size < 0 or self._buffer_pos + len(self._buffer) < self._pos + size):
+            self._decode_chunk()
+        start = self._pos - self._buffer_pos
+        end = len(self._buffer) if size < 0 else start + size
+        with memoryview(self._buffer) as view:
+            data = bytes(view[start:end])
+        self._pos += len(data)
+        return data
+
+    def _get_size(self):
+        """Return the size of the decompressed data. If it is not known
+        yet, the rest of the file is decoded without keeping the output,
+        recording checkpoints on the way.
+        """
+        size = self._index.get_size()
+        if size is None:
+            pos = self._pos
+            self._pos = sys.maxsize
+            with self._index.extending:
+                self._prepare_decoding()
+                while not self._eof:
+                    self._decode_chunk()
+            self._pos = pos
+            size = self._index.get_size()
+        return size
+
+    def _new_decompressor(self):
+        if self._kind == GZIP:
+            return zlib.decompressobj(31)
+        return bz2.BZ2Decompressor()
+
+    def _prepare_decoding(self):
+        """Make sure that decoding forwards from where the decompressor
+        currently is will reach the current position, restarting from
+        the closest checkpoint if that is faster or if we have to go back.
+        """
+        decoded_end = self._buffer_pos + len(self._buffer)
+        checkpoint = self._index.find(self._pos)
+        if self._decompressor is None or self._pos < self._buffer_pos or \
+                checkpoint[0] > decoded_end:
+            out_pos, in_pos, state = checkpoint
+            if state is None:
+                self._decompressor = self._new_decompressor()
+            else:
+                self._decompressor = state.copy()
+            self._file.seek(in_pos)
+            self._in_pos = in_pos
+            self._buffer = bytearray()
+            self._buffer_pos = out_pos
+            self._eof = False
+        elif self._buffer_pos < self._pos:
+            # Don't keep data we have passed already.
+            drop = min(self._pos, decoded_end) - self._buffer_pos
+            del self._buffer[:drop]
+            self._buffer_pos += drop
+
+    def _decode_chunk(self):
+        """Decompress another chunk of the file into the buffer, and
+        record checkpoints while doing so.
+        """
+        data = self._file.read(_READ_SIZE)
+        if not data:
+            self._eof = True
+            self._index.set_size(self._buffer_pos + len(self._buffer))
+            return
+        self._in_pos += len(data)
+        out_pos = self._buffer_pos + len(self._buffer)
+        output = []
+        try:
+            while data:
+                chunk = self._decompressor.decompress(data)
+                output.append(chunk)
+                out_pos += len(chunk)
+                data = b''
+                if self._decompressor.eof:
+                    # Concatenated streams (or gzip members).
+                    data = self._decompressor.unused_data
+                    self._decompressor = self._new_decompressor()
+                    if self._kind == BZIP2:
+                        self._index.add(out_pos, self._in_pos - len(data), None)
+        except (zlib.error, IOError, EOFError):
+            # Trailing garbage after the last stream.
+            self._eof = True
+        if self._kind == GZIP and not self._eof:
+            self._index.add(out_pos, self._in_pos, self._decompressor,
+                            _CHECKPOINT_SPACING)
+        decoded_end = self._buffer_pos + len(self._buffer) + sum(map(len, output))
+        if decoded_end < self._pos:
+            # While skipping forwards we only need the data from the
+            # current position on.
+            self._buffer_pos = decoded_end
+            del self._buffer[:]
+        else:
+            for chunk in output:
+                self._buffer += chunk
+        if self._eof:
+            self._index.set_size(self._buffer_pos + len(self._buffer))
+
+
+class _Index(object):
+    """The checkpoints of a compressed file, as a sorted list of tuples
+    (uncompressed offset, compressed offset, decompressor state). The state
+    is None where a new decompressor should be used.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checkpoints = [(0, 0, None)]
+        self._offsets = [0]
+        self._size = None
+        self.extending = threading.Lock()
+
+    def covers(self, offset):
+        """Return True if the uncompressed <offset> is within the part
+        of the file that is already indexed.
+        """
+        with self._lock:
+            if self._size is not None:
+                return True
+            return offset <= self._offsets[-1]
+
+    def get_size(self):
+        """Return the size of the uncompressed data, or None if the
+        end of the file has not been reached yet.
+        """
+        return self._size
+
+    def set_size(self, size):
+        """Record the <size> of the uncompressed data."""
+        with self._lock:
+            self._size = size
+
+    def find(self, offset):
+        """Return the last checkpoint at or before the uncompressed
+        <offset>.
+        """
+        with self._lock:
+            return self._checkpoints[bisect.bisect_right(self._offsets, offset) - 1]
+
+    def add(self, out_pos, in_pos, state, spacing=0):
+        """Add a checkpoint at <out_pos> if it is at least <spacing> bytes
+        beyond the last one. A copy is stored of a decompressor <state>.
+        """
+        with self._lock:
+            if out_pos < self._offsets[-1] + max(spacing, 1):
+                return
+            if state is not None:
+                state = state.copy()
+            self._checkpoints.append((out_pos, in_pos, state))
+            self._offsets.append(out_pos)
+
+
+def _get_index(path):
+    """Return the shared _Index for the compressed file at <path>."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    with _indexes_lock:
+        if key not in _indexes:
+            if len(_indexes) >= _MAX_INDEXES:
+                del _indexes[next(iter(_indexes))]
+            _indexes[key] = _Index()
+        return _indexes[key]
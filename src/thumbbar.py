@@ -2,6 +2,9 @@
 """thumbbar.py - Thumbnail sidebar for main window."""
 from __future__ import absolute_import
 
+import os
+import threading
+
 try:
     from urllib import pathname2url  # Py2
 except ImportError:
@@ -26,6 +29,9 @@ try:
 except NameError:
     pass
 
+# The largest number of threads that create thumbnails for the sidebar.
+_MAX_THREADS = 8
+
 
 class ThumbnailSidebar(Gtk.HBox):
     """A thumbnail sidebar including scrollbar for the main window."""
@@ -36,7 +42,17 @@ class ThumbnailSidebar(Gtk.HBox):
         self._loaded = False
         self._load_task = None
         self._height = 0
-        self._stop_update = False
+        self._placeholder = None
+        # Thumbnails are made in threads, see _thread_load(). The pages
+        # that are waited for are sorted so that the visible ones go first.
+        self._condition = threading.Condition()
+        self._generation = 0
+        self._wanted = []
+        self._finished = []
+        self._threads = 0
+        self._flush_pending = False
+        self._create = False
+        self._size = prefs['thumbnail size']
 
         self._liststore = Gtk.ListStore(GdkPixbuf.Pixbuf)
         self._treeview = Gtk.TreeView(self._liststore)
@@ -69,6 +85,7 @@ class ThumbnailSidebar(Gtk.HBox):
         self._treeview.connect('drag_data_get', self._drag_data_get)
         self._selection.connect('changed', self._selection_event)
         self._layout.connect('scroll_event', self._scroll_event)
+        self._vadjust.connect('value_changed', self._sort_wanted)
 
     def get_width(self):
         """Return the width in pixels of the ThumbnailSidebar."""
@@ -85,7 +102,14 @@ class ThumbnailSidebar(Gtk.HBox):
         self._layout.set_size(0, 0)
         self._height = 0
         self._loaded = False
-        self._stop_update = True
+        if self._load_task is not None:
+            GObject.source_remove(self._load_task)
+            self._load_task = None
+        with self._condition:
+            self._generation += 1
+            self._wanted = []
+            self._finished = []
+        self._window.file_handler.notify_page_waiters()
 
     def resize(self):
         """Reload the thumbnails with the size specified by in the
@@ -126,25 +150,141 @@ class ThumbnailSidebar(Gtk.HBox):
             self._vadjust.set_value(value)
 
     def _load(self):
+        """Fill the sidebar with placeholders for all pages, and start
+        making their thumbnails in the background.
+        """
+        self._load_task = None
         if self._window.file_handler.archive_type is not None:
             create = False
         else:
             create = prefs['create thumbnails']
-        self._stop_update = False
-        for i in range(1, self._window.file_handler.get_number_of_pages() + 1):
-            pixbuf = self._window.file_handler.get_thumbnail(i, prefs['thumbnail size'], prefs['thumbnail size'], create)
-            if prefs['show page numbers on thumbnails']:
-                _add_page_number(pixbuf, i)
-            pixbuf = image.add_border(pixbuf, 1)
-            self._liststore.append([pixbuf])
-            while Gtk.events_pending():
-                Gtk.main_iteration()
-            if self._stop_update:
-                return
-            self._height += self._treeview.get_background_area(Gtk.TreePath(i - 1), self._column).height
-            self._layout.set_size(0, self._height)
-        self._stop_update = True
+        size = prefs['thumbnail size']
+        placeholder = GdkPixbuf.Pixbuf.new(colorspace=GdkPixbuf.Colorspace.RGB,
+                                           has_alpha=True, bits_per_sample=8,
+                                           width=max(size * 2 // 3, 1), height=size)
+        placeholder.fill(0x00000000)
+        self._placeholder = image.add_border(placeholder, 1)
+        num_pages = self._window.file_handler.get_number_of_pages()
+        self._treeview.set_model(None)
+        for i in range(num_pages):
+            self._liststore.append([self._placeholder])
+        self._treeview.set_model(self._liststore)
+        self._update_height()
+        with self._condition:
+            self._create = create
+            self._size = size
+            self._wanted = list(range(1, num_pages + 1))
+            self._finished = []
+            self._sort_wanted()
+            for i in range(self._threads, min(_MAX_THREADS, os.cpu_count() or 1)):
+                self._threads += 1
+                thread = threading.Thread(target=self._thread_load)
+                thread.setDaemon(False)
+                thread.start()
         self.update_select()
+        return False
+
+    # noinspection PyUnusedLocal
+    def _sort_wanted(self, *args):
+        """Order the pages whose thumbnails are still to be made so that
+        the visible ones come first, followed by those closest to them.
+        """
+        if not self._wanted or self._height <= 0:
+            return
+        first = self._treeview.get_path_at_pos(0, int(self._vadjust.get_value()))
+        last = self._treeview.get_path_at_pos(
+                0, int(self._vadjust.get_value() + self._vadjust.get_page_size()) - 1)
+        first = first[0].get_indices()[0] + 1 if first is not None else 1
+        last = last[0].get_indices()[0] + 1 if last is not None else len(self._liststore)
+
+        def distance(page):
+            if page < first:
+                return first - page
+            return max(page - last, 0)
+
+        with self._condition:
+            self._wanted.sort(key=distance)
+
+    def _thread_load(self):
+        """Make the wanted thumbnails until there are no more, and hand
+        them over to _flush() in batches. Pages that have been extracted
+        go first, if there are none the thread waits on the extractor.
+        """
+        file_handler = self._window.file_handler
+        while True:
+            with self._condition:
+                if not self._wanted:
+                    self._threads -= 1
+                    break
+                generation = self._generation
+                size = self._size
+                create = self._create
+                for i, page in enumerate(self._wanted):
+                    if file_handler.is_page_ready(page):
+                        del self._wanted[i]
+                        break
+                else:
+                    page = None
+                    pages = self._wanted[:]
+            if page is None:
+                if not file_handler.wait_on_pages(
+                        pages, lambda: generation == self._generation):
+                    with self._condition:
+                        # The extractor was stopped, these pages won't
+                        # be ready anymore.
+                        if generation == self._generation:
+                            self._wanted = []
+                continue
+            pixbuf = file_handler.decode_thumbnail(page, size, size, create)
+            if pixbuf is not None:
+                pixbuf = self._decorate(pixbuf, page)
+            with self._condition:
+                if generation != self._generation:
+                    continue
+                self._finished.append((page, pixbuf))
+                if not self._flush_pending:
+                    self._flush_pending = True
+                    GObject.idle_add(self._flush)
+        # Every _load() starts new threads, their archive handles would
+        # otherwise stay open until the archive is closed.
+        file_handler.close_thread_handle()
+
+    def _flush(self):
+        """Put the thumbnails made since the last call into the sidebar."""
+        with self._condition:
+            finished = self._finished
+            self._finished = []
+            self._flush_pending = False
+        for page, pixbuf in finished:
+            if page > len(self._liststore):
+                continue
+            if pixbuf is None:
+                missing = self._window.render_icon(Gtk.STOCK_MISSING_IMAGE,
+                                                   Gtk.IconSize.DIALOG)
+                pixbuf = self._decorate(image.fit_in_rectangle(
+                        missing, self._size, self._size), page)
+            self._liststore[page - 1][0] = pixbuf
+        if finished:
+            self._update_height()
+        return False
+
+    def _decorate(self, pixbuf, page):
+        """Return the thumbnail <pixbuf> of <page> as it is shown in the
+        sidebar, with a border and maybe a page number.
+        """
+        if prefs['show page numbers on thumbnails']:
+            _add_page_number(pixbuf, page)
+        return image.add_border(pixbuf, 1)
+
+    def _update_height(self):
+        """Make the layout as high as all the thumbnails together."""
+        if len(self._liststore) == 0:
+            self._height = 0
+        else:
+            rect = self._treeview.get_background_area(
+                    Gtk.TreePath(len(self._liststore) - 1), self._column)
+            self._height = rect.y + rect.height
+        self._layout.set_size(0, self._height)
 
     def _get_selected_row(self):
         """Return the index of the currently selected row."""
@@ -176,7 +316,7 @@ class ThumbnailSidebar(Gtk.HBox):
         the file can be copied (e.g. to a file manager).
         """
         selected = self._get_selected_row()
-        path = self._window.file_handler.get_path_to_page(selected + 1)
+        path = self._window.file_handler.extract_page(selected + 1)
         uri = 'file://localhost' + pathname2url(path)
         selection.set_uris([uri])
 
@@ -2,31 +2,47 @@
 """thumbnail.py - Thumbnail module for Comix implementing (most of) the
 freedesktop.org "standard" at http://jens.triq.net/thumbnail-spec/
 
-Only normal size (i.e. 128x128 px) thumbnails are supported.
+Normal (128x128 px) and large (256x256 px) thumbnails are supported, and
+files that no thumbnail can be made for are recorded in fail/comix/.
 """
 from __future__ import absolute_import, division
 
 import os
+import pickle
 import re
 import shutil
 import tempfile
+import threading
+from collections import OrderedDict
 from hashlib import md5
 try:
     from urllib import pathname2url  # Py2
 except ImportError:
     from urllib.request import pathname2url  # Py3
 
-from PIL import Image
 from gi.repository import GdkPixbuf
 
 from src import archive
 from src import constants
-from src.image import get_supported_format_extensions_preg, pil_to_pixbuf
-
-_thumbdir = os.path.join(constants.HOME_DIR, '.thumbnails/normal')
-
-
-def get_thumbnail(path, create=True, dst_dir=_thumbdir):
+from src import image
+from src.image import get_supported_format_extensions_preg
+
+_thumbdir = os.path.join(constants.HOME_DIR, '.thumbnails')
+# The sizes of thumbnails, with the subdirectories they are stored in.
+_TIERS = (('normal', 128), ('large', 256))
+_FAIL_DIR = os.path.join('fail', 'comix')
+_index_path = os.path.join(constants.DATA_DIR, 'thumbnail_index.pickle')
+_index = None
+_index_changed = False
+_index_lock = threading.Lock()
+# The index only remembers this many of the most recently stored thumbnails.
+_MAX_INDEX_ENTRIES = 100000
+# Changes to the index to be passed on to another process, or None if
+# they are not tracked, see track_index_updates().
+_index_updates = None
+
+
+def get_thumbnail(path, create=True, dst_dir=_thumbdir, size=128):
     """Return a thumbnail pixbuf for the file at <path> by looking in the
     directory of stored thumbnails. If a thumbnail for the file doesn't
     exist we create a thumbnail pixbuf from the original. If <create>
@@ -39,62 +55,171 @@ def get_thumbnail(path, create=True, dst_dir=_thumbdir):
     if <create> is False, since re-creating the thumbnail on the fly each
     time would be too costly.
 
+    The thumbnail is taken from the smallest size (normal or large) that
+    is at least <size> px, or from large thumbnails if <size> is larger
+    than that, so it may have to be scaled down further. A stored thumbnail
+    of a larger size is used if there is none of that size yet. Files that
+    were read but could not be decoded, when <create> was True, are not
+    tried again until they change. Files that could not be read at all
+    (e.g. locked, or archives without an extractor) are tried next time.
+
     If <dst_dir> is set it is the base thumbnail directory, if not we use
-    the default .thumbnails/normal/.
+    the default .thumbnails/.
     """
-    thumbpath = _path_to_thumbpath(path, dst_dir)
-    if not os.path.exists(thumbpath):
-        return _get_new_thumbnail(path, create, dst_dir)
     try:
-        info = Image.open(thumbpath).info
-        try:
-            mtime = int(info['Thumb::MTime'])
-        except Exception as e:
-            mtime = -1
-            raise e
-        if os.stat(path).st_mtime != mtime:
-            return _get_new_thumbnail(path, create, dst_dir)
-        return GdkPixbuf.Pixbuf.new_from_file(thumbpath)
-    except Exception as e:
-        raise e
+        stat = os.stat(path)
+    except OSError:
+        return None
+    tiers = [tier for tier, tier_size in _TIERS if tier_size >= size]
+    if not tiers:
+        tiers = [_TIERS[-1][0]]
+    for tier in tiers:
+        pixbuf = _load_stored_thumbnail(_path_to_thumbpath(path, dst_dir, tier), stat)
+        if pixbuf is not None:
+            return pixbuf
+    failpath = _path_to_thumbpath(path, dst_dir, _FAIL_DIR)
+    if _load_stored_thumbnail(failpath, stat) is not None:
+        return None
+    try:
+        pixbuf = _get_new_thumbnail(path, create, dst_dir, tiers[0])
+    except Exception:
+        print('! Could not create thumbnail for {}'.format(path))
         return None
+    if pixbuf is None and create:
+        _create_failed_thumbnail(path, failpath, stat)
+    return pixbuf
 
 
 def delete_thumbnail(path, dst_dir=_thumbdir):
-    """Delete the thumbnail (if it exists) for the file at <path>.
+    """Delete the thumbnails (if they exist) of all sizes, and the record
+    of a failed thumbnail, for the file at <path>.
 
     If <dst_dir> is set it is the base thumbnail directory, if not we use
-    the default .thumbnails/normal/.
+    the default .thumbnails/.
+    """
+    for tier in [tier for tier, tier_size in _TIERS] + [_FAIL_DIR]:
+        thumbpath = _path_to_thumbpath(path, dst_dir, tier)
+        _forget_thumbnail(thumbpath)
+        if os.path.isfile(thumbpath):
+            try:
+                os.remove(thumbpath)
+            except Exception:
+                pass
+
+
+def write_index():
+    """Store the thumbnail index in the data directory, if it has
+    changed.
     """
-    thumbpath = _path_to_thumbpath(path, dst_dir)
-    if os.path.isfile(thumbpath):
+    global _index_changed
+    with _index_lock:
+        if not _index_changed:
+            return
         try:
-            os.remove(thumbpath)
+            fd = open(_index_path, 'wb')
+            pickle.dump(constants.VERSION, fd, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(_index, fd, pickle.HIGHEST_PROTOCOL)
+            fd.close()
         except Exception:
-            pass
+            print('! thumbnail.py: Could not write {}'.format(_index_path))
+            return
+        _index_changed = False
+
+
+def track_index_updates():
+    """Start keeping track of the changes to the thumbnail index, for
+    processes that make thumbnails for another one (which writes the
+    index), see take_index_updates().
+    """
+    global _index_updates
+    with _index_lock:
+        _index_updates = {}
+
+
+def take_index_updates():
+    """Return the changes to the thumbnail index since the last call,
+    as a dictionary for update_index(), and forget about them.
+    """
+    global _index_updates
+    with _index_lock:
+        updates = _index_updates or {}
+        if _index_updates is not None:
+            _index_updates = {}
+        return updates
 
 
-def _get_new_thumbnail(path, create, dst_dir):
-    """Return a new thumbnail pixbuf for the file at <path>. If <create> is
-    True we also save it to disk with <dst_dir> as the base thumbnail
-    directory.
+def update_index(updates):
+    """Apply the changes <updates> to the thumbnail index, as returned
+    by take_index_updates() in another process.
+    """
+    for thumbpath, info in updates.items():
+        if info is None:
+            _forget_thumbnail(thumbpath)
+        else:
+            _remember_thumbnail(thumbpath, info)
+
+
+def _load_stored_thumbnail(thumbpath, stat):
+    """Return a pixbuf of the stored thumbnail at <thumbpath>, or None if
+    there is none or it is outdated for an original with the stat object
+    <stat>. Whether it is up to date is looked up in the thumbnail index,
+    so a known thumbnail is only read once, to load it.
+    """
+    with _index_lock:
+        info = _get_index().get(thumbpath)
+    if info is not None and not _is_valid(info, stat):
+        return None
+    try:
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file(thumbpath)
+    except Exception:
+        if info is not None:
+            _forget_thumbnail(thumbpath)
+        return None
+    if info is None:
+        info = (_get_int_option(pixbuf, 'tEXt::Thumb::MTime'),
+                _get_int_option(pixbuf, 'tEXt::Thumb::Size'))
+        _remember_thumbnail(thumbpath, info)
+        if not _is_valid(info, stat):
+            return None
+    return pixbuf
+
+
+def _get_new_thumbnail(path, create, dst_dir, tier):
+    """Return a new thumbnail pixbuf of size <tier> for the file at
+    <path>. If <create> is True we also save it to disk with <dst_dir> as
+    the base thumbnail directory. Return None if the file can not be
+    decoded, raise an exception if it can not be read.
     """
     if archive.archive_mime_type(path) is not None:
         if create:
-            return _get_new_archive_thumbnail(path, dst_dir)
+            return _get_new_archive_thumbnail(path, dst_dir, tier)
         return None
     if create:
-        return _create_thumbnail(path, dst_dir)
-    return _get_pixbuf128(path)
+        return _create_thumbnail(path, dst_dir, tier)
+    return _get_scaled_pixbuf(path, dict(_TIERS)[tier])
 
 
-def _get_new_archive_thumbnail(path, dst_dir):
-    """Return a new thumbnail pixbuf for the archive at <path>, and save it
-    to disk; <dst_dir> is the base thumbnail directory.
+def _get_new_archive_thumbnail(path, dst_dir, tier):
+    """Return a new thumbnail pixbuf of size <tier> for the archive at
+    <path>, and save it to disk; <dst_dir> is the base thumbnail directory.
     """
     extractor = archive.Extractor()
     tmpdir = tempfile.mkdtemp(prefix='comix_archive_thumb.')
+    try:
+        return _extract_archive_thumbnail(extractor, path, dst_dir, tier, tmpdir)
+    finally:
+        extractor.stop()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def _extract_archive_thumbnail(extractor, path, dst_dir, tier, tmpdir):
+    """Return a new thumbnail pixbuf for the archive at <path> like
+    _get_new_archive_thumbnail(), extracting the cover with <extractor>
+    to <tmpdir>.
+    """
     condition = extractor.setup(path, tmpdir)
+    if condition is None:
+        raise IOError('Can not read {}'.format(path))
     files = extractor.get_files()
     wanted = _guess_cover(files)
     if wanted is None:
@@ -110,7 +235,7 @@ def _get_new_archive_thumbnail(path, dst_dir):
             condition.release()
             subpath = os.path.join(tmpdir, subs[0])
             """ Recursively try to find an image to use as cover """
-            return _get_new_archive_thumbnail(subpath, dst_dir)
+            return _get_new_archive_thumbnail(subpath, dst_dir, tier)
         return None
     extractor.set_files([wanted])
     extractor.extract()
@@ -119,16 +244,15 @@ def _get_new_archive_thumbnail(path, dst_dir):
     while not extractor.is_ready(wanted):
         condition.wait()
     condition.release()
-    pixbuf = _create_thumbnail(path, dst_dir, image_path=image_path)
-    shutil.rmtree(tmpdir)
-    return pixbuf
+    return _create_thumbnail(path, dst_dir, tier, image_path=image_path)
 
 
-def _create_thumbnail(path, dst_dir, image_path=None):
-    """Create a thumbnail from the file at <path> and store it if it is
-    larger than 128x128 px. A pixbuf for the thumbnail is returned.
+def _create_thumbnail(path, dst_dir, tier, image_path=None):
+    """Create a thumbnail of size <tier> from the file at <path> and store
+    it if the image is larger than that. A pixbuf for the thumbnail is
+    returned.
 
-    <dst_dir> is the base thumbnail directory (usually ~/.thumbnails/normal).
+    <dst_dir> is the base thumbnail directory (usually ~/.thumbnails).
 
     If <image_path> is not None it is used as the path to the image file
     actually used to create the thumbnail image, although the created
@@ -136,41 +260,135 @@ def _create_thumbnail(path, dst_dir, image_path=None):
     """
     if image_path is None:
         image_path = path
-    pixbuf = _get_pixbuf128(image_path)
+    # Raises if the file can't be read (e.g. a failed extraction), as
+    # opposed to read but not decoded.
+    open(image_path, 'rb').close()
+    tier_size = dict(_TIERS)[tier]
+    pixbuf = _get_scaled_pixbuf(image_path, tier_size)
     if pixbuf is None:
         return None
     mime, width, height = GdkPixbuf.Pixbuf.get_file_info(image_path)
-    if width <= 128 and height <= 128:
+    if mime is None or (width <= tier_size and height <= tier_size):
         return pixbuf
-    mime = mime.get_mime_types()[0]
-    uri = 'file://' + pathname2url(os.path.normpath(path))
-    thumbpath = _uri_to_thumbpath(uri, dst_dir)
     stat = os.stat(path)
-    mtime = str(int(stat.st_mtime))
-    size = str(stat.st_size)
-    width = str(width)
-    height = str(height)
     tEXt_data = {
-        'tEXt::Thumb::URI': uri,
-        'tEXt::Thumb::MTime': mtime,
-        'tEXt::Thumb::Size': size,
-        'tEXt::Thumb::Mimetype': mime,
-        'tEXt::Thumb::Image::Width': width,
-        'tEXt::Thumb::Image::Height': height,
-        'tEXt::Software': 'Comix {}'.format(constants.VERSION)
+        'tEXt::Thumb::Mimetype': mime.get_mime_types()[0],
+        'tEXt::Thumb::Image::Width': str(width),
+        'tEXt::Thumb::Image::Height': str(height)
     }
-    if not os.path.isdir(dst_dir):
-        os.makedirs(dst_dir, 0o700)
-    pixbuf.savev(thumbpath + '-comixtemp', 'png', tEXt_data.keys(), tEXt_data.values())
+    _save_thumbnail(pixbuf, path, _path_to_thumbpath(path, dst_dir, tier),
+                    stat, tEXt_data)
+    return pixbuf
+
+
+def _create_failed_thumbnail(path, failpath, stat):
+    """Record at <failpath> that no thumbnail could be made for the file
+    at <path>, with the stat object <stat>, as an empty thumbnail.
+    """
+    pixbuf = GdkPixbuf.Pixbuf.new(colorspace=GdkPixbuf.Colorspace.RGB,
+                                  has_alpha=True, bits_per_sample=8,
+                                  width=1, height=1)
+    pixbuf.fill(0x00000000)
+    try:
+        _save_thumbnail(pixbuf, path, failpath, stat)
+    except Exception:
+        print('! Could not store failed thumbnail for {}'.format(path))
+
+
+def _save_thumbnail(pixbuf, path, thumbpath, stat, tEXt_data=None):
+    """Save <pixbuf> as the thumbnail at <thumbpath> for the file at
+    <path>, with the stat object <stat>. The standard tEXt chunks are
+    added to those in <tEXt_data>.
+    """
+    tEXt_data = dict(tEXt_data or {})
+    tEXt_data.update({
+        'tEXt::Thumb::URI': 'file://' + pathname2url(os.path.normpath(path)),
+        'tEXt::Thumb::MTime': str(int(stat.st_mtime)),
+        'tEXt::Thumb::Size': str(stat.st_size),
+        'tEXt::Software': 'Comix {}'.format(constants.VERSION)
+    })
+    thumbdir = os.path.dirname(thumbpath)
+    if not os.path.isdir(thumbdir):
+        os.makedirs(thumbdir, 0o700)
+    pixbuf.savev(thumbpath + '-comixtemp', 'png', list(tEXt_data.keys()),
+                 list(tEXt_data.values()))
     os.rename(thumbpath + '-comixtemp', thumbpath)
     os.chmod(thumbpath, 0o600)
+    _remember_thumbnail(thumbpath, (int(stat.st_mtime), stat.st_size))
 
-    return pixbuf
 
+def _get_index():
+    """Return the thumbnail index, a dictionary with a tuple (mtime, size)
+    of the original file for each stored thumbnail, keyed on the path to
+    the thumbnail. The index is loaded from disk the first time. The
+    caller must hold _index_lock.
+    """
+    global _index
+    if _index is None:
+        _index = OrderedDict()
+        if os.path.isfile(_index_path):
+            try:
+                fd = open(_index_path, 'rb')
+                version = pickle.load(fd)
+                _index.update(pickle.load(fd))
+                fd.close()
+            except Exception:
+                print('! thumbnail.py: Could not parse {}'.format(_index_path))
+                _index.clear()
+    return _index
+
+
+def _remember_thumbnail(thumbpath, info):
+    """Add the (mtime, size) tuple <info> for <thumbpath> to the thumbnail
+    index, dropping the oldest entries if it grows too large.
+    """
+    global _index_changed
+    with _index_lock:
+        index = _get_index()
+        index.pop(thumbpath, None)
+        index[thumbpath] = info
+        while len(index) > _MAX_INDEX_ENTRIES:
+            index.popitem(last=False)
+        _index_changed = True
+        if _index_updates is not None:
+            _index_updates[thumbpath] = info
+
+
+def _forget_thumbnail(thumbpath):
+    """Remove <thumbpath> from the thumbnail index."""
+    global _index_changed
+    with _index_lock:
+        if _get_index().pop(thumbpath, None) is not None:
+            _index_changed = True
+        if _index_updates is not None:
+            _index_updates[thumbpath] = None
+
+
+def _is_valid(info, stat):
+    """Return True if a thumbnail with the (mtime, size) tuple <info> is
+    up to date for a file with the stat object <stat>. The size is optional
+    in thumbnails and only checked if it is there.
+    """
+    mtime, size = info
+    return mtime == int(stat.st_mtime) and size in (None, stat.st_size)
 
-def _path_to_thumbpath(path, dst_dir):
+
+def _get_int_option(pixbuf, key):
+    """Return the integer value of the PNG text chunk <key> of <pixbuf>,
+    or None if it is missing or not a number.
+    """
+    try:
+        return int(pixbuf.get_option(key))
+    except (TypeError, ValueError):
+        return None
+
+
+def _path_to_thumbpath(path, dst_dir, tier):
+    """Return the full path to the thumbnail for the file at <path> in
+    the subdirectory <tier> of the base thumbnail directory <dst_dir>.
+    """
     uri = 'file://' + pathname2url(os.path.normpath(path))
-    return _uri_to_thumbpath(uri, dst_dir)
+    return _uri_to_thumbpath(uri, os.path.join(dst_dir, tier))
 
 
 def _uri_to_thumbpath(uri, dst_dir):
@@ -182,32 +400,28 @@ def _uri_to_thumbpath(uri, dst_dir):
     return thumbpath
 
 
-def _get_pixbuf128(path):
+def _get_scaled_pixbuf(path, size):
+    """Return a pixbuf of the image at <path> that fits in <size>x<size> px, or
+    None if it can not be read.
+    """
+    try:
+        return image.load_thumbnail(path, size, size)
+    except Exception:
+        pass
+
+    # Formats that only GdkPixbuf can read.
     try:
         if "gif" not in path[-3:].lower():
-            return GdkPixbuf.Pixbuf.new_from_file_at_size(path, 128, 128)
+            return GdkPixbuf.Pixbuf.new_from_file_at_size(path, size, size)
         else:
             thumb = GdkPixbuf.PixbufAnimation(path).get_static_image()
             width = thumb.get_width()
             height = thumb.get_height()
             if width > height:
-                return thumb.scale_simple(128, int(max(height * 128 / width, 1)), GdkPixbuf.InterpType.TILES)
+                return thumb.scale_simple(size, int(max(height * size / width, 1)), GdkPixbuf.InterpType.TILES)
             else:
-                return thumb.scale_simple(int(max(width * 128 / height, 1)), 128, GdkPixbuf.InterpType.TILES)
+                return thumb.scale_simple(int(max(width * size / height, 1)), size, GdkPixbuf.InterpType.TILES)
     except Exception:
-        pass
-
-    # Try imaging
-    try:
-        im = Image.open(path)
-        width = im.size[0]
-        height = im.size[1]
-        if width > height:
-            im.resize(128, int(max(height * 128 / width, 1)))
-        else:
-            im.resize(int(max(width * 128 / height, 1)), 128)
-        return pil_to_pixbuf(im)
-    except:
         return None
 
 
@@ -105,7 +105,7 @@ class _ThumbnailMaintenanceDialog(Gtk.Dialog):
     def _update_num_and_size(self):
         self._num_thumbs = 0
         size_thumbs = 0
-        for subdir in ('normal', 'large'):
+        for subdir in ('normal', 'large', os.path.join('fail', 'comix')):
             dir_path = os.path.join(_thumb_base, subdir)
             if os.path.isdir(dir_path):
                 for entry in os.listdir(dir_path):
@@ -174,7 +174,7 @@ class _ThumbnailRemover(Gtk.Dialog):
         iteration = 0.0
         removed_thumbs = 0
         thumbs_size = 0
-        for subdir in ('normal', 'large'):
+        for subdir in ('normal', 'large', os.path.join('fail', 'comix')):
             dir_path = os.path.join(_thumb_base, subdir)
             if not os.path.isdir(dir_path) or not os.access(dir_path, os.X_OK):
                 continue
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import gzip
+import os
+import tarfile
+import threading
+import zipfile
+from io import BytesIO
+from unittest import mock
+
+import pytest
+
+from src import archive, archivecache
+
+# Captured with "unrar x -kb -p- -o- -idc -idp -- book.cbr <names> dst/".
+UNRAR_OUTPUT = b"""
+Extracting from /home/user/book.cbr
+
+Creating    /tmp/comix.abc/chapter 1                                  OK
+Extracting  /tmp/comix.abc/chapter 1/page 01.jpg                      OK
+Extracting  /tmp/comix.abc/chapter 1/page 02.jpg                      OK
+All OK
+"""
+
+# Captured with "7z x -bd -p- -y -odst/ -bb1 -- book.cb7 <names>".
+SEVENZIP_OUTPUT = b"""
+7-Zip [64] 16.02 : Copyright (c) 1999-2016 Igor Pavlov : 2016-05-21
+p7zip Version 16.02 (locale=en_US.UTF-8,Utf16=on,HugeFiles=on,64 bits)
+
+Scanning the drive for archives:
+1 file, 123456 bytes (121 KiB)
+
+Extracting archive: /home/user/book.cb7
+--
+Path = /home/user/book.cb7
+Type = 7z
+Physical Size = 123456
+Solid = +
+Blocks = 1
+
+- chapter 1/page 01.jpg
+- chapter 1/page 02.jpg
+
+Everything is Ok
+
+Files: 2
+"""
+
+NAMES = ['chapter 1/page 01.jpg', 'chapter 1/page 02.jpg']
+
+
+def test_get_extracted_name():
+    assert archive._get_extracted_name(
+        'Extracting  /tmp/comix.abc/a/b.jpg      OK', '/tmp/comix.abc/') == 'a/b.jpg'
+    assert archive._get_extracted_name('Extracting  a/b.jpg') == 'a/b.jpg'
+    assert archive._get_extracted_name('- a/b.jpg', '/tmp/comix.abc') == 'a/b.jpg'
+    assert archive._get_extracted_name('Extracting from /tmp/book.cbr') is None
+    assert archive._get_extracted_name('Creating    /tmp/comix.abc/a   OK') is None
+    assert archive._get_extracted_name('--') is None
+
+
+def _run_extract_process(archive_type, output):
+    """Return the files marked as ready while a RAR or 7z process that
+    prints <output> runs, and those marked after it has exited.
+    """
+    extractor = archive.Extractor()
+    extractor._type = archive_type
+    extractor._src = '/home/user/book'
+    extractor._dst = '/tmp/comix.abc/'
+    extractor._stop = False
+    ready = []
+    extractor._set_ready = ready.append
+    proc = mock.Mock()
+    proc.spawn.return_value = BytesIO(output)
+    proc.wait.side_effect = lambda: ready.append(None)
+    with mock.patch('src.archive.process.Process', return_value=proc) as process, \
+            mock.patch('src.archive._rar_exec', 'unrar'), \
+            mock.patch('src.archive._7z_exec', '7z'), \
+            mock.patch('src.archive._7z_progress_switches', ['-bb1']):
+        extractor._run_extract_process(NAMES)
+    cmd = process.call_args[0][0]
+    assert cmd[cmd.index('--') + 1] == '/home/user/book'
+    during = ready[:ready.index(None)]
+    after = ready[ready.index(None) + 1:]
+    return during, after
+
+
+def test_extract_process_rar():
+    during, after = _run_extract_process(archive.RAR, UNRAR_OUTPUT)
+    assert during == NAMES
+    assert after == []
+
+
+def test_extract_process_7z():
+    # 7z reports files when it starts on them, so the last one is only
+    # known to be done when the process exits.
+    during, after = _run_extract_process(archive.SEVENZIP, SEVENZIP_OUTPUT)
+    assert during == NAMES[:1]
+    assert after == NAMES[1:]
+
+
+def _write_tar(path, mode):
+    with tarfile.open(path, mode) as tar:
+        info = tarfile.TarInfo('page 01.jpg')
+        info.size = 4
+        tar.addfile(info, BytesIO(b'data'))
+
+
+def test_archive_mime_type(tmp_path):
+    path = str(tmp_path / 'book.cbz')
+    with zipfile.ZipFile(path, 'w') as zip_file:
+        zip_file.writestr('page 01.jpg', b'data')
+        zip_file.comment = b'comment'
+    assert archive.archive_mime_type(path) == archive.ZIP
+    # The type is found from the contents, not the name.
+    renamed = str(tmp_path / 'book.cbr')
+    with open(path, 'rb') as src, open(renamed, 'wb') as dst:
+        dst.write(src.read())
+    assert archive.archive_mime_type(renamed) == archive.ZIP
+    for name, mode, archive_type in (('book.cbt', 'w', archive.TAR),
+                                     ('book.tar.gz', 'w:gz', archive.GZIP),
+                                     ('book.tar.bz2', 'w:bz2', archive.BZIP2)):
+        path = str(tmp_path / name)
+        _write_tar(path, mode)
+        assert archive.archive_mime_type(path) == archive_type
+
+
+def test_archive_mime_type_not_archive(tmp_path):
+    for name, data in (('empty.cbz', b''),
+                       ('text.cbz', b'PK not really a zip file'),
+                       ('image.jpg', b'\xff\xd8\xff\xe0' + b'\0' * 1000),
+                       # Compressed, but not a tar archive.
+                       ('page.gz', gzip.compress(b'data' * 1000))):
+        path = str(tmp_path / name)
+        with open(path, 'wb') as fd:
+            fd.write(data)
+        assert archive.archive_mime_type(path) is None
+    assert archive.archive_mime_type(str(tmp_path / 'gone.cbz')) is None
+    assert archive.archive_mime_type(str(tmp_path)) is None
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(archivecache, '_db_path', str(tmp_path / 'archive_cache.db'))
+    monkeypatch.setattr(archivecache, '_con', None)
+    yield
+    if archivecache._con is not None:
+        archivecache._con.close()
+
+
+def _write_zip(path, names):
+    with zipfile.ZipFile(path, 'w') as zip_file:
+        for name in names:
+            zip_file.writestr(name, b'data')
+    return path
+
+
+def test_stop_wakes_waiting_threads(tmp_path, cache):
+    extractor = archive.Extractor()
+    condition = extractor.setup(_write_zip(str(tmp_path / 'book.cbz'), NAMES),
+                                str(tmp_path / 'dst') + os.sep)
+    stopped = []
+
+    def _wait():
+        with condition:
+            while not extractor.is_stopped():
+                condition.wait()
+        stopped.append(True)
+
+    thread = threading.Thread(target=_wait)
+    thread.start()
+    extractor.stop()
+    thread.join(5)
+    assert stopped == [True]
+    # The Condition is kept for the next archive, and setup() clears the
+    # stopped state.
+    assert extractor.setup(str(tmp_path / 'book.cbz'),
+                           str(tmp_path / 'dst') + os.sep) is condition
+    assert not extractor.is_stopped()
+    extractor.stop()
+    extractor.close()
+
+
+def test_thread_handles_are_closed(tmp_path, cache):
+    path = _write_zip(str(tmp_path / 'book.cbz'), ['page 01.jpg'])
+    extractor = archive.Extractor()
+    extractor.setup(path, str(tmp_path / 'dst') + os.sep)
+    data = []
+
+    def _read():
+        data.append(extractor.read_file('page 01.jpg'))
+        extractor.close_thread_handle()
+
+    try:
+        for _ in range(3):
+            thread = threading.Thread(target=_read)
+            thread.start()
+            thread.join()
+        assert data == [b'data'] * 3
+        assert extractor._handles == []
+    finally:
+        extractor.stop()
+        extractor.close()
+
+
+def test_extract_file_io_rar(tmp_path):
+    extractor = archive.Extractor()
+    extractor._type = archive.RAR
+    extractor._src = '/home/user/book.cbr'
+    extractor._dst = None
+    extractor._stop = False
+    commands = []
+
+    def _process(cmd):
+        # Write the file where unrar would, and report it.
+        commands.append(cmd)
+        path = os.path.join(cmd[-1], 'page 01.jpg')
+        with open(path, 'wb') as fd:
+            fd.write(b'data')
+        proc = mock.Mock()
+        proc.spawn.return_value = BytesIO(
+            'Extracting  {}   OK\n'.format(path).encode('utf-8'))
+        return proc
+
+    with mock.patch('src.archive.process.Process', side_effect=_process), \
+            mock.patch('src.archive._rar_exec', 'unrar'):
+        assert extractor.extract_file_io('page 01.jpg').read() == b'data'
+    assert len(commands) == 1 and commands[0][1] == 'x'
+    # The temporary destination directory is removed again.
+    assert not os.path.exists(commands[0][-1])
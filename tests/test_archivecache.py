@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import itertools
+import os
+from unittest import mock
+
+import pytest
+
+from src import archive, archivecache
+
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(archivecache, '_db_path', str(tmp_path / 'archive_cache.db'))
+    monkeypatch.setattr(archivecache, '_con', None)
+    # Make sure that every use is later than the previous one.
+    clock = itertools.count(1000)
+    monkeypatch.setattr(archivecache, 'time', mock.Mock(time=lambda: next(clock)))
+    yield
+    if archivecache._con is not None:
+        archivecache._con.close()
+
+
+def _archive(tmp_path, name, data=b'data'):
+    path = str(tmp_path / name)
+    with open(path, 'wb') as fd:
+        fd.write(data)
+    return path
+
+
+def test_toc_and_page_info(tmp_path):
+    path = _archive(tmp_path, 'book.cbz')
+    assert archivecache.get_toc(path) is None
+    assert archivecache.get_page_info(path) == {}
+    members = [('page 01.jpg', 0, 100), ('page 02.jpg', 100, 200)]
+    archivecache.set_toc(path, archive.ZIP, members, solid=False)
+    archivecache.set_page_info(path, {'page 01.jpg': (10, 20, 1, 'image/jpeg')})
+    assert archivecache.get_toc(path) == (archive.ZIP, members, False)
+    assert archivecache.get_page_info(path) == {
+        'page 01.jpg': (10, 20, 1, 'image/jpeg')}
+    # Changing the archive drops everything stored about it.
+    with open(path, 'ab') as fd:
+        fd.write(b'more')
+    assert archivecache.get_toc(path) is None
+    assert archivecache.get_page_info(path) == {}
+    os.remove(path)
+    assert archivecache.get_toc(path) is None
+
+
+def test_thumbnails(tmp_path, monkeypatch):
+    monkeypatch.setattr(archivecache, '_MAX_THUMBNAIL_ARCHIVES', 2)
+    paths = [_archive(tmp_path, 'book{}.cbz'.format(i)) for i in range(3)]
+    archivecache.set_thumbnails(paths[0], 128, 128, {'a.jpg': b'png a'})
+    archivecache.set_thumbnails(paths[0], 128, 128, {'b.jpg': b'png b'})
+    archivecache.set_thumbnails(paths[0], 64, 64, {'a.jpg': b'small a'})
+    assert archivecache.get_thumbnails(paths[0], 128, 128) == {
+        'a.jpg': b'png a', 'b.jpg': b'png b'}
+    assert archivecache.get_thumbnails(paths[0], 64, 64) == {'a.jpg': b'small a'}
+    archivecache.set_thumbnails(paths[1], 128, 128, {'a.jpg': b'png a'})
+    # Use the first archive again, so the second is the oldest one.
+    archivecache.get_thumbnails(paths[0], 128, 128)
+    archivecache.set_thumbnails(paths[2], 128, 128, {'a.jpg': b'png a'})
+    assert archivecache.get_thumbnails(paths[0], 128, 128)
+    assert archivecache.get_thumbnails(paths[1], 128, 128) == {}
+    assert archivecache.get_thumbnails(paths[2], 128, 128)
+
+
+def test_old_archives_are_removed(tmp_path, monkeypatch):
+    monkeypatch.setattr(archivecache, '_MAX_ARCHIVES', 2)
+    paths = [_archive(tmp_path, 'book{}.cbz'.format(i)) for i in range(3)]
+    members = [('page.jpg', 0, 4)]
+    archivecache.set_toc(paths[0], archive.ZIP, members)
+    archivecache.set_toc(paths[1], archive.ZIP, members)
+    archivecache.get_toc(paths[0])
+    archivecache.set_toc(paths[2], archive.ZIP, members)
+    assert archivecache.get_toc(paths[0]) is not None
+    assert archivecache.get_toc(paths[1]) is None
+    assert archivecache.get_toc(paths[2]) is not None
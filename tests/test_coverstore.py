@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import itertools
+import os
+import sqlite3
+from unittest import mock
+
+import pytest
+
+from src import coverstore
+
+
+@pytest.fixture(autouse=True)
+def store(tmp_path, monkeypatch):
+    path = str(tmp_path / 'library_covers.db')
+    monkeypatch.setattr(coverstore, '_db_path', path)
+    monkeypatch.setattr(coverstore, '_con', None)
+    # Make sure that every cover is stored later than the previous one.
+    clock = itertools.count(1000)
+    monkeypatch.setattr(coverstore, 'time', mock.Mock(time=lambda: next(clock)))
+    # Covers are stored as they are, rather than as PNG data.
+    monkeypatch.setattr(coverstore.image, 'load_pixbuf_from_data', lambda data: data)
+    yield path
+    if coverstore._con is not None:
+        coverstore._con.close()
+
+
+def _pixbuf(data):
+    pixbuf = mock.Mock()
+    pixbuf.save_to_bufferv.return_value = (True, data)
+    return pixbuf
+
+
+def _book(tmp_path, name='book.cbz'):
+    path = str(tmp_path / name)
+    with open(path, 'wb') as fd:
+        fd.write(b'data')
+    return path
+
+
+def test_get_and_set_cover(tmp_path):
+    path = _book(tmp_path)
+    assert coverstore.get_cover(1, path, 128) is None
+    coverstore.set_cover(1, path, 128, _pixbuf(b'cover 128'))
+    assert coverstore.get_cover(1, path, 128) == b'cover 128'
+    assert coverstore.get_cover(1, path, 64) is None
+    assert coverstore.get_cover(2, path, 128) is None
+    coverstore.delete_covers([1])
+    assert coverstore.get_cover(1, path, 128) is None
+
+
+def test_changed_archive(tmp_path):
+    path = _book(tmp_path)
+    coverstore.set_cover(1, path, 128, _pixbuf(b'cover'))
+    with open(path, 'ab') as fd:
+        fd.write(b'more')
+    os.utime(path, (0, 0))
+    assert coverstore.get_cover(1, path, 128) is None
+
+
+def test_keeps_last_sizes(tmp_path):
+    path = _book(tmp_path)
+    sizes = [64, 96, 128, 160]
+    for size in sizes:
+        coverstore.set_cover(1, path, size, _pixbuf(b'cover'))
+    coverstore.set_cover(2, path, 64, _pixbuf(b'other'))
+    assert [size for size in sizes
+            if coverstore.get_cover(1, path, size) is not None] == \
+        sizes[-coverstore._MAX_SIZES:]
+    assert coverstore.get_cover(2, path, 64) == b'other'
+
+
+def test_old_layout_is_dropped(store, tmp_path):
+    con = sqlite3.connect(store)
+    con.execute('''CREATE TABLE cover (book INTEGER PRIMARY KEY, path string,
+        size INTEGER, mtime REAL, data BLOB)''')
+    con.commit()
+    con.close()
+    path = _book(tmp_path)
+    coverstore.set_cover(1, path, 128, _pixbuf(b'cover'))
+    assert coverstore.get_cover(1, path, 128) == b'cover'
+    version = coverstore._get_connection().execute('PRAGMA user_version').fetchone()
+    assert version == (coverstore._VERSION,)
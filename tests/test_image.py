@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from io import BytesIO
+from unittest import mock
+
+from PIL import Image
+from PIL import JpegImagePlugin
+
+from src import image
+
+
+def _save(path, image_format, size=(40, 60), orientation=None):
+    exif = Image.Exif()
+    if orientation is not None:
+        exif[0x0112] = orientation
+    Image.new('RGB', size).save(path, image_format, exif=exif)
+    return path
+
+
+def test_get_header_info(tmp_path):
+    path = _save(str(tmp_path / 'page.jpg'), 'JPEG', orientation=6)
+    assert image.get_header_info(path) == (40, 60, 6, 'JPEG')
+    path = _save(str(tmp_path / 'page.webp'), 'WEBP', orientation=3)
+    assert image.get_header_info(path) == (40, 60, 3, 'WEBP')
+    path = _save(str(tmp_path / 'page.png'), 'PNG')
+    assert image.get_header_info(path) == (40, 60, 1, 'PNG')
+
+
+def test_get_header_info_does_not_decode(tmp_path):
+    # Only the start of the file is there, so decoding it would fail.
+    path = _save(str(tmp_path / 'page.png'), 'PNG', size=(2000, 3000))
+    with open(path, 'rb') as fd:
+        data = fd.read(1024)
+    assert image.get_header_info(BytesIO(data)) == (2000, 3000, 1, 'PNG')
+
+
+def _captured_pixbuf_data(monkeypatch):
+    """Make pil_to_pixbuf() return the arguments it creates the pixbuf
+    from, rather than a pixbuf.
+    """
+    pixbufs = mock.Mock()
+    pixbufs.Pixbuf.new_from_data.side_effect = lambda *args: args
+    monkeypatch.setattr(image, 'GdkPixbuf', pixbufs)
+
+
+def test_pil_to_pixbuf_16_bit(monkeypatch):
+    _captured_pixbuf_data(monkeypatch)
+    im = Image.new('I;16', (2, 1))
+    im.putpixel((0, 0), 0xFFFF)
+    im.putpixel((1, 0), 0x8000)
+    data, colorspace, has_alpha, bits, width, height, rowstride = \
+        image.pil_to_pixbuf(im)
+    assert bytes(data) == b'\xff\xff\xff\x80\x80\x80'
+    assert (has_alpha, width, height, rowstride) == (False, 2, 1, 6)
+
+
+def test_load_thumbnail(monkeypatch, tmp_path):
+    _captured_pixbuf_data(monkeypatch)
+    path = _save(str(tmp_path / 'page.jpg'), 'JPEG', size=(2000, 3000))
+    decoded = []
+    draft = JpegImagePlugin.JpegImageFile.draft
+
+    def _draft(im, mode, size):
+        result = draft(im, mode, size)
+        decoded.append(im.size)
+        return result
+
+    monkeypatch.setattr(JpegImagePlugin.JpegImageFile, 'draft', _draft)
+    width, height = image.load_thumbnail(path, 128, 128)[4:6]
+    assert (width, height) == (85, 128)
+    # Decoded at 1/8 of the size by libjpeg.
+    assert decoded[0] == (250, 375)
+    path = _save(str(tmp_path / 'page.png'), 'PNG', size=(300, 100))
+    assert image.load_thumbnail(path, 128, 128)[4:6] == (128, 43)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+from types import SimpleNamespace
+from unittest import mock
+
+from src import library
+
+
+def _book_area(num_books, first, last):
+    """Return a stand-in for a _BookArea with <num_books> books, of which
+    those from <first> to <last> are visible, that starts no threads.
+    """
+    start = mock.Mock()
+    start.get_indices.return_value = [first]
+    end = mock.Mock()
+    end.get_indices.return_value = [last]
+    iconview = mock.Mock()
+    iconview.get_visible_range.return_value = (start, end)
+    return SimpleNamespace(
+        _update_pending=True, _iconview=iconview,
+        _liststore=[['placeholder', 100 + i] for i in range(num_books)],
+        _book_paths=dict((100 + i, '/books/{}.cbz'.format(i))
+                         for i in range(num_books)),
+        _covers_requested=set(), _covers_wanted=[], _covers_loaded=[],
+        _cover_condition=threading.Condition(),
+        _cover_threads=library._COVER_THREADS, _flush_pending=True,
+        _missing_cover='missing', _schedule_update_covers=mock.Mock())
+
+
+def test_update_covers_visible_first():
+    area = _book_area(20, 5, 6)
+    library._BookArea._update_covers(area)
+    # The visible books, then those closest to them, a screenful on
+    # either side.
+    assert [index for index, book, path in area._covers_wanted] == [
+        5, 6, 7, 4, 8, 3]
+    assert area._covers_wanted[0] == (5, 105, '/books/5.cbz')
+    # Requested covers are not requested again.
+    area._covers_wanted = []
+    library._BookArea._update_covers(area)
+    assert area._covers_wanted == []
+    area = _book_area(3, 0, 1)
+    library._BookArea._update_covers(area)
+    assert [index for index, book, path in area._covers_wanted] == [0, 1, 2]
+
+
+def test_flush_covers():
+    area = _book_area(3, 0, 2)
+    area._covers_loaded = [(0, 100, 'cover'), (1, 101, None), (2, 999, 'moved')]
+    area._covers_requested = {100, 101, 999}
+    library._BookArea._flush_covers(area)
+    assert [row[0] for row in area._liststore] == [
+        'cover', 'missing', 'placeholder']
+    # The cover of a book that moved is requested again.
+    assert area._covers_requested == {100, 101}
+    assert area._schedule_update_covers.called
+    assert not area._flush_pending
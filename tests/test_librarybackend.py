@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+
+import pytest
+
+from src import archive, archivecache, librarybackend, thumbnail
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    path = str(tmp_path / 'library.db')
+    monkeypatch.setattr(librarybackend, '_db_path', path)
+    monkeypatch.setattr(librarybackend, '_cover_dir', str(tmp_path / 'covers'))
+    return path
+
+
+@pytest.fixture
+def backend(db_path):
+    backend = librarybackend.LibraryBackend()
+    yield backend
+    backend.close()
+
+
+def _query_plan(backend, query, parameters=()):
+    return ' '.join(str(row[-1]) for row in backend._con.execute(
+            'EXPLAIN QUERY PLAN ' + query, parameters))
+
+
+def test_migrate_from_version_0(db_path):
+    # The layout of libraries from before schema versions.
+    con = sqlite3.connect(db_path)
+    con.execute('''CREATE TABLE book (id INTEGER PRIMARY KEY, name string,
+        path string UNIQUE, pages INTEGER, format INTEGER, size INTEGER,
+        added DATE DEFAULT current_date)''')
+    con.execute('''CREATE TABLE collection (id INTEGER PRIMARY KEY,
+        name string UNIQUE, supercollection INTEGER)''')
+    con.execute('''CREATE TABLE contain (collection INTEGER NOT NULL,
+        book INTEGER NOT NULL, PRIMARY KEY (collection, book))''')
+    con.execute('''INSERT INTO book (name, path, pages, format, size)
+        VALUES ('old.cbz', '/books/old.cbz', 10, 0, 1000)''')
+    con.commit()
+    con.close()
+
+    backend = librarybackend.LibraryBackend()
+    try:
+        version = backend._con.execute('PRAGMA user_version').fetchone()
+        assert version == len(backend._get_migrations())
+        columns = [row[1] for row in backend._con.execute('PRAGMA table_info(book)')]
+        assert 'mtime' in columns and 'missing' in columns
+        record = backend.get_book_record(1)
+        assert record.path == '/books/old.cbz' and not record.missing
+        if backend._has_search_index:
+            assert backend.get_books_in_collection(None, 'old') == [1]
+    finally:
+        backend.close()
+    # Opening it again runs no more migrations.
+    backend = librarybackend.LibraryBackend()
+    try:
+        assert backend.get_book_record(1).name == 'old.cbz'
+    finally:
+        backend.close()
+
+
+def test_indexes_are_used(backend):
+    assert 'contain_book' in _query_plan(
+            backend, 'SELECT collection FROM Contain WHERE book = ?', (1,))
+    assert 'collection_supercollection' in _query_plan(
+            backend, 'SELECT id FROM Collection WHERE supercollection = ?', (1,))
+    assert 'book_added' in _query_plan(
+            backend, 'SELECT id FROM Book WHERE added > ?', ('2000-01-01',))
+
+
+def _add_book(backend, path, size=4, mtime=None):
+    record = (path, os.path.basename(path), 1, 0, size, mtime)
+    backend.add_book_records([record])
+    return backend._con.execute('SELECT id FROM Book WHERE path = ?',
+                                (path,)).fetchone()
+
+
+def test_search_index_follows_books(backend):
+    if not backend._has_search_index:
+        pytest.skip('sqlite was built without FTS5')
+    book = _add_book(backend, '/books/Blue Moon 01.cbz')
+    assert backend.get_books_in_collection(None, 'moon') == [book]
+    assert backend.get_books_in_collection(None, 'blu mo') == [book]
+    assert backend.get_books_in_collection(None, 'sun') == []
+    # Words that are not in the index are ignored.
+    assert backend.get_books_in_collection(None, '-') == [book]
+    assert backend.get_books_in_collection(None, 'moon (') == [book]
+    with backend._con:
+        backend._con.execute('''UPDATE Book SET name = 'Red Sun 01.cbz',
+            path = '/books/Red Sun 01.cbz' WHERE id = ?''', (book,))
+    assert backend.get_books_in_collection(None, 'moon') == []
+    assert backend.get_books_in_collection(None, 'sun') == [book]
+    backend.remove_book(book)
+    assert backend.get_books_in_collection(None, 'sun') == []
+
+
+def test_get_changed_books(backend, tmp_path):
+    paths = [str(tmp_path / name) for name in ('same.cbz', 'changed.cbz',
+                                               'gone.cbz', 'old.cbz')]
+    for path in paths:
+        with open(path, 'wb') as fd:
+            fd.write(b'data')
+    books = []
+    for path in paths[:3]:
+        books.append(_add_book(backend, path, mtime=os.stat(path).st_mtime))
+    # Added before modification times were stored.
+    old = _add_book(backend, paths[3])
+    with open(paths[1], 'ab') as fd:
+        fd.write(b'more')
+    os.remove(paths[2])
+    assert backend.get_changed_books() == ([paths[1]], [books[2]], [])
+    assert backend._con.execute('SELECT mtime FROM Book WHERE id = ?',
+                                (old,)).fetchone() == os.stat(paths[3]).st_mtime
+    # Books that are already known to be missing are not reported again,
+    # until their archives are back.
+    backend.set_books_missing([books[2]])
+    assert backend.get_missing_books() == [books[2]]
+    assert backend.get_changed_books() == ([paths[1]], [], [])
+    with open(paths[2], 'wb') as fd:
+        fd.write(b'data')
+    os.utime(paths[2], (0, backend.get_book_file_states()[2][3]))
+    assert backend.get_changed_books() == ([paths[1]], [], [books[2]])
+
+
+def test_read_book_reports_errors(tmp_path, monkeypatch):
+    monkeypatch.setattr(archivecache, '_db_path', str(tmp_path / 'archive_cache.db'))
+    monkeypatch.setattr(archivecache, '_con', None)
+    monkeypatch.setattr(archive, '_interactive', True)
+    monkeypatch.setattr(archive, '_rar_exec', None)
+    monkeypatch.setattr(archive, '_get_rar_exec', lambda: None)
+    monkeypatch.setattr(thumbnail, '_index_updates', None)
+    # As in the worker processes, which have no user interface.
+    librarybackend._init_import_worker()
+    path = str(tmp_path / 'book.cbr')
+    with open(path, 'wb') as fd:
+        fd.write(b'Rar!\x1a\x07\x00' + b'\0' * 100)
+    text_path = str(tmp_path / 'text.cbz')
+    with open(text_path, 'wb') as fd:
+        fd.write(b'not a book')
+    try:
+        assert librarybackend._read_book(path)[1:] == (
+            None, _('Could not find RAR file extractor!'), {})
+        # No message for files that are simply not archives.
+        assert librarybackend._read_book(text_path)[1:3] == (None, None)
+    finally:
+        if archivecache._con is not None:
+            archivecache._con.close()
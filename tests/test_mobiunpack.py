@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import struct
+
+import pytest
+
+from src import mobiunpack
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\0' * 100
+JPEG = b'\xff\xd8\xff\xe0\0\x10JFIF\0' + b'\0' * 100
+
+
+def _write_mobi(path, sections):
+    """Write a minimal unencrypted MOBI book with the image <sections>
+    (and a record header) to <path>.
+    """
+    header = bytearray(0x100)
+    struct.pack_into('>L', header, 0x6C, 1)  # First image record.
+    sections = [bytes(header)] + sections
+    head = bytearray(78)
+    head[0x3C:0x44] = b'BOOKMOBI'
+    struct.pack_into('>H', head, 76, len(sections))
+    offset = len(head) + len(sections) * 8
+    table = b''
+    for section in sections:
+        table += struct.pack('>LL', offset, 0)
+        offset += len(section)
+    with open(path, 'wb') as fd:
+        fd.write(bytes(head) + table + b''.join(sections))
+
+
+def test_read_images(tmp_path):
+    path = str(tmp_path / 'book.mobi')
+    _write_mobi(path, [PNG, JPEG, b'not an image'])
+    mobi = mobiunpack.MobiFile(path)
+    try:
+        assert mobi.getnames() == ['image00001.png', 'image00002.jpeg']
+        data = mobi.read('image00002.jpeg')
+        assert bytes(data) == JPEG
+        mobi.extract('image00001.png', str(tmp_path / 'page.png'))
+        with open(str(tmp_path / 'page.png'), 'rb') as fd:
+            assert fd.read() == PNG
+        with pytest.raises(mobiunpack.unpackException):
+            mobi.read('image00009.png')
+    finally:
+        # Closing is fine while the data that was read is still in use.
+        mobi.close()
+    assert bytes(data) == JPEG
+
+
+def test_invalid_files(tmp_path):
+    for name, data in (('empty.mobi', b''), ('short.mobi', b'BOOKMOBI'),
+                       ('text.mobi', b'not a book' * 100)):
+        path = str(tmp_path / name)
+        with open(path, 'wb') as fd:
+            fd.write(data)
+        with pytest.raises(mobiunpack.unpackException):
+            mobiunpack.MobiFile(path)
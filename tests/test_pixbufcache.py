@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+from src import pixbufcache
+
+
+def _pixbuf(size):
+    pixbuf = mock.Mock()
+    pixbuf.get_rowstride.return_value = size
+    pixbuf.get_height.return_value = 1
+    return pixbuf
+
+
+def test_get_pixbuf_size():
+    assert pixbufcache.get_pixbuf_size(_pixbuf(100)) == 100
+    animation = mock.Mock(spec=['get_width', 'get_height'])
+    animation.get_width.return_value = 10
+    animation.get_height.return_value = 5
+    assert pixbufcache.get_pixbuf_size(animation) == 200
+
+
+def test_evicts_least_recently_used():
+    cache = pixbufcache.PixbufCache(limit=300)
+    for key in (1, 2, 3):
+        cache[key] = _pixbuf(100)
+    cache[1]  # Use 1, so that 2 is now the oldest.
+    cache[4] = _pixbuf(100)
+    assert sorted(cache) == [1, 3, 4]
+    assert cache.get_size() == 300
+    # Replacing a pixbuf does not count the old one.
+    cache[3] = _pixbuf(50)
+    assert len(cache) == 3 and cache.get_size() == 250
+
+
+def test_pinned_are_kept():
+    cache = pixbufcache.PixbufCache(limit=200)
+    cache[1] = _pixbuf(100)
+    cache[2] = _pixbuf(100)
+    cache.pin([1, 2])
+    cache[3] = _pixbuf(100)
+    assert sorted(cache) == [1, 2]
+    # Pinned pages stay even if they alone exceed the limit.
+    cache.pin([1, 2])
+    cache.set_limit(0)
+    assert sorted(cache) == [1, 2]
+    cache.pin([2])
+    assert list(cache) == [2]
+    cache.clear()
+    assert len(cache) == 0 and cache.get_size() == 0
+
+
+def test_get_limits():
+    decoded, scaled = pixbufcache.get_limits(256)
+    assert decoded + scaled == 256 * 1024 * 1024
+    assert scaled == 64 * 1024 * 1024
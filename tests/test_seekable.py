@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import bz2
+import gzip
+import os
+import random
+
+import pytest
+
+from src import seekable
+
+
+def _data():
+    rand = random.Random(0)
+    return bytes(bytearray(rand.randrange(16) for _ in range(300000)))
+
+
+@pytest.fixture(autouse=True)
+def small_checkpoints(monkeypatch):
+    monkeypatch.setattr(seekable, '_CHECKPOINT_SPACING', 16 * 1024)
+    monkeypatch.setattr(seekable, '_READ_SIZE', 4 * 1024)
+    monkeypatch.setattr(seekable, '_indexes', {})
+
+
+@pytest.fixture(params=[seekable.GZIP, seekable.BZIP2])
+def compressed(request, tmp_path):
+    data = _data()
+    path = str(tmp_path / 'data')
+    half = len(data) // 2
+    # Concatenated streams, as written by pigz or pbzip2.
+    if request.param == seekable.GZIP:
+        content = gzip.compress(data[:half]) + gzip.compress(data[half:])
+    else:
+        content = bz2.compress(data[:half]) + bz2.compress(data[half:])
+    with open(path, 'wb') as fd:
+        fd.write(content)
+    return path, request.param, data
+
+
+def test_read_all(compressed):
+    path, kind, data = compressed
+    fd = seekable.SeekableFile(path, kind)
+    try:
+        assert fd.read() == data
+        assert fd.read(10) == b''
+        assert fd.tell() == len(data)
+    finally:
+        fd.close()
+
+
+def test_random_seeks(compressed):
+    path, kind, data = compressed
+    rand = random.Random(1)
+    for _ in range(2):  # The second file object uses the stored index.
+        fd = seekable.SeekableFile(path, kind)
+        try:
+            assert fd.seek(0, os.SEEK_END) == len(data)
+            for _ in range(30):
+                offset = rand.randrange(len(data))
+                size = rand.randrange(1, 20000)
+                fd.seek(offset)
+                assert fd.read(size) == data[offset:offset + size]
+                assert fd.tell() == min(offset + size, len(data))
+            fd.seek(-100, os.SEEK_END)
+            assert fd.read() == data[-100:]
+            fd.seek(1000)
+            fd.seek(-500, os.SEEK_CUR)
+            assert fd.read(10) == data[500:510]
+        finally:
+            fd.close()
+    assert len(seekable._get_index(path)._offsets) > 2
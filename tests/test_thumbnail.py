@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+from collections import namedtuple
+from unittest import mock
+
+import pytest
+
+from src import thumbnail
+
+Stat = namedtuple('Stat', 'st_mtime st_size')
+
+
+@pytest.fixture(autouse=True)
+def index(tmp_path, monkeypatch):
+    monkeypatch.setattr(thumbnail, '_index_path', str(tmp_path / 'thumbnail_index.pickle'))
+    monkeypatch.setattr(thumbnail, '_index', None)
+    monkeypatch.setattr(thumbnail, '_index_changed', False)
+    monkeypatch.setattr(thumbnail, '_index_updates', None)
+
+
+def test_index_is_written_and_read():
+    thumbnail._remember_thumbnail('/thumbs/a.png', (100, 10))
+    thumbnail._remember_thumbnail('/thumbs/b.png', (200, None))
+    thumbnail._forget_thumbnail('/thumbs/b.png')
+    thumbnail.write_index()
+    assert os.path.isfile(thumbnail._index_path)
+    thumbnail._index = None
+    with thumbnail._index_lock:
+        assert dict(thumbnail._get_index()) == {'/thumbs/a.png': (100, 10)}
+
+
+def test_index_drops_oldest(monkeypatch):
+    monkeypatch.setattr(thumbnail, '_MAX_INDEX_ENTRIES', 2)
+    for name in ('a', 'b', 'a', 'c'):
+        thumbnail._remember_thumbnail(name, (1, 1))
+    with thumbnail._index_lock:
+        assert list(thumbnail._get_index()) == ['a', 'c']
+
+
+def test_is_valid():
+    assert thumbnail._is_valid((100, 10), Stat(100.5, 10))
+    assert thumbnail._is_valid((100, None), Stat(100.5, 10))
+    assert not thumbnail._is_valid((100, 10), Stat(101, 10))
+    assert not thumbnail._is_valid((100, 10), Stat(100, 11))
+
+
+def test_outdated_thumbnails_are_not_read(monkeypatch):
+    pixbufs = mock.Mock()
+    monkeypatch.setattr(thumbnail, 'GdkPixbuf', pixbufs)
+    thumbnail._remember_thumbnail('/thumbs/a.png', (100, 10))
+    assert thumbnail._load_stored_thumbnail('/thumbs/a.png', Stat(200, 10)) is None
+    assert not pixbufs.Pixbuf.new_from_file.called
+    # Up to date thumbnails are loaded without reading their options.
+    assert thumbnail._load_stored_thumbnail('/thumbs/a.png', Stat(100, 10)) is \
+        pixbufs.Pixbuf.new_from_file.return_value
+    assert not pixbufs.Pixbuf.new_from_file.return_value.get_option.called
+
+
+def test_index_updates():
+    # Not tracked unless asked for.
+    thumbnail._remember_thumbnail('/thumbs/a.png', (100, 10))
+    assert thumbnail.take_index_updates() == {}
+    thumbnail.track_index_updates()
+    thumbnail._remember_thumbnail('/thumbs/b.png', (200, 20))
+    thumbnail._forget_thumbnail('/thumbs/a.png')
+    updates = thumbnail.take_index_updates()
+    assert updates == {'/thumbs/b.png': (200, 20), '/thumbs/a.png': None}
+    assert thumbnail.take_index_updates() == {}
+    # As applied by the process that writes the index.
+    thumbnail._index = None
+    thumbnail._remember_thumbnail('/thumbs/a.png', (100, 10))
+    thumbnail.update_index(updates)
+    with thumbnail._index_lock:
+        assert dict(thumbnail._get_index()) == {'/thumbs/b.png': (200, 20)}